@@ -0,0 +1,224 @@
+"""Reproducible benchmarks on synthetic stock masters.
+
+Generates stock masters and multi-site datasets of a given size, times the main stages of
+the pipeline separately and saves the timings as json, so that runs can be compared across commits.
+"""
+
+import argparse
+import itertools
+import platform
+import random
+import subprocess
+import time
+
+import pandas
+
+import file_utils
+
+NOUNS = ["BOLT", "NUT", "WASHER", "SCREW", "BEARING", "SEAL", "O-RING", "GASKET", "FILTER", "VALVE", "PUMP", "HOSE",
+         "BELT", "SWITCH", "CABLE", "FUSE", "RELAY", "SENSOR", "MOTOR", "BRACKET", "CLAMP", "PIN", "SPRING", "SHAFT",
+         "GEAR", "PLATE", "PIPE", "ELBOW", "TEE", "FLANGE", "COUPLING", "CONNECTOR", "BUSHING", "CYLINDER", "NOZZLE", "LAMP"]
+MODIFIERS = ["HEX", "FLAT", "LOCK", "HYDRAULIC", "AIR", "OIL", "FUEL", "WATER", "STAINLESS", "STEEL", "BRASS", "RUBBER",
+             "NYLON", "GALV", "BALL", "ROLLER", "TAPER", "CHECK", "GATE", "RELIEF", "PRESSURE", "TEMPERATURE", "ELECTRIC",
+             "SS", "ASSY", "BRG", "KIT", "REPAIR", "HIGH", "LOW", "HEAVY", "DUTY", "MALE", "FEMALE", "SEALED", "SPLIT"]
+SIZES = ["M6", "M8", "M10", "M12", "M16", "M20", "M24", "1/4IN", "3/8IN", "1/2IN", "3/4IN", "1IN", "10MM", "25MM", "50MM", "100MM"]
+BRANDS = ["CAT", "KOMATSU", "LG", "SKF", "PARKER", "BOSCH", "FESTO", "GATES", "TIMKEN", "EATON"]
+
+STAGES = ["most_matching_words", "match_by_description", "match_sites", "add_commodities_to_stocks", "detect_brands", "embedding_match"]
+
+def generate_descriptions(n, rng, duplicate_rate=0.2, vocabulary_size=None):
+    """Generate n stock descriptions resembling real ones.
+
+    Descriptions combine a noun, modifiers, sizes, brands and part numbers. Rarer synthetic words
+    are drawn from a Zipf-like distribution so that the vocabulary grows with the amount of rows.
+    A duplicate_rate share of the descriptions are variants of earlier ones, only differing in case,
+    punctuation, spacing or word order, like the duplicates found in real stock masters.
+
+    Arguments:
+    n (int) -- Amount of descriptions to generate
+    rng (random.Random) -- Source of randomness
+    duplicate_rate (float) -- Share of descriptions that repeat an earlier one
+    vocabulary_size (int) -- Amount of rare synthetic words. Defaults to a tenth of n.
+
+    Returns:
+    A list of n strings
+    """
+    if vocabulary_size is None:
+        vocabulary_size = max(n // 10, 10)
+    rare_words = ["X" + format(i, "x").upper() + rng.choice("ABCDEFGH") for i in range(vocabulary_size)]
+    # Cumulative weights, so that random.choices does not sum the weights again on every call
+    rare_cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(vocabulary_size)))
+    descriptions = []
+    for _ in range(n):
+        if descriptions and rng.random() < duplicate_rate:
+            words = rng.choice(descriptions).replace(",", " ").split()
+            if rng.random() < 0.5:
+                rng.shuffle(words)
+            separator = rng.choice([" ", ", ", "  ", ";"])
+            description = separator.join(words)
+            descriptions.append(description.lower() if rng.random() < 0.3 else description)
+            continue
+        words = [rng.choice(NOUNS)] + rng.sample(MODIFIERS, rng.randint(0, 3))
+        if rng.random() < 0.5:
+            words.append(rng.choice(SIZES))
+        if rng.random() < 0.2:
+            words.append(rng.choice(BRANDS))
+        words.extend(rng.choices(rare_words, cum_weights=rare_cum_weights, k=rng.randint(0, 2)))
+        if rng.random() < 0.3:
+            words.append("".join(rng.choices("0123456789ABCDEF", k=rng.randint(4, 8))))
+        descriptions.append(words[0] + ", " + " ".join(words[1:]) if len(words) > 1 else words[0])
+    return descriptions
+
+def generate_stock_master(n_rows, seed=0, duplicate_rate=0.2):
+    """Generate a synthetic stock master.
+
+    Returns:
+    A list of dictionaries, each with keys "id", "text" and "Brand" like the input of commodity_matcher.add_commodities_to_stocks
+    """
+    rng = random.Random(seed)
+    rows = []
+    for i, description in enumerate(generate_descriptions(n_rows, rng, duplicate_rate)):
+        brand = next((brand for brand in BRANDS if brand in description.upper().split()), "")
+        rows.append({"id": str(i), "text": description, "Brand": brand})
+    return rows
+
+def generate_site_rows(n_rows, n_sites=5, seed=0, duplicate_rate=0.2, shared_rate=0.5):
+    """Generate a synthetic multi-site dataset.
+
+    Each stock item is stocked at one site, and a shared_rate share of them at a few more sites
+    too, under the same stock code and a possibly reformatted description.
+
+    Arguments:
+    n_rows (int) -- Amount of rows to generate
+    n_sites (int) -- Amount of sites
+    seed (int) -- Seed, so that the same arguments always generate the same rows
+    duplicate_rate (float) -- Share of descriptions that repeat an earlier one, see generate_descriptions
+    shared_rate (float) -- Share of stock items stocked at more than one site
+
+    Returns:
+    A list of dictionaries with the keys in row_to_row_matcher.INPUT_FIELDNAMES
+    """
+    rng = random.Random(seed)
+    sites = ["Site " + str(i + 1) for i in range(n_sites)]
+    descriptions = generate_descriptions(n_rows, rng, duplicate_rate)
+    rows = []
+    item = 0
+    while len(rows) < n_rows:
+        stock_code = str(100000 + item)
+        description = descriptions[item]
+        item_sites = [rng.choice(sites)]
+        if n_sites > 1 and rng.random() < shared_rate:
+            item_sites = rng.sample(sites, rng.randint(2, min(n_sites, 4)))
+        for site in item_sites[:n_rows - len(rows)]:
+            site_description = description.upper() if rng.random() < 0.5 else description
+            rows.append({"Site": site, "Stock Code": stock_code, "Stock & Site": stock_code + " " + site, "Stock Description": site_description})
+        item += 1
+    return rows
+
+def bench_most_matching_words(n_rows, n_sites, seed, duplicate_rate, queries=1000):
+    from matcher import most_matching_words, to_base_word_set, JaccardIndex
+    descriptions = [row["text"] for row in generate_stock_master(n_rows, seed, duplicate_rate)]
+    candidates = {description: {"Preprocessed": to_base_word_set(description)} for description in descriptions}
+    sample = random.Random(seed).sample(descriptions, min(queries, len(descriptions)))
+    stime = time.perf_counter()
+    index = JaccardIndex(candidates)
+    for description in sample:
+        most_matching_words(to_base_word_set(description), index, 10, set())
+    return time.perf_counter() - stime, {"Queries": len(sample), "Candidates": len(candidates)}
+
+def bench_match_by_description(n_rows, n_sites, seed, duplicate_rate):
+    import row_to_row_matcher
+    rows = [{**row, "Description": row["Stock Description"]} for row in generate_site_rows(n_rows, n_sites, seed, duplicate_rate)]
+    stime = time.perf_counter()
+    row_to_row_matcher.match_by_description(rows, [])
+    return time.perf_counter() - stime, {}
+
+def bench_match_sites(n_rows, n_sites, seed, duplicate_rate):
+    import row_to_row_matcher
+    rows = [{**row, "Description": row["Stock Description"]} for row in generate_site_rows(n_rows, n_sites, seed, duplicate_rate)]
+    stime = time.perf_counter()
+    output = list(row_to_row_matcher.match_sites(rows))
+    return time.perf_counter() - stime, {"Output Rows": len(output)}
+
+def bench_add_commodities_to_stocks(n_rows, n_sites, seed, duplicate_rate):
+    import commodity_matcher
+    stock_master = generate_stock_master(n_rows, seed, duplicate_rate)
+    stime = time.perf_counter()
+    commodity_matcher.add_commodities_to_stocks(stock_master)
+    return time.perf_counter() - stime, {}
+
+def bench_detect_brands(n_rows, n_sites, seed, duplicate_rate):
+    import brand_extract_parallel
+    df = pandas.DataFrame(generate_stock_master(n_rows, seed, duplicate_rate))
+    df["Brand"] = ""
+    stime = time.perf_counter()
+    brand_extract_parallel.detect_brands(df)
+    return time.perf_counter() - stime, {}
+
+def bench_embedding_match(n_rows, n_sites, seed, duplicate_rate, tc_to_check_count=25):
+    import commodity_matcher
+    import top_category_matcher
+    preprocessed = commodity_matcher.generate_preprocessed_stocks(generate_stock_master(n_rows, seed, duplicate_rate))
+    top_category_strings = file_utils.read_csv("top_category_strings.csv")
+    stime = time.perf_counter()
+    top_category_matcher.embedding_match(top_category_strings, [], preprocessed, tc_to_check_count)
+    return time.perf_counter() - stime, {}
+
+BENCHMARKS = {
+    "most_matching_words": bench_most_matching_words,
+    "match_by_description": bench_match_by_description,
+    "match_sites": bench_match_sites,
+    "add_commodities_to_stocks": bench_add_commodities_to_stocks,
+    "detect_brands": bench_detect_brands,
+    "embedding_match": bench_embedding_match
+}
+
+def git_commit():
+    """Return the current git commit hash, or an empty string outside a git repository."""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+def run_benchmarks(sizes, n_sites=5, stages=STAGES, seed=0, duplicate_rate=0.2):
+    """Time each stage at each size.
+
+    Stages that fail, e.g. because the data files or the spacy model they need are missing,
+    are recorded with the error instead of a time, and the rest of the stages still run.
+
+    Returns:
+    A dictionary with the run settings and a "Results" list with a dictionary for each size and stage
+    """
+    results = []
+    for n_rows in sizes:
+        for stage in stages:
+            result = {"Stage": stage, "Rows": n_rows, "Sites": n_sites}
+            print("Benchmarking " + stage + " with " + str(n_rows) + " rows...")
+            try:
+                seconds, details = BENCHMARKS[stage](n_rows, n_sites, seed, duplicate_rate)
+                result["Seconds"] = seconds
+                result.update(details)
+            except Exception as e:
+                result["Error"] = repr(e)
+            results.append(result)
+    return {"Commit": git_commit(), "Python": platform.python_version(), "Seed": seed, "Duplicate Rate": duplicate_rate, "Results": results}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Script to benchmark matching on synthetic stock masters.")
+    parser.add_argument("-s", "--sizes", help="Amounts of rows to benchmark with. Default is 1000 and 10000.", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("-n", "--sites", help="Amount of sites in the multi-site datasets. Default value is 5.", type=int, default=5)
+    parser.add_argument("-t", "--stages", help="Stages to benchmark. Default is all of them.", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("-d", "--duplicate_rate", help="Share of generated descriptions repeating an earlier one. Default value is 0.2.", type=float, default=0.2)
+    parser.add_argument("--seed", help="Seed for generating the data. Default value is 0.", type=int, default=0)
+    parser.add_argument("-o", "--output", help="Save results to this json file. Default is benchmark_results.json.", default="benchmark_results.json")
+    parser.add_argument("-g", "--generate", help="Only save a generated multi-site dataset with the first size to this csv file, for use with row_to_row_matcher.py.")
+
+    args = parser.parse_args()
+
+    if args.generate:
+        file_utils.save_csv(args.generate, generate_site_rows(args.sizes[0], args.sites, args.seed, args.duplicate_rate))
+    else:
+        results = run_benchmarks(args.sizes, args.sites, args.stages, args.seed, args.duplicate_rate)
+        file_utils.save_json(args.output, results)
+        for result in results["Results"]:
+            print(result)
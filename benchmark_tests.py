@@ -0,0 +1,32 @@
+import unittest
+import random
+
+import benchmark
+import row_to_row_matcher
+
+class GeneratorTestCase(unittest.TestCase):
+    """Tests for the synthetic data generators."""
+
+    def test_same_seed_generates_same_rows(self):
+        """Benchmarks are only comparable across commits if the data is reproducible."""
+        assert benchmark.generate_site_rows(500, 4, seed=3) == benchmark.generate_site_rows(500, 4, seed=3)
+        assert benchmark.generate_stock_master(500, seed=3) == benchmark.generate_stock_master(500, seed=3)
+        assert benchmark.generate_stock_master(500, seed=3) != benchmark.generate_stock_master(500, seed=4)
+
+    def test_site_rows_have_input_fields(self):
+        """Generated rows should have the requested size and sites and be valid row_to_row_matcher input."""
+        rows = benchmark.generate_site_rows(300, 3)
+        assert len(rows) == 300
+        assert {row["Site"] for row in rows} == {"Site 1", "Site 2", "Site 3"}
+        for row in rows:
+            assert set(row.keys()) == {"Site", "Stock Code", "Stock & Site", "Stock Description"}
+
+    def test_duplicate_rate(self):
+        """More duplicates should mean less unique token sets per row."""
+        rng = random.Random(0)
+        few = row_to_row_matcher.compression_ratio([{"Description": d} for d in benchmark.generate_descriptions(2000, rng, 0.0)])
+        many = row_to_row_matcher.compression_ratio([{"Description": d} for d in benchmark.generate_descriptions(2000, rng, 0.5)])
+        assert many > few
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,6 +5,7 @@ import os
 import sys
 import csv
 import concurrent.futures
+import multiprocessing
 import regex as re
 import pandas
 # if "LOCAL" in os.environ:
@@ -15,13 +16,16 @@ import brand_extract_parallel
 #     from . import file_utils
 #     from . import top_category_matcher
 
-from matcher import most_matching_words, best_n_results, to_base_word_set
+from matcher import most_matching_words, best_n_results, to_base_word_set, compile_abbrevs, Vocabulary, JaccardIndex
 
 csv.field_size_limit(int(sys.maxsize/100000000000))
 
 FIELDNAMES = ["Stock & Site", "Site", "Stock Code", "text", "OEM Field", "Commodity", "Commodity Code", "Jaccard", "Match Number"]
 
-def match_commodities(stock_with_top_categories, jaccard_threshold, topn, parallel=True):
+# (commodities_by_tc, brands, abbrevs, vocabulary, indexes_by_tc) of the worker processes, so that they are not pickled for every task. See match_commodities.
+_WORKER_STATE = None
+
+def match_commodities(stock_with_top_categories, jaccard_threshold, topn, parallel=True, chunk_size=100, processes=None):
     """Match commodities to stocks.
     Requires csv:s generated by generate_top_category_files to be in top_category_files/.
 
@@ -29,35 +33,75 @@ def match_commodities(stock_with_top_categories, jaccard_threshold, topn, parall
     stock_with_top_categories -- A list of dictionaries, each with keys "Description", "id", "Top Categories", and "Brands".
     jaccard_threshold (float) -- if jaccard_index is lower than threshold, re-run with all top categories.
     parallel (boolean) -- Whether to use concurrency or not. Defaults to True.
+    chunk_size (int) -- Amount of rows to send to a worker process at a time
+    processes (int) -- Amount of worker processes. Defaults to the amount of cpus.
 
     Returns:
     List of dictionaries with the same keys as stock_with_top_categories, and the keys "Commodity", "Commodity Code", and "Jaccard".
     """
+    return list(iter_match_commodities(stock_with_top_categories, jaccard_threshold, topn, parallel, chunk_size, processes))
+
+def iter_match_commodities(stock_with_top_categories, jaccard_threshold, topn, parallel=True, chunk_size=100, processes=None):
+    """Match commodities to stocks like match_commodities, yielding the rows in order as they are done.
+
+    The commodities, brands and abbreviations are set up once for each worker process, inherited when
+    forking and passed to the pool initializer otherwise, so tasks only carry their chunk of rows.
+    Only a few chunks per process are matched ahead of the one being yielded.
+    """
+    global _WORKER_STATE
     brands = get_brands()
-    abbrevs = file_utils.read_csv("desc_abbrevs.csv")
+    abbrevs = compile_abbrevs(file_utils.read_csv("desc_abbrevs.csv"))
     #Fetches all the allowed top categories.
     tcs = top_category_matcher.non_excluded_top_categories()
-    commodities = {tc: get_commodities_for_top_category(tc, abbrevs) for tc in tcs}
-    if parallel:
-        with concurrent.futures.ProcessPoolExecutor() as executor:
-            futures = []
-            for row in stock_with_top_categories:
-                futures.append(executor.submit(match_commodities_for_row, row, jaccard_threshold, commodities, brands, topn, abbrevs))
-            updated_rows = [future.result() for future in futures]
+    vocabulary = Vocabulary()
+    commodities = {tc: get_commodities_for_top_category(tc, abbrevs, vocabulary) for tc in tcs}
+    indexes = {tc: JaccardIndex(tc_commodities, vocabulary) for tc, tc_commodities in commodities.items()}
+    state = (commodities, brands, abbrevs, vocabulary, indexes)
+    if not parallel:
+        for row in stock_with_top_categories:
+            yield match_commodities_for_row(row, jaccard_threshold, commodities, brands, topn, abbrevs, vocabulary, indexes)
+        return
+    if "fork" in multiprocessing.get_all_start_methods():
+        # Forked workers inherit the state, so it is never pickled
+        _WORKER_STATE = state
+        pool_args = {"mp_context": multiprocessing.get_context("fork")}
     else:
-        updated_rows = [match_commodities_for_row(row, jaccard_threshold, commodities, brands, topn, abbrevs) for row in stock_with_top_categories]
-    return updated_rows
-
-def get_commodities_for_top_category(top_category, abbrevs=[]):
-    return get_commodities_for_top_categories([top_category], abbrevs)
-
-def get_commodities_for_top_categories(top_categories, abbrevs=[]):
+        pool_args = {"initializer": init_commodity_worker, "initargs": (state,)}
+    processes = processes or os.cpu_count() or 1
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes, **pool_args) as executor:
+            futures = []
+            for start in range(0, len(stock_with_top_categories), chunk_size):
+                futures.append(executor.submit(match_commodities_for_chunk, stock_with_top_categories[start:start+chunk_size], jaccard_threshold, topn))
+                if len(futures) > 2 * processes:
+                    yield from futures.pop(0).result()
+            for future in futures:
+                yield from future.result()
+    finally:
+        _WORKER_STATE = None
+
+def init_commodity_worker(state):
+    """Pool initializer setting the state match_commodities_for_chunk uses in a worker process."""
+    global _WORKER_STATE
+    _WORKER_STATE = state
+
+def match_commodities_for_chunk(rows, jaccard_threshold, topn):
+    """Run match_commodities_for_row for each row with the commodities, brands and abbreviations of the worker process."""
+    commodities_by_tc, brands, abbrevs, vocabulary, indexes_by_tc = _WORKER_STATE
+    return [match_commodities_for_row(row, jaccard_threshold, commodities_by_tc, brands, topn, abbrevs, vocabulary, indexes_by_tc) for row in rows]
+
+def get_commodities_for_top_category(top_category, abbrevs=[], vocabulary=None):
+    return get_commodities_for_top_categories([top_category], abbrevs, vocabulary)
+
+def get_commodities_for_top_categories(top_categories, abbrevs=[], vocabulary=None):
     """Given a list of top categories:
         (1) go through the matching files and
         (2) compose a list of all commodities contained in those files.
 
         Arguments:
         top_categories -- list of names of top categories to fetch
+        abbrevs -- a list of dictionaries with keys "Abbreviation" and "Expanded", or a matcher.Abbreviations
+        vocabulary -- If given, store "Preprocessed" as a tuple of word ids encoded with this matcher.Vocabulary
 
         Returns:
         List of commodities in the given top categories."""
@@ -67,10 +111,43 @@ def get_commodities_for_top_categories(top_categories, abbrevs=[]):
         for row in rows:
             if row["Commodity Name"] in commodities:
                 print("Duplicate commodity: " + row["Commodity Name"])
-            commodities[row["Commodity Name"]] = {"Commodity Code": row["Commodity"], "Preprocessed": to_base_word_set(row["Commodity Name"], abbrevs)}
+            preprocessed = to_base_word_set(row["Commodity Name"], abbrevs)
+            if vocabulary is not None:
+                preprocessed = vocabulary.encode(preprocessed)
+            commodities[row["Commodity Name"]] = {"Commodity Code": row["Commodity"], "Preprocessed": preprocessed}
     return commodities
 
-def match_commodities_for_row(row, jaccard_threshold, commodities_by_tc, brands=[], topn=1, abbrevs=[]):
+def most_matching_commodities(desc, tcs, commodities_by_tc, number_of_results, brands, vocabulary=None, indexes_by_tc=None, min_score=None):
+    """Match desc against the commodities of the top categories tcs, with the same results as against their commodities merged into one dictionary.
+
+    Arguments:
+    desc -- The preprocessed description to match
+    tcs -- A list of top category names
+    commodities_by_tc -- A dictionary mapping top category names to dictionaries of commodities
+    number_of_results (int) -- Amount of matches to return
+    brands -- A set of words to ignore
+    vocabulary -- The matcher.Vocabulary used to encode the commodities, if any
+    indexes_by_tc -- A dictionary mapping top category names to matcher.JaccardIndexes of their commodities, built once for all rows.
+                     The commodities are scanned if not given.
+    min_score -- If given, only return matches scoring at least this much, see matcher.most_matching_words
+
+    Returns:
+    A tuple (matches, scores), best first
+    """
+    # The best matches of each top category, in the order of the merged dictionary so that ties are ordered the same
+    merged = {}
+    for tc in tcs:
+        candidates = commodities_by_tc[tc] if indexes_by_tc is None else indexes_by_tc[tc]
+        matches, scores = most_matching_words(desc, sentences_preprocessed=candidates, number_of_results=number_of_results, words_to_exclude=brands, vocabulary=vocabulary, min_score=min_score)
+        for match, score in zip(matches, scores):
+            merged.setdefault(match, score)
+    return best_n_results(merged, n=number_of_results)
+
+def commodity_code(commodity, tcs, commodities_by_tc):
+    """Return the code of a commodity from the last of the top categories tcs having it, like in their merged dictionary."""
+    return next(commodities_by_tc[tc][commodity] for tc in reversed(tcs) if commodity in commodities_by_tc[tc])["Commodity Code"]
+
+def match_commodities_for_row(row, jaccard_threshold, commodities_by_tc, brands=[], topn=1, abbrevs=[], vocabulary=None, indexes_by_tc=None):
     """Take a row dictionary and return best-matching commodities.
 
     Arguments:
@@ -79,6 +156,9 @@ def match_commodities_for_row(row, jaccard_threshold, commodities_by_tc, brands=
     commodities_by_tc -- A dictionary mapping top category names to lists of commodities
     brands -- A list of brand names to ignore
     topn -- Amount of matches to return for each row
+    abbrevs -- a list of dictionaries with keys "Abbreviation" and "Expanded", or a matcher.Abbreviations
+    vocabulary -- The matcher.Vocabulary used to encode the commodities, if any
+    indexes_by_tc -- A dictionary mapping top category names to matcher.JaccardIndexes of their commodities, see most_matching_commodities
 
     Output:
     The input row with additional fields 'Commodity' 'Commodity_Code' and 'Jaccard' for each match.
@@ -87,21 +167,19 @@ def match_commodities_for_row(row, jaccard_threshold, commodities_by_tc, brands=
     brands = set(brands)
     print("Row " + row["id"] + ", matching commodities.")
     tc_string = row["Top Categories"].replace('"', "")
-    tcs = filter(None, tc_string.split(";"))
-    commodities = {}
-    for tc in tcs:
-        commodities.update(commodities_by_tc[tc])
-    results, scores = most_matching_words(desc, sentences_preprocessed=commodities, number_of_results=topn, words_to_exclude=brands)
+    tcs = list(filter(None, tc_string.split(";")))
+    results, scores = most_matching_commodities(desc, tcs, commodities_by_tc, topn, brands, vocabulary, indexes_by_tc)
+    searched_tcs = tcs
 
     #RE-RUN MATCHING IF LOW JACCARD SCORES
     if scores[0] < jaccard_threshold:
         #Get ALL top_category files minus the ones we checked before
         print("Low Jaccard score, checking other categories.")
-        tcs = set(commodities_by_tc.keys()) - set(tcs)
-        commodities = {}
-        for tc in tcs:
-            commodities.update(commodities_by_tc[tc])
-        more_results, more_scores = most_matching_words(desc, sentences_preprocessed=commodities, number_of_results=topn, words_to_exclude=brands)
+        other_tcs = [tc for tc in commodities_by_tc if tc not in tcs]
+        searched_tcs = tcs + other_tcs
+        #Only matches beating the ones we already have can change the results, let the search skip the rest
+        min_score = scores[-1] if len(scores) == topn else None
+        more_results, more_scores = most_matching_commodities(desc, other_tcs, commodities_by_tc, topn, brands, vocabulary, indexes_by_tc, min_score)
         #{**x, **y} merges two dictionaries
         jaccard_scores_dict_all_results = {**dict(zip(results, scores)), **dict(zip(more_results, more_scores))}
         results, scores = best_n_results(jaccard_scores_dict_all_results, n=topn)
@@ -109,7 +187,7 @@ def match_commodities_for_row(row, jaccard_threshold, commodities_by_tc, brands=
     for i, res in enumerate(results):
         postfix = f" {i+1}" if i > 0 else ""
         score = round(scores[i], 2)
-        code = commodities[res]["Commodity Code"]
+        code = commodity_code(res, searched_tcs, commodities_by_tc)
         # Ex. if i == 1, keys == ("Commodity 2", "Commodity Code 2", "Jaccard 2")
         keys = (key+postfix for key in ["Commodity", "Commodity Code", "Jaccard"])
         new_results = dict(zip(keys, (res, code, score)))
@@ -303,7 +381,7 @@ def remove_temp_files():
     for f in tmp_files:
         os.remove(f)
 
-def add_commodities_to_stocks(stock_master, level="Family Name", tc_to_check_count=25, jaccard_threshold=0.3, topn=1, parallel=True, skip_preprocessing=False):
+def add_commodities_to_stocks(stock_master, level="Family Name", tc_to_check_count=25, jaccard_threshold=0.3, topn=1, parallel=True, skip_preprocessing=False, chunk_size=100):
     """stock_master is a list of dicts that must contain keys id, text and Brand. Brand may be an empty string."""
     generate_constant_csvs(level)
     preprocessed = generate_preprocessed_stocks(stock_master)
@@ -313,7 +391,7 @@ def add_commodities_to_stocks(stock_master, level="Family Name", tc_to_check_cou
     top_category_strings = file_utils.read_csv("top_category_strings.csv")
     stock_with_top_categories = top_category_matcher.match_preprocessed_to_top_categories(preprocessed, top_category_strings, brand_counts, tc_to_check_count = tc_to_check_count)
     print("Matching commodities")
-    stock_with_commodities = match_commodities(stock_with_top_categories, jaccard_threshold=jaccard_threshold, topn=topn, parallel=parallel)
+    stock_with_commodities = match_commodities(stock_with_top_categories, jaccard_threshold=jaccard_threshold, topn=topn, parallel=parallel, chunk_size=chunk_size)
     rows = map_preprocessed_to_original(stock_master, stock_with_commodities)
     if skip_preprocessing:
         rows = stock_with_commodities
@@ -364,6 +442,7 @@ if __name__ == "__main__":
     parser.add_argument("-j", "--jaccard", help="Sets the Jaccard threshold. If the Jaccard score of the best match is below the threshold, reruns the search for all top categories to find the best possible match. Default value is 0.3.", type=float, default=0.3)
     parser.add_argument("-m", "--matches", help="How many matches to return for each row. Default is 1.", type=int, default=1)
     parser.add_argument("-np", "--no_parallel", help="Flag that determines whether to use parallel processing to speed up search.", action="store_true")
+    parser.add_argument("-c", "--chunk_size", help="Amount of rows to send to a worker process at a time when using parallel processing. Default value is 100.", type=int, default=100)
     parser.add_argument("-a", "--add_ids", help="Flag that determines whether to add an id column to the data read from the input csv.", action="store_true")
     parser.add_argument("-s", "--skip_preprocessing", help="If set, skip preprocessing steps. This will slow down the processing.", action="store_true")
 
@@ -385,7 +464,7 @@ if __name__ == "__main__":
         df = add_commodities_to_dataframe(stock_master)
         print(df)
     else:
-        rows = add_commodities_to_stocks(stock_master, level+" Name", top_categories_to_check_count, jac, topn, parallel, skip_preprocessing)
+        rows = add_commodities_to_stocks(stock_master, level+" Name", top_categories_to_check_count, jac, topn, parallel, skip_preprocessing, args.chunk_size)
         try:
             file_utils.save_csv(output, rows, fieldnames=FIELDNAMES)
         except ValueError:
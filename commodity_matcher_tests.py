@@ -2,7 +2,9 @@
 
 import unittest
 import copy
-from commodity_matcher import match_commodities, add_commodities_to_stocks, map_preprocessed_to_original, order_fieldnames, unpivot_stocks
+import random
+from commodity_matcher import match_commodities, match_commodities_for_row, add_commodities_to_stocks, map_preprocessed_to_original, order_fieldnames, unpivot_stocks
+from matcher import JaccardIndex, Vocabulary, best_n_results, most_matching_words, to_base_word_set
 
 class AddCommoditiesToStocksTestCase(unittest.TestCase):
     """Test cases for add_commodities_to_stocks."""
@@ -50,6 +52,56 @@ class MatchCommoditiesTestCase(unittest.TestCase):
             output = match_commodities(stock, jaccard_threshold=0.3, parallel=parallel, topn=2)
             assert all([key in output[0] for key in ("Commodity", "Commodity Code", "Jaccard", "Commodity 2", "Commodity Code 2", "Jaccard 2")])
 
+    def test_same_output_in_chunks(self):
+        """Parallel matching in chunks should return the same rows in the same order as serial matching."""
+        descriptions = ["circuit", "resistor", "capacitor", "fuse", "relay"]
+        stock = [{"Description": description, "id": str(i), "Top Categories": "Electronic Components and Supplies", "Brands": ""} for i, description in enumerate(descriptions)]
+        serial = match_commodities(copy.deepcopy(stock), jaccard_threshold=0.3, topn=2, parallel=False)
+        for chunk_size in (1, 2, 10):
+            assert match_commodities(copy.deepcopy(stock), jaccard_threshold=0.3, topn=2, parallel=True, chunk_size=chunk_size, processes=2) == serial
+
+class MatchCommoditiesForRowTestCase(unittest.TestCase):
+    """Test cases for match_commodities_for_row."""
+
+    words = ["circuit", "resistor", "capacitor", "fuse", "relay", "switch", "cable", "plug", "socket", "lamp"]
+
+    def commodities_by_tc(self, vocabulary):
+        commodities_by_tc = {}
+        for tc in ("A", "B", "C", "D"):
+            commodities_by_tc[tc] = {}
+            for i in range(50):
+                name = " ".join(random.sample(self.words, random.randint(1, 3))) + " " + tc + str(i)
+                commodities_by_tc[tc][name] = {"Commodity Code": tc + str(i), "Preprocessed": vocabulary.encode(to_base_word_set(name))}
+        return commodities_by_tc
+
+    def scan(self, desc, tcs, commodities_by_tc, topn, vocabulary):
+        commodities = {}
+        for tc in tcs:
+            commodities.update(commodities_by_tc[tc])
+        return most_matching_words(desc, commodities, topn, set(), vocabulary)
+
+    def test_same_results_as_scanning_merged_commodities(self):
+        """Matching against the indexes of the top categories, and re-running against the other ones with a score floor,
+        should give the same results as scanning the merged commodities of the categories."""
+        vocabulary = Vocabulary()
+        commodities_by_tc = self.commodities_by_tc(vocabulary)
+        indexes_by_tc = {tc: JaccardIndex(commodities, vocabulary) for tc, commodities in commodities_by_tc.items()}
+        for _ in range(50):
+            description = " ".join(random.sample(self.words, random.randint(1, 4)))
+            desc = to_base_word_set(description)
+            for jaccard_threshold in (0.0, 1.0):
+                for topn in (1, 3):
+                    row = {"Description": description, "id": "1", "Top Categories": "A;C"}
+                    matches, scores = self.scan(desc, ["A", "C"], commodities_by_tc, topn, vocabulary)
+                    if scores[0] < jaccard_threshold:
+                        more_matches, more_scores = self.scan(desc, ["B", "D"], commodities_by_tc, topn, vocabulary)
+                        matches, scores = best_n_results({**dict(zip(matches, scores)), **dict(zip(more_matches, more_scores))}, topn)
+                    output = match_commodities_for_row(dict(row), jaccard_threshold, commodities_by_tc, [], topn, [], vocabulary, indexes_by_tc)
+                    for i, (match, score) in enumerate(zip(matches, scores)):
+                        postfix = f" {i+1}" if i > 0 else ""
+                        assert (output["Commodity" + postfix], output["Jaccard" + postfix]) == (match, round(score, 2))
+                        assert output["Commodity Code" + postfix] == match.split()[-1]
+
 class MapPreprocessedToOriginalTestCase(unittest.TestCase):
     """Test cases for map_preprocessed_to_original."""
 
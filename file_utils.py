@@ -1,6 +1,8 @@
 import os
 import csv
+import heapq
 import json
+import tempfile
 
 data_path = ""
 
@@ -47,6 +49,97 @@ def save_csv(filename, rows, mode = "w", fieldnames = []):
         for r in rows:
             w.writerow(r)
 
+def external_sort(items, key, chunk_size=100000):
+    """Sort items by key, without holding more than chunk_size items in memory.
+
+    Sorted chunks of items are written to temporary json lines files, which are then merged.
+    Items with equal keys keep their order, like with sorted.
+
+    Arguments:
+    items -- An iterable of json serializable items
+    key -- A function returning the value to sort an item by
+    chunk_size (int) -- Maximum amount of items to sort in memory at a time
+
+    Yields:
+    The items in sorted order
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        chunk_files = []
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= chunk_size:
+                chunk_files.append(os.path.join(tmpdir, str(len(chunk_files)) + ".jsonl"))
+                save_jsonl(chunk_files[-1], sorted(chunk, key=key), add_data_path=False)
+                chunk = []
+        if not chunk_files:
+            yield from sorted(chunk, key=key)
+            return
+        if chunk:
+            chunk_files.append(os.path.join(tmpdir, str(len(chunk_files)) + ".jsonl"))
+            save_jsonl(chunk_files[-1], sorted(chunk, key=key), add_data_path=False)
+        files = [open(chunk_filename, encoding="utf-8") for chunk_filename in chunk_files]
+        try:
+            yield from heapq.merge(*[(json.loads(line) for line in f) for f in files], key=key)
+        finally:
+            for f in files:
+                f.close()
+
+def save_sorted_csv(filename, rows, key, fieldnames, chunk_size=100000):
+    """Save rows to a csv file sorted by key, without holding more than chunk_size rows in memory.
+
+    Arguments:
+    filename (string) -- Filename of the csv file to save
+    rows -- An iterable of dictionaries with values that are strings
+    key -- A function returning the value to sort a row dictionary by
+    fieldnames -- A list of the columns to save
+    chunk_size (int) -- Maximum amount of rows to sort in memory at a time, see external_sort
+
+    Returns:
+    The amount of rows saved
+    """
+    filename = add_path(filename)
+    count = 0
+    with open(filename, "w", encoding="utf-8-sig", newline="") as fo:
+        w = csv.DictWriter(fo, fieldnames=fieldnames, extrasaction="ignore")
+        w.writeheader()
+        for row in external_sort(rows, key, chunk_size):
+            w.writerow(row)
+            count += 1
+    return count
+
+def save_jsonl(filename, items, add_data_path=True):
+    """Save items to a json lines file, one json document per line.
+
+    Arguments:
+    filename (string) -- Filename of the json lines file to save
+    items -- An iterable of json serializable items
+    add_data_path (bool) -- If false, filename is used as it is
+
+    Returns:
+    The amount of items saved
+    """
+    if add_data_path:
+        filename = add_path(filename)
+    count = 0
+    with open(filename, "w", encoding="utf-8") as fo:
+        for item in items:
+            fo.write(json.dumps(item, ensure_ascii=False, separators=(",", ":")) + "\n")
+            count += 1
+    return count
+
+def read_jsonl(filename):
+    """Read a json lines file into a list of items.
+
+    Arguments:
+    filename (string) -- Filename of the json lines file to read
+
+    Returns:
+    A list with an item for each non-empty line.
+    """
+    filename = add_path(filename)
+    with open(filename, encoding="utf-8-sig") as f:
+        return [json.loads(line) for line in f if line.strip()]
 
 def read_csv(filename, add_ids=False):
     """Read a csv file into a list of row dictionaries.
@@ -0,0 +1,28 @@
+import unittest
+import os
+import random
+import tempfile
+
+import file_utils
+
+class SaveSortedCsvTestCase(unittest.TestCase):
+    """Tests for save_sorted_csv."""
+
+    def test_same_as_sorting_in_memory(self):
+        """Merging sorted chunks should give the rows in the same order as sorted, ties included."""
+        rows = [{"Key": str(random.randint(0, 20)), "Value": str(i)} for i in range(250)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for chunk_size in (7, 100, 1000):
+                filename = os.path.join(tmpdir, "sorted.csv")
+                count = file_utils.save_sorted_csv(filename, iter(rows), key=lambda row: row["Key"], fieldnames=["Key", "Value"], chunk_size=chunk_size)
+                assert count == len(rows)
+                assert file_utils.read_csv(filename) == sorted(rows, key=lambda row: row["Key"])
+
+    def test_empty_rows_save_header(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "sorted.csv")
+            assert file_utils.save_sorted_csv(filename, [], key=lambda row: row["Key"], fieldnames=["Key", "Value"]) == 0
+            assert file_utils.read_csv(filename) == []
+
+if __name__ == "__main__":
+    unittest.main()
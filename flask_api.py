@@ -6,6 +6,7 @@ from rq.exceptions import NoSuchJobError
 from rq.job import Job
 from redis import Redis
 import urllib.parse as urlparse
+import hashlib
 import json
 
 app = Flask(__name__)
@@ -14,6 +15,15 @@ urlparse.uses_netloc.append('redis')
 url = urlparse.urlparse(redis_url)
 conn = Redis(host=url.hostname, port=url.port, db=0, password=url.password)
 q = Queue(connection=conn)  #no args implies the default queue
+# Row to row matching takes much longer, so it runs on the low priority queue to not hold up the commodity matching jobs
+row_to_row_q = Queue("low", connection=conn)
+# Seconds a row to row job may run, and how long its results are kept after it finishes
+ROW_TO_ROW_TIMEOUT = 4*3600
+ROW_TO_ROW_RESULT_TTL = 24*3600
+ROW_TO_ROW_FIELDS = ["Site", "Stock & Site", "Stock Description"]
+# The output fields of row_to_row_matcher, which old rows come from
+ROW_TO_ROW_OLD_FIELDS = ["Site", "Match Site", "Stock & Site", "Description", "Old Row", "Match Description", "Match Stock & Site", "Match Score", "Match Number", "Matching Row Count"]
+ROW_TO_ROW_JOB_PREFIX = "row_to_row_"
 
 @app.route("/api", methods = ["GET", "POST"])
 def api():
@@ -56,3 +66,86 @@ def api():
             msg = "Processing. Ask again in a few minutes to see your results."
             return {"Results": [], "Errors": [], "Status": j.get_status(), "Message": msg}
 
+
+@app.route("/row_to_row", methods = ["GET", "POST"])
+def row_to_row():
+    """Match uploaded rows to rows of other sites on the rq workers.
+
+    POST a json object with "rows", a list of objects with the fields "Site", "Stock & Site" and "Stock Description",
+    and optionally "old_rows" with the rows of a previous output to combine the new matches with, "matches", the maximum
+    amount of matches for each row and site, and "page_size", the amount of output rows in each page of the results.
+    The response has the "Job" id to GET the results with, as /row_to_row?job=<id>&page=<page>, pages starting from 0.
+    Uploading the same rows again returns the same job.
+    """
+    if request.method == "GET":
+        job_id = request.args.get("job", default="")
+        page = request.args.get("page", default=0, type=int)
+        try:
+            # Other jobs, such as the ones of /api, have other results
+            if not job_id.startswith(ROW_TO_ROW_JOB_PREFIX):
+                raise NoSuchJobError(job_id)
+            j = Job.fetch(job_id, conn)
+        except NoSuchJobError:
+            msg = "No such job. It may have expired, upload the rows again."
+            return {"Job": job_id, "Results": [], "Errors": [msg], "Status": "missing", "Message": msg}, 404
+        return row_to_row_status(j, page)
+    data = request.json
+    if not isinstance(data, dict) or "rows" not in data:
+        return row_to_row_rejected("Upload a json object with the rows to match in \"rows\".")
+    rows = data["rows"]
+    old_rows = data.get("old_rows", [])
+    for name, checked_rows, fields in (("rows", rows, ROW_TO_ROW_FIELDS), ("old_rows", old_rows, ROW_TO_ROW_OLD_FIELDS)):
+        if not isinstance(checked_rows, list) or not all(isinstance(row, dict) for row in checked_rows):
+            return row_to_row_rejected("\"" + name + "\" should be a list of objects.")
+        missing = [field for field in fields if any(field not in row for row in checked_rows)]
+        if missing:
+            return row_to_row_rejected("Every row of \"" + name + "\" needs the fields " + ", ".join(fields) + ". Missing: " + ", ".join(missing))
+    try:
+        top_n = int(data.get("matches", 5))
+        page_size = int(data.get("page_size", 1000))
+    except (TypeError, ValueError):
+        top_n = page_size = 0
+    if top_n < 1 or page_size < 1:
+        return row_to_row_rejected("\"matches\" and \"page_size\" should be positive integers.")
+    job_id = ROW_TO_ROW_JOB_PREFIX + hashlib.sha1(json.dumps([rows, old_rows, top_n, page_size], sort_keys=True).encode("utf-8")).hexdigest()
+    try:
+        j = Job.fetch(job_id, conn)
+        if j.get_status() == "failed":
+            # Uploading the same rows again retries a failed job instead of returning it until it expires
+            j.delete()
+            raise NoSuchJobError(job_id)
+    except NoSuchJobError:
+        # Enqueued by name, so that the web process does not import the matching code
+        j = row_to_row_q.enqueue("row_to_row_matcher.match_sites_to_redis", rows, old_rows, row_to_row_pages_key(job_id), top_n=top_n, page_size=page_size, ttl=ROW_TO_ROW_RESULT_TTL,
+                                 job_id=job_id, job_timeout=ROW_TO_ROW_TIMEOUT, result_ttl=ROW_TO_ROW_RESULT_TTL)
+    return row_to_row_status(j)
+
+def row_to_row_rejected(msg):
+    """Return the response for an upload that can not be matched."""
+    return {"Results": [], "Errors": [msg], "Status": "rejected", "Message": msg}, 400
+
+def row_to_row_pages_key(job_id):
+    return "row_to_row_pages:" + job_id
+
+def row_to_row_status(j, page=0):
+    """Return the response for a row to row job, with the rows of the given page of the results if it has finished."""
+    status = j.get_status()
+    response = {"Job": j.id, "Results": [], "Errors": [], "Status": status}
+    if status == "finished":
+        response.update(j.result)
+        response["Page"] = page
+        results = conn.lindex(row_to_row_pages_key(j.id), page) if 0 <= page < j.result["Pages"] else None
+        if results is not None:
+            response["Results"] = json.loads(results)
+        elif j.result["Pages"]:
+            msg = "No page " + str(page) + ", pages go from 0 to " + str(j.result["Pages"] - 1) + "."
+            response["Errors"].append(msg)
+            response["Message"] = msg
+            return response, 404
+        response["Message"] = "Success!"
+    elif status == "failed":
+        response["Errors"].append("Row to row matching failed.")
+        response["Message"] = "Something went wrong. Time limit may have been exceeded, try a smaller job."
+    else:
+        response["Message"] = "Processing. Ask again in a few minutes to see your results."
+    return response
@@ -0,0 +1,68 @@
+import unittest
+import os
+
+class RowToRowTestCase(unittest.TestCase):
+    """Tests for the /row_to_row endpoint, running its jobs on a synchronous rq queue backed by fakeredis."""
+
+    rows = [{"Site": site, "Stock Code": str(i), "Stock & Site": str(i) + " " + site, "Stock Description": description}
+            for i, (site, description) in enumerate([("A", "hex bolt m10"), ("B", "bolt hex m10"), ("C", "nut m12"), ("A", "nut m12 steel"), ("B", "washer")])]
+
+    def setUp(self):
+        os.environ.setdefault("REDISTOGO_URL", "redis://localhost:6379")
+        try:
+            import fakeredis
+            from rq import Queue
+            import flask_api
+        except ImportError:
+            self.skipTest("flask, rq, fakeredis and the commodity matcher dependencies are needed to run the api locally")
+        self.flask_api = flask_api
+        self.saved = (flask_api.conn, flask_api.row_to_row_q)
+        flask_api.conn = fakeredis.FakeRedis()
+        flask_api.row_to_row_q = Queue("low", is_async=False, connection=flask_api.conn)
+        self.client = flask_api.app.test_client()
+
+    def tearDown(self):
+        self.flask_api.conn, self.flask_api.row_to_row_q = self.saved
+
+    def test_upload_and_read_pages(self):
+        """Uploaded rows should be matched, and every page of the output served until the last one."""
+        response = self.client.post("/row_to_row", json={"rows": self.rows, "page_size": 3})
+        assert response.status_code == 200
+        job, pages, count = response.json["Job"], response.json["Pages"], response.json["Rows"]
+        assert response.json["Status"] == "finished"
+        results = []
+        for page in range(pages):
+            response = self.client.get("/row_to_row?job=" + job + "&page=" + str(page))
+            assert response.status_code == 200
+            assert len(response.json["Results"]) <= 3
+            results.extend(response.json["Results"])
+        assert len(results) == count
+        assert self.client.get("/row_to_row?job=" + job + "&page=" + str(pages)).status_code == 404
+        assert self.client.post("/row_to_row", json={"rows": self.rows, "page_size": 3}).json["Job"] == job
+        # The output can be uploaded again as old rows
+        response = self.client.post("/row_to_row", json={"rows": self.rows[:1], "old_rows": results})
+        assert (response.status_code, response.json["Status"]) == (200, "finished")
+
+    def test_unknown_jobs_missing(self):
+        """Jobs that do not exist or are not row to row jobs should not be served."""
+        assert self.client.get("/row_to_row?job=nope").status_code == 404
+        assert self.client.get("/row_to_row?job=row_to_row_nope").status_code == 404
+
+    def test_invalid_uploads_rejected(self):
+        """Uploads that can not be matched should be rejected before a job is enqueued."""
+        invalid = [{"row": self.rows},
+                   {"rows": {"Site": "A"}},
+                   {"rows": [{"Site": "A"}]},
+                   {"rows": self.rows, "old_rows": [{"Site": "A"}]},
+                   {"rows": self.rows, "matches": "many"},
+                   {"rows": self.rows, "matches": 0},
+                   {"rows": self.rows, "page_size": -1},
+                   {"rows": self.rows, "page_size": None}]
+        for data in invalid:
+            response = self.client.post("/row_to_row", json=data)
+            assert (response.status_code, response.json["Status"]) == (400, "rejected")
+            assert response.json["Errors"] == [response.json["Message"]]
+        assert self.flask_api.conn.keys("rq:job:*") == []
+
+if __name__ == "__main__":
+    unittest.main()
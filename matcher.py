@@ -1,66 +1,827 @@
 """Common functions for commodity and row-to-row matching."""
 
+import bisect
+import functools
+import hashlib
+import heapq
+import json
+import math
+from collections import OrderedDict
+
+import numpy
 import regex as re
+from scipy import sparse
 
 def preprocess(string, abbrevs = []):
     '''
     Preprocess a string. Removes commas and semicolons, removes extra spaces,
-    and expands abbreviations.
+    and expands abbreviations. Results are cached in TOKENIZATION_CACHE.
     INPUTS:
     - string to preprocess
-    - abbreviations to replace. List of dicts with Abbreviation and Expanded keys.
+    - abbreviations to replace. List of dicts with Abbreviation and Expanded keys, or an Abbreviations instance.
     OUTPUTS:
-    - set of preprocessed words
+    - frozenset of preprocessed words
     '''
-    #Lowercase, replace , and ; with spaces to prevent merging words
-    string = string.lower().replace(",", " ").replace(";", " ")
-    #Remove extra spaces we may have added
-    string = " ".join(string.split())
-    #Expand any abbreviations we may have
-    for abbrev in abbrevs:
-        string = string.replace(abbrev["Abbreviation"].lower(), abbrev["Expanded"].lower())
-    return set(string.split(" "))
+    abbrevs = compile_abbrevs(abbrevs)
+    key = ("preprocess", string, abbrevs.version)
+    words = TOKENIZATION_CACHE.get(key)
+    if words is None:
+        #Lowercase, replace , and ; with spaces to prevent merging words
+        string = string.lower().replace(",", " ").replace(";", " ")
+        #Remove extra spaces we may have added
+        string = " ".join(string.split())
+        #Expand any abbreviations we may have
+        string = abbrevs.expand(string)
+        words = frozenset(string.split(" "))
+        TOKENIZATION_CACHE.put(key, words)
+    return words
 
 def to_base_word_set(word_string, abbrevs = []):
-    word_string = word_string.lower()
-    # Note that this may expand "abbreviations" which are part of another word. TODO: test and fix this.
-    for abbrev in abbrevs:
-        word_string = word_string.replace(abbrev["Abbreviation"].lower(), abbrev["Expanded"].lower())
-    words = re.findall(r"[\w]+", word_string)
-    base_words = [re.sub('\er$', '', re.sub('\ing$', '', w.lower().rstrip("s"))) for w in words]
-    return set(base_words)
-
-def most_matching_words(words_to_match, sentences_preprocessed, number_of_results, words_to_exclude):
+    """Return the frozenset of base words in word_string, after expanding abbreviations. Results are cached in TOKENIZATION_CACHE."""
+    abbrevs = compile_abbrevs(abbrevs)
+    key = ("to_base_word_set", word_string, abbrevs.version)
+    base_words = TOKENIZATION_CACHE.get(key)
+    if base_words is None:
+        word_string = abbrevs.expand(word_string.lower())
+        base_words = frozenset(base_word(w) for w in re.findall(r"[\w]+", word_string))
+        TOKENIZATION_CACHE.put(key, base_words)
+    return base_words
+
+def base_word(word):
+    """Strip plural s, -ing and -er from a lowercase word. Each distinct word is only stemmed once, see STEM_CACHE."""
+    base = STEM_CACHE.get(word)
+    if base is None:
+        base = word.rstrip("s")
+        if base.endswith("ing"):
+            base = base[:-3]
+        if base.endswith("er"):
+            base = base[:-2]
+        STEM_CACHE.put(word, base)
+    return base
+
+class LRUCache:
+    """Bounded least recently used cache that counts its hits and misses.
+
+    None is used to signal a miss, so it cannot be stored as a value.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Return the value stored for key, or None if it is not in the cache."""
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Store value for key, evicting the least recently used entries if the cache is full."""
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        self._evict()
+
+    def resize(self, maxsize):
+        """Change the maximum size, evicting the least recently used entries that no longer fit."""
+        self.maxsize = maxsize
+        self._evict()
+
+    def _evict(self):
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """Return a dictionary with keys "Hits", "Misses", "Size" and "Max Size"."""
+        return {"Hits": self.hits, "Misses": self.misses, "Size": len(self.entries), "Max Size": self.maxsize}
+
+# Preprocessed descriptions keyed by (function name, raw string, abbreviation table version).
+# Sized to hold a full stock master, set maxsize to tune.
+TOKENIZATION_CACHE = LRUCache(maxsize=2**18)
+# Base words keyed by the lowercase word
+STEM_CACHE = LRUCache(maxsize=2**16)
+
+def cache_stats():
+    """Return the stats of TOKENIZATION_CACHE and STEM_CACHE, keyed by cache name."""
+    return {"Tokenization": TOKENIZATION_CACHE.stats(), "Stemming": STEM_CACHE.stats()}
+
+class Abbreviations:
+    """Abbreviation table compiled into a single regular expression.
+
+    All abbreviations are expanded in one scan of the string, and never inside a word: "ss" ->
+    "stainless steel" leaves "brass" alone. Only the ends of an abbreviation that are word characters
+    need a word boundary, so "w/" -> "with" still expands in "w/handle". Compile the table once with
+    compile_abbrevs and pass the result to preprocess and to_base_word_set.
+    """
+
+    def __init__(self, abbrevs):
+        """Arguments:
+        abbrevs -- a list of dictionaries with keys "Abbreviation" and "Expanded"
+        """
+        self.expansions = {}
+        for abbrev in abbrevs:
+            abbreviation = abbrev["Abbreviation"].lower()
+            # Like the replace loop this replaces, the first entry for an abbreviation wins
+            if abbreviation and abbreviation not in self.expansions:
+                self.expansions[abbreviation] = abbrev["Expanded"].lower()
+        self.pattern = None
+        if self.expansions:
+            # Longest first, so that the longest abbreviation starting at a position is used
+            alternatives = sorted(self.expansions, key=len, reverse=True)
+            self.pattern = re.compile("|".join(self._alternative(a) for a in alternatives))
+        # Identifies the table contents, e.g. for cache keys
+        self.version = hashlib.sha1(json.dumps(sorted(self.expansions.items())).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _alternative(abbreviation):
+        """Return the pattern of an abbreviation, not matching where it starts or ends inside a word."""
+        pattern = re.escape(abbreviation)
+        if re.match(r"\w", abbreviation[0]):
+            pattern = r"(?<!\w)" + pattern
+        if re.match(r"\w", abbreviation[-1]):
+            pattern = pattern + r"(?!\w)"
+        return pattern
+
+    def expand(self, string):
+        """Return string with every abbreviation replaced by its expansion."""
+        if self.pattern is None:
+            return string
+        return self.pattern.sub(lambda match: self.expansions[match.group()], string)
+
+def compile_abbrevs(abbrevs):
+    """Return abbrevs as an Abbreviations instance.
+
+    Arguments:
+    abbrevs -- a list of dictionaries with keys "Abbreviation" and "Expanded", or an Abbreviations instance
+
+    Returns:
+    An Abbreviations instance. Compiled tables are cached, so passing the same list again is cheap,
+    but callers preprocessing many strings should compile once and pass the result.
+    """
+    if isinstance(abbrevs, Abbreviations):
+        return abbrevs
+    return _compile_abbrevs(tuple((abbrev["Abbreviation"], abbrev["Expanded"]) for abbrev in abbrevs))
+
+@functools.lru_cache(maxsize=8)
+def _compile_abbrevs(pairs):
+    return Abbreviations({"Abbreviation": abbreviation, "Expanded": expanded} for abbreviation, expanded in pairs)
+
+class TopK:
+    """Streaming accumulator keeping the k best scored keys seen so far in a bounded heap.
+
+    Results are ordered by score, best first, with ties in the order the keys were pushed
+    (or by the explicit order given to push). This is the same as sorting everything pushed
+    and keeping the first k, without holding everything in memory.
+
+    A key pushed again is merged with the kept entry: the better score wins, and the
+    "Stock & Site" row sets of both are unioned. Row sets of dropped keys are remembered,
+    so that a dropped key coming back with a better score still gets all of its rows.
+    """
+
+    def __init__(self, k):
+        self.k = k
+        # Min-heap of (score, -order, key), the worst kept entry on top. Entries whose score
+        # improved leave stale tuples behind, which are skipped when popping.
+        self.heap = []
+        # key -> [float score, score as pushed, order, rows]
+        self.entries = {}
+        self.dropped_rows = {}
+        self.pushed = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def push(self, key, score, rows=None, order=None):
+        """Add a scored key.
+
+        Arguments:
+        key -- The key to rank, e.g. a matching description
+        score -- The score of the key, a number or a string representing one
+        rows -- Optional set of rows ("Stock & Site" values) matching the key
+        order -- Optional tie breaker, lower comes first. Defaults to the order of pushes.
+        """
+        self.pushed += 1
+        if order is None:
+            order = self.pushed
+        value = float(score)
+        if key in self.entries:
+            entry = self.entries[key]
+            if rows is not None:
+                entry[3] = rows if entry[3] is None else entry[3] | rows
+            if value > entry[0]:
+                entry[0], entry[1], entry[2] = value, score, order
+                heapq.heappush(self.heap, (value, -order, key))
+            return
+        if key in self.dropped_rows:
+            dropped = self.dropped_rows.pop(key)
+            rows = dropped if rows is None else dropped | rows
+        if len(self.entries) >= self.k:
+            worst = self._worst()
+            if worst is None or (value, -order) < worst[:2]:
+                self._drop(key, rows)
+                return
+            heapq.heappop(self.heap)
+            self._drop(worst[2], self.entries.pop(worst[2])[3])
+        self.entries[key] = [value, score, order, rows]
+        heapq.heappush(self.heap, (value, -order, key))
+
+    def merge(self, other):
+        """Push everything kept or dropped by another TopK into this one."""
+        for key, score, rows in other.results():
+            self.push(key, score, rows)
+        for key, rows in other.dropped_rows.items():
+            if key in self.entries:
+                self.entries[key][3] = rows if self.entries[key][3] is None else self.entries[key][3] | rows
+            else:
+                self._drop(key, rows)
+
+    def kth_score(self):
+        """Return the score an entry must beat to get in once k entries are kept, or None while there is room."""
+        if len(self.entries) < self.k:
+            return None
+        worst = self._worst()
+        return worst[0] if worst is not None else None
+
+    def results(self):
+        """Return the kept entries as (key, score, rows) tuples, best first."""
+        ranked = sorted(self.entries.items(), key=lambda item: (-item[1][0], item[1][2]))
+        return [(key, entry[1], entry[3]) for key, entry in ranked]
+
+    def _worst(self):
+        while self.heap:
+            value, negative_order, key = self.heap[0]
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == value and entry[2] == -negative_order:
+                return self.heap[0]
+            heapq.heappop(self.heap)
+        return None
+
+    def _drop(self, key, rows):
+        if rows is not None:
+            self.dropped_rows[key] = rows if key not in self.dropped_rows else self.dropped_rows[key] | rows
+
+class Vocabulary:
+    """Intern words as small integer ids.
+
+    Preprocessed descriptions are stored as sorted tuples of word ids instead of sets of
+    strings: a tuple of shared ints is several times smaller than a set of strings, and
+    ids are what JaccardIndex keys its postings by, so words are hashed once per description.
+    """
+
+    def __init__(self):
+        self.word_ids = {}
+
+    def __len__(self):
+        return len(self.word_ids)
+
+    def encode(self, words):
+        """Return words as a sorted tuple of word ids, adding unseen words to the vocabulary.
+        Already encoded tuples are returned unchanged."""
+        if isinstance(words, tuple):
+            return words
+        ids = []
+        for word in words:
+            if word not in self.word_ids:
+                self.word_ids[word] = len(self.word_ids)
+            ids.append(self.word_ids[word])
+        return tuple(sorted(ids))
+
+    def known_ids(self, words):
+        """Return the ids of the words already in the vocabulary. Unknown words cannot match anything."""
+        return [self.word_ids[word] for word in words if word in self.word_ids]
+
+class JaccardIndex:
+    """Inverted index for top-k Jaccard searches over a fixed set of candidates.
+
+    Build it once per candidate dictionary and query it as many times as needed.
+    Only candidates sharing at least one word with the query are visited, everything
+    else scores 0.0. Results are identical to scanning every candidate, including the
+    order of tied scores (candidates keep their dictionary order).
+
+    Candidates with the same word set are indexed and scored once, and their results are
+    fanned back out to every one of them, so duplicate descriptions cost next to nothing.
+    """
+
+    def __init__(self, sentences_preprocessed, vocabulary=None):
+        """Arguments:
+        sentences_preprocessed -- A {string: {"Preprocessed": set of words or tuple of word ids, ...}} dictionary
+        vocabulary -- The Vocabulary the word id tuples were encoded with. A private one is used if not given.
+        """
+        self.vocabulary = vocabulary if vocabulary is not None else Vocabulary()
+        self.candidates = []
+        # Everything below is per unique word set. members lists the candidates of each set in dictionary order.
+        self.members = []
+        self.candidate_ids = []
+        self.sizes = []
+        self.postings = {}
+        self.postings_by_size = None
+        self.matrix = None
+        self.set_positions = {}
+        for candidate, data in sentences_preprocessed.items():
+            word_ids = self.vocabulary.encode(data["Preprocessed"])
+            self.candidates.append(candidate)
+            if word_ids in self.set_positions:
+                self.members[self.set_positions[word_ids]].append(len(self.candidates) - 1)
+                continue
+            position = len(self.members)
+            self.set_positions[word_ids] = position
+            self.members.append([len(self.candidates) - 1])
+            self.candidate_ids.append(word_ids)
+            self.sizes.append(len(word_ids))
+            for word_id in word_ids:
+                if word_id not in self.postings:
+                    self.postings[word_id] = []
+                self.postings[word_id].append(position)
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def most_matching_words(self, words_to_match, number_of_results, words_to_exclude=frozenset(), min_score=None):
+        """Return the best number_of_results candidates and their scores, best first.
+
+        If min_score is given, only candidates scoring at least min_score are returned, and there may be
+        fewer than number_of_results of them. This lets the search skip most candidates, see _most_matching_words_above.
+        """
+        if min_score is not None and min_score > 0:
+            return self._most_matching_words_above(words_to_match, number_of_results, words_to_exclude, min_score)
+        words = set(words_to_match) - words_to_exclude
+        query_size = len(words)
+        intersections = {}
+        for word_id in self.vocabulary.known_ids(words):
+            for position in self.postings.get(word_id, ()):
+                intersections[position] = intersections.get(position, 0) + 1
+        top = TopK(number_of_results)
+        for position, count in intersections.items():
+            top.push(position, count / (self.sizes[position] + query_size - count), order=position)
+        best = [(score, position) for position, score, _ in top.results()]
+        return self._results(best, intersections, number_of_results)
+
+    def _most_matching_words_above(self, words_to_match, number_of_results, words_to_exclude, min_score):
+        """Top-k search returning only scores of at least min_score, identical to filtering the exhaustive results.
+
+        A candidate of size b can only reach Jaccard index t with a query of size a if
+        min(a, b) / max(a, b) >= t, and only if it shares at least ceil(t * a) words with the query.
+        So only candidates within the size range are looked at, only through the posting lists of
+        the a - ceil(t * a) + 1 rarest query words (prefix filtering), and the size bound is checked
+        against the current k-th best score before any candidate is scored.
+        """
+        words = set(words_to_match) - words_to_exclude
+        query_size = len(words)
+        if query_size == 0 or number_of_results <= 0:
+            return [], []
+        # Small tolerance so that floating point error in t * a never excludes a candidate scoring exactly t
+        min_overlap = math.ceil(min_score * query_size - 1e-9)
+        if min_overlap <= 1:
+            # Every query word is in the prefix, so counting through the posting lists is cheaper
+            matches, scores = self.most_matching_words(words, number_of_results)
+            kept = [(match, score) for match, score in zip(matches, scores) if score >= min_score]
+            return [match for match, _ in kept], [score for _, score in kept]
+        min_size = min_overlap
+        max_size = math.floor(query_size / min_score + 1e-9)
+        word_ids = self.vocabulary.known_ids(words)
+        # Words no candidate has are the rarest of all, and take up their places in the prefix
+        prefix_length = query_size - min_overlap + 1 - (query_size - len(word_ids))
+        word_ids.sort(key=lambda word_id: len(self.postings.get(word_id, ())))
+        query_ids = set(word_ids)
+        postings_by_size = self._postings_by_size()
+        top = TopK(number_of_results)
+        kth_score = None
+        seen = set()
+        for word_id in word_ids[:max(prefix_length, 0)]:
+            if word_id not in postings_by_size:
+                continue
+            sizes, positions = postings_by_size[word_id]
+            for i in range(bisect.bisect_left(sizes, min_size), bisect.bisect_right(sizes, max_size)):
+                position = positions[i]
+                if position in seen:
+                    continue
+                seen.add(position)
+                size = sizes[i]
+                if kth_score is not None and min(size, query_size) / max(size, query_size) < kth_score:
+                    continue
+                count = len(query_ids.intersection(self.candidate_ids[position]))
+                score = count / (size + query_size - count)
+                if score >= min_score:
+                    top.push(position, score, order=position)
+                    kth_score = top.kth_score()
+        return self._expand([(score, position) for position, score, _ in top.results()], number_of_results)
+
+    def _postings_by_size(self):
+        """Posting lists sorted by candidate size, as {word_id: ([sizes], [positions])}. Built on first use."""
+        if self.postings_by_size is None:
+            self.postings_by_size = {}
+            for word_id, positions in self.postings.items():
+                ordered = sorted(positions, key=lambda position: (self.sizes[position], position))
+                self.postings_by_size[word_id] = ([self.sizes[position] for position in ordered], ordered)
+        return self.postings_by_size
+
+    def most_matching_words_batch(self, queries, number_of_results, words_to_exclude=frozenset(), block_size=1000):
+        """Match many queries at once. Returns a list with a (matches, scores) tuple for each query,
+        identical to calling most_matching_words for each of them.
+
+        Each block of queries is encoded as a sparse binary matrix and multiplied with the candidate
+        matrix, which gives every intersection size in the block at once. block_size bounds the
+        memory used by the product when common words make it dense.
+        """
+        results = []
+        for start in range(0, len(queries), block_size):
+            results.extend(self._most_matching_words_block(queries[start:start+block_size], number_of_results, words_to_exclude))
+        return results
+
+    def _most_matching_words_block(self, queries, number_of_results, words_to_exclude):
+        intersections, query_sizes = self.intersections(queries, words_to_exclude)
+        intersections.sort_indices()
+        rows = numpy.repeat(numpy.arange(len(queries)), numpy.diff(intersections.indptr))
+        counts = intersections.data
+        positions = intersections.indices
+        scores = counts / (numpy.asarray(self.sizes)[positions] + numpy.asarray(query_sizes)[rows] - counts)
+        bests = _best_by_row(rows, positions, scores, len(queries), number_of_results)
+        results = []
+        for row, best in enumerate(bests):
+            hit_positions = ()
+            if len(best) < number_of_results:
+                # Every hit is already in best, the rest of the places are filled with zero scores
+                hit_positions = {position for _, position in best}
+            results.append(self._results(best, hit_positions, number_of_results))
+        return results
+
+    def _results(self, best, hit_positions, number_of_results):
+        """Turn (score, position) tuples into matches and scores. Candidates without shared words all
+        score 0.0 and fill any remaining places in dictionary order."""
+        position = 0
+        while len(best) < number_of_results and position < len(self.sizes):
+            if position not in hit_positions:
+                best.append((0.0, position))
+            position += 1
+        return self._expand(best, number_of_results)
+
+    def _expand(self, best, number_of_results):
+        """Fan the best (score, position) tuples of word sets out to their candidates, best first.
+
+        Sets are ordered by their first candidate, so the best number_of_results sets always
+        contain the best number_of_results candidates.
+        """
+        if len(self.members) == len(self.candidates):
+            return [self.candidates[position] for _, position in best], [score for score, _ in best]
+        expanded = sorted(((score, member) for score, position in best for member in self.members[position]), key=lambda entry: (-entry[0], entry[1]))
+        expanded = expanded[:number_of_results]
+        return [self.candidates[member] for _, member in expanded], [score for score, _ in expanded]
+
+    def intersections(self, queries, words_to_exclude=frozenset(), query_parts=None, part_candidates=None):
+        """Return a sparse queries x word sets matrix of intersection sizes, and the sizes of the queries.
+
+        If query_parts is given, it is the number of a part for each query, and part_candidates a list with
+        a sorted numpy array of the word set positions to intersect the queries of each part with. The other
+        word sets are never multiplied, and have no entries in the matrix as if they shared no words.
+        """
+        query_matrix, query_sizes = self._query_matrix(queries, words_to_exclude)
+        if query_parts is None:
+            return (query_matrix @ self._matrix().T).tocsr(), query_sizes
+        order = numpy.argsort(query_parts, kind="stable")
+        bounds = numpy.searchsorted(numpy.asarray(query_parts)[order], numpy.arange(len(part_candidates) + 1))
+        blocks = []
+        for part, candidates in enumerate(part_candidates):
+            part_intersections = (query_matrix[order[bounds[part]:bounds[part + 1]]] @ self._matrix()[candidates].T).tocsr()
+            # Back to the positions of the word sets in the whole index
+            blocks.append(sparse.csr_matrix((part_intersections.data, candidates[part_intersections.indices], part_intersections.indptr),
+                                            shape=(part_intersections.shape[0], len(self.sizes))))
+        if not blocks:
+            return sparse.csr_matrix((len(queries), len(self.sizes)), dtype=numpy.int32), query_sizes
+        return sparse.vstack(blocks).tocsr()[numpy.argsort(order)], query_sizes
+
+    def _query_matrix(self, queries, words_to_exclude):
+        """Encode queries as a sparse binary queries x word ids matrix. Words no candidate has are left
+        out of the matrix but still counted in the returned query sizes."""
+        query_sizes = []
+        indptr = [0]
+        indices = []
+        for words_to_match in queries:
+            words = set(words_to_match) - words_to_exclude
+            query_sizes.append(len(words))
+            indices.extend(word_id for word_id in self.vocabulary.known_ids(words) if word_id in self.postings)
+            indptr.append(len(indices))
+        query_matrix = sparse.csr_matrix((numpy.ones(len(indices), dtype=numpy.int32), indices, indptr), shape=(len(queries), self._matrix().shape[1]))
+        return query_matrix, query_sizes
+
+    def _matrix(self):
+        """Sparse binary candidates x word ids matrix, built on first use."""
+        if self.matrix is None:
+            rows = []
+            columns = []
+            for word_id, positions in self.postings.items():
+                rows.extend(positions)
+                columns.extend([word_id] * len(positions))
+            width = max(self.postings) + 1 if self.postings else 0
+            self.matrix = sparse.csr_matrix((numpy.ones(len(rows), dtype=numpy.int32), (rows, columns)), shape=(len(self.sizes), width))
+        return self.matrix
+
+def _best_by_row(rows, positions, scores, row_count, number_of_results):
+    """Return a list with the best number_of_results (score, position) tuples of each row, best first.
+
+    The entries must be sorted by row, and by position within each row. lexsort is stable,
+    so tied scores stay in position order like in JaccardIndex.most_matching_words.
+    """
+    order = numpy.lexsort((-scores, rows))
+    ranks = numpy.arange(len(order)) - numpy.searchsorted(rows, rows[order])
+    best_entries = order[ranks < number_of_results]
+    bests = [[] for _ in range(row_count)]
+    for row, score, position in zip(rows[best_entries].tolist(), scores[best_entries].tolist(), positions[best_entries].tolist()):
+        bests[row].append((score, position))
+    return bests
+
+def group_patterns(query_groups):
+    """Split queries by the groups they are matched against.
+
+    Arguments:
+    query_groups -- A boolean numpy array of queries x groups, like MultiJaccardIndex.most_matching_words_from_intersections takes
+
+    Returns:
+    A tuple (patterns, parts) with a boolean numpy array of the distinct rows of query_groups, and the number of the pattern of each query
+    """
+    query_groups = numpy.asarray(query_groups, dtype=bool)
+    if not len(query_groups):
+        return query_groups, numpy.zeros(0, dtype=numpy.int64)
+    patterns, parts = numpy.unique(query_groups, axis=0, return_inverse=True)
+    return patterns, parts.ravel()
+
+class MultiJaccardIndex:
+    """Top-k Jaccard searches against many candidate dictionaries at once, such as one for each site.
+
+    Word sets are indexed once for all the dictionaries, so a single traversal of the shared
+    posting lists scores a query against every dictionary. The results for each dictionary are
+    identical to those of a JaccardIndex built from that dictionary alone.
+    """
+
+    def __init__(self, groups, vocabulary=None, index=None):
+        """Arguments:
+        groups -- A {group: {string: {"Preprocessed": set of words or tuple of word ids, ...}}} dictionary
+        vocabulary -- The Vocabulary the word id tuples were encoded with. A private one is used if not given.
+        index -- A JaccardIndex containing every word set of the groups, to share with other indexes. Built from the groups if not given.
+        """
+        if index is None:
+            merged = {(group, candidate): data for group, sentences in groups.items() for candidate, data in sentences.items()}
+            index = JaccardIndex(merged, vocabulary)
+        self.index = index
+        self.vocabulary = index.vocabulary
+        self.group_names = list(groups)
+        self.groups = []
+        columns = []
+        for sentences in groups.values():
+            group_index = _GroupIndex()
+            local_positions = {}
+            for candidate, data in sentences.items():
+                position = index.set_positions.get(self.vocabulary.encode(data["Preprocessed"]))
+                if position is None:
+                    raise ValueError("The shared index is missing the word set of " + repr(candidate))
+                group_index.candidates.append(candidate)
+                if position not in local_positions:
+                    local_positions[position] = len(group_index.members)
+                    group_index.members.append([])
+                    group_index.sizes.append(index.sizes[position])
+                group_index.members[local_positions[position]].append(len(group_index.candidates) - 1)
+            self.groups.append(group_index)
+            columns.extend(local_positions)
+        # Columns of the membership matrix are the word sets of every group, group after group in their own order
+        group_lengths = [len(group_index.sizes) for group_index in self.groups]
+        self.column_groups = numpy.repeat(numpy.arange(len(self.groups)), group_lengths)
+        self.column_offsets = numpy.concatenate(([0], numpy.cumsum(group_lengths)))[:-1].astype(numpy.int64)
+        self.column_sizes = numpy.asarray([size for group_index in self.groups for size in group_index.sizes])
+        self.column_positions = numpy.asarray(columns, dtype=numpy.int64)
+        self.membership = sparse.csr_matrix((numpy.ones(len(columns), dtype=numpy.int32), (columns, numpy.arange(len(columns)))), shape=(len(index.sizes), len(columns)))
+
+    def most_matching_words(self, words_to_match, number_of_results, words_to_exclude=frozenset()):
+        """Return a {group: (matches, scores)} dictionary with the best number_of_results candidates of each group, best first."""
+        return self.most_matching_words_batch([words_to_match], number_of_results, words_to_exclude)[0]
+
+    def most_matching_words_batch(self, queries, number_of_results, words_to_exclude=frozenset(), block_size=1000, query_groups=None):
+        """Match many queries at once. Returns a list with a {group: (matches, scores)} dictionary for each query.
+        See most_matching_words_from_intersections for query_groups."""
+        results = []
+        for start in range(0, len(queries), block_size):
+            block_groups = None if query_groups is None else query_groups[start:start+block_size]
+            intersections, query_sizes = self.intersections(queries[start:start+block_size], words_to_exclude, block_groups)
+            results.extend(self.most_matching_words_from_intersections(intersections, query_sizes, number_of_results, block_groups))
+        return results
+
+    def members(self, groups):
+        """Return the sorted positions in the shared index of the word sets of the groups that are True in the boolean array groups."""
+        return numpy.unique(self.column_positions[numpy.asarray(groups, dtype=bool)[self.column_groups]])
+
+    def word_set_groups(self, positions):
+        """Return a boolean numpy array of the given shared index word set positions x groups, True for the groups having each word set."""
+        rows = self.membership[positions]
+        mask = numpy.zeros((rows.shape[0], len(self.groups)), dtype=bool)
+        mask[numpy.repeat(numpy.arange(rows.shape[0]), numpy.diff(rows.indptr)), self.column_groups[rows.indices]] = True
+        return mask
+
+    def intersections(self, queries, words_to_exclude=frozenset(), query_groups=None):
+        """Like JaccardIndex.intersections of the shared index. With query_groups (see most_matching_words_from_intersections),
+        each query is only intersected with the word sets of the groups it is matched against."""
+        if query_groups is None:
+            return self.index.intersections(queries, words_to_exclude)
+        patterns, parts = group_patterns(query_groups)
+        return self.index.intersections(queries, words_to_exclude, parts, [self.members(pattern) for pattern in patterns])
+
+    def most_matching_words_from_intersections(self, intersections, query_sizes, number_of_results, query_groups=None):
+        """Like most_matching_words_batch, from already known intersection sizes.
+
+        Arguments:
+        intersections -- A sparse queries x word sets matrix of intersection sizes with the word sets of the shared index
+        query_sizes -- The amount of words in each query
+        number_of_results (int) -- Amount of matches to return for each query and group
+        query_groups -- A boolean numpy array of queries x groups, in the order of the groups given to the constructor.
+                        If given, each query is only matched against the groups that are True for it, and its
+                        dictionary only has those groups.
+        """
+        query_count = intersections.shape[0]
+        # Intersection sizes with every word set of every group
+        intersections = (intersections @ self.membership).tocsr()
+        intersections.sort_indices()
+        group_count = len(self.groups)
+        queries_of_entries = numpy.repeat(numpy.arange(query_count), numpy.diff(intersections.indptr))
+        columns = intersections.indices
+        counts = intersections.data
+        # Every (query, group) pair is a row of its own. Columns are sorted by group and then position within a query.
+        groups_of_entries = self.column_groups[columns]
+        rows = queries_of_entries * group_count + groups_of_entries
+        if query_groups is not None:
+            wanted = numpy.asarray(query_groups, dtype=bool).ravel()[rows]
+            queries_of_entries, columns, counts, groups_of_entries, rows = queries_of_entries[wanted], columns[wanted], counts[wanted], groups_of_entries[wanted], rows[wanted]
+        scores = counts / (self.column_sizes[columns] + numpy.asarray(query_sizes)[queries_of_entries] - counts)
+        positions = columns - self.column_offsets[groups_of_entries]
+        bests = _best_by_row(rows, positions, scores, query_count * group_count, number_of_results)
+        results = []
+        for query in range(query_count):
+            query_results = {}
+            for number, (group, group_index) in enumerate(zip(self.group_names, self.groups)):
+                if query_groups is not None and not query_groups[query][number]:
+                    continue
+                best = bests[query * group_count + number]
+                hit_positions = ()
+                if len(best) < number_of_results:
+                    hit_positions = {position for _, position in best}
+                query_results[group] = group_index._results(best, hit_positions, number_of_results)
+            results.append(query_results)
+        return results
+
+class _GroupIndex(JaccardIndex):
+    """The candidates of one group of a MultiJaccardIndex, holding only what is needed to
+    zero fill and expand its results. Positions are the group's own word set positions."""
+
+    def __init__(self):
+        self.candidates = []
+        self.members = []
+        self.sizes = []
+
+class MinHashLSHIndex(JaccardIndex):
+    """Approximate JaccardIndex using MinHash signatures and locality sensitive hashing.
+
+    Each candidate gets a MinHash signature of bands * rows_per_band hashes, and each band of the signature
+    is hashed into a bucket. A query only scores the candidates sharing at least one bucket with it,
+    exactly, so the scores returned are real Jaccard indices but a good match may be missed.
+    A pair with Jaccard index s shares a bucket with probability 1 - (1 - s**rows_per_band)**bands.
+    """
+
+    PRIME = 2**31 - 1
+
+    def __init__(self, sentences_preprocessed, vocabulary=None, bands=32, rows_per_band=2, seed=0):
+        """Arguments:
+        sentences_preprocessed -- A {string: {"Preprocessed": set of words or tuple of word ids, ...}} dictionary
+        vocabulary -- The Vocabulary the word id tuples were encoded with. A private one is used if not given.
+        bands (int) -- Amount of LSH bands. More bands find more matches but cost more.
+        rows_per_band (int) -- Amount of hashes per band. More rows make buckets stricter.
+        seed (int) -- Seed for the hash functions, so that runs are reproducible
+        """
+        super().__init__(sentences_preprocessed, vocabulary)
+        self.bands = bands
+        self.rows_per_band = rows_per_band
+        random_state = numpy.random.RandomState(seed)
+        self.hash_a = random_state.randint(1, self.PRIME, size=bands*rows_per_band).astype(numpy.uint64)
+        self.hash_b = random_state.randint(0, self.PRIME, size=bands*rows_per_band).astype(numpy.uint64)
+        self.buckets = [{} for _ in range(bands)]
+        matrix = self._matrix()
+        for position, signature in self._signatures(matrix):
+            for band, bucket in enumerate(self._band_keys(signature)):
+                if bucket not in self.buckets[band]:
+                    self.buckets[band][bucket] = []
+                self.buckets[band][bucket].append(position)
+
+    def most_matching_words(self, words_to_match, number_of_results, words_to_exclude=frozenset(), min_score=None):
+        """Return the best number_of_results candidates found in the query's buckets and their scores, best first.
+        If min_score is given, only candidates scoring at least min_score are returned."""
+        matches, scores = self.most_matching_words_batch([words_to_match], number_of_results, words_to_exclude)[0]
+        if min_score is not None and min_score > 0:
+            kept = [(match, score) for match, score in zip(matches, scores) if score >= min_score]
+            matches, scores = [match for match, _ in kept], [score for _, score in kept]
+        return matches, scores
+
+    def _most_matching_words_block(self, queries, number_of_results, words_to_exclude):
+        # Words no candidate has are left out of the signature. That only makes collisions more likely,
+        # and the scores below still use the full query sizes.
+        query_matrix, query_sizes = self._query_matrix(queries, words_to_exclude)
+        signatures = dict(self._signatures(query_matrix))
+        results = []
+        for row, query_size in enumerate(query_sizes):
+            hits = set()
+            if row in signatures:
+                for band, bucket in enumerate(self._band_keys(signatures[row])):
+                    hits.update(self.buckets[band].get(bucket, ()))
+            word_ids = set(query_matrix.indices[query_matrix.indptr[row]:query_matrix.indptr[row+1]].tolist())
+            top = TopK(number_of_results)
+            for position in hits:
+                count = len(word_ids.intersection(self.candidate_ids[position]))
+                top.push(position, count / (self.sizes[position] + query_size - count), order=position)
+            best = [(score, position) for position, score, _ in top.results()]
+            results.append(self._results(best, hits, number_of_results))
+        return results
+
+    def _signatures(self, matrix, block_size=10000):
+        """Yield (row, MinHash signature) for every non-empty row of a sparse binary matrix."""
+        for start in range(0, matrix.shape[0], block_size):
+            block = matrix[start:start+block_size]
+            counts = numpy.diff(block.indptr)
+            if not block.nnz:
+                continue
+            word_ids = block.indices.astype(numpy.uint64)
+            hashes = (word_ids[:, None] * self.hash_a + self.hash_b) % numpy.uint64(self.PRIME)
+            non_empty = numpy.flatnonzero(counts)
+            signatures = numpy.minimum.reduceat(hashes, block.indptr[non_empty], axis=0)
+            for row, signature in zip(non_empty.tolist(), signatures):
+                yield start + row, signature
+
+    def _band_keys(self, signature):
+        return [signature[band*self.rows_per_band:(band+1)*self.rows_per_band].tobytes() for band in range(self.bands)]
+
+def most_matching_words(words_to_match, sentences_preprocessed, number_of_results, words_to_exclude, vocabulary=None, min_score=None):
     '''
     Function to calculate Jaccard distance between individual words.
     Preprocess words_to_match and sentences_preprocessed with to_base_word_set().
-    sentences_preprocessed should be a {string: {"Preprocessed": to_base_word_set(string)}} dictionary.
+    sentences_preprocessed should be a {string: {"Preprocessed": to_base_word_set(string)}} dictionary,
+    or a JaccardIndex built from one. A dictionary is scanned in full, so build the index once when matching
+    many queries against the same candidates.
+    If the "Preprocessed" values are word id tuples, pass the Vocabulary used to encode them.
+    If min_score is given, only matches scoring at least min_score are returned, which is much faster.
     INPUTS:
      - words_to_match
      - sentences_preprocessed
      - number_of_results
      - words_to_exclude
+     - vocabulary
+     - min_score
     OUTPUTS:
      - matches_sorted[:limit]
      - scores_sorted[:limit]
     '''
-    #print("Matching " + str(words_to_match))
-    jaccard_index = {}
-    try:
-        for match_candidate in sentences_preprocessed:
-            preprocessed_candidate = sentences_preprocessed[match_candidate]["Preprocessed"]
-            words_to_match -= words_to_exclude
-            intersection = len(preprocessed_candidate.intersection(words_to_match))
-            jaccard_index[match_candidate] = intersection / (len(preprocessed_candidate) + len(words_to_match) - intersection)
-        matches_sorted, scores_sorted = best_n_results(jaccard_index, number_of_results)
-    except Exception as e:
-        print(e)
-        matches_sorted = ["NOT FOUND" for i in range(number_of_results)]
-        scores_sorted = [0 for i in range(number_of_results)]
-    #print("Finished " + str(words_to_match))
-    return matches_sorted[:number_of_results], scores_sorted[:number_of_results]
+    if isinstance(sentences_preprocessed, JaccardIndex):
+        return sentences_preprocessed.most_matching_words(words_to_match, number_of_results, words_to_exclude, min_score)
+    # Building an index only pays off when it is queried more than once
+    words = set(words_to_match) - words_to_exclude
+    query_ids = set(vocabulary.known_ids(words)) if vocabulary is not None else None
+    top = TopK(number_of_results)
+    for candidate, data in sentences_preprocessed.items():
+        preprocessed = data["Preprocessed"]
+        count = len((query_ids if isinstance(preprocessed, tuple) else words).intersection(preprocessed))
+        score = count / (len(preprocessed) + len(words) - count) if count else 0.0
+        if min_score is None or min_score <= 0 or score >= min_score:
+            top.push(candidate, score)
+    best = top.results()
+    return [candidate for candidate, _, _ in best], [score for _, score, _ in best]
+
+def most_matching_words_batch(queries, sentences_preprocessed, number_of_results, words_to_exclude, vocabulary=None):
+    """Batch version of most_matching_words.
+
+    Arguments:
+    queries -- A list of word sets to match
+    sentences_preprocessed -- A {string: {"Preprocessed": ...}} dictionary or a JaccardIndex built from one
+    number_of_results (int) -- Amount of matches to return for each query
+    words_to_exclude -- A set of words to ignore in every query
+    vocabulary -- The Vocabulary used to encode "Preprocessed", if any
+
+    Returns:
+    A list with a (matches_sorted, scores_sorted) tuple for each query, in the same order as queries.
+    """
+    if not isinstance(sentences_preprocessed, JaccardIndex):
+        sentences_preprocessed = JaccardIndex(sentences_preprocessed, vocabulary)
+    return sentences_preprocessed.most_matching_words_batch(queries, number_of_results, words_to_exclude)
 
 def best_n_results(jaccard_index, n):
-    commodities_sorted = sorted(list(jaccard_index.keys()), key=lambda commodity: -jaccard_index[commodity])
-    scores_sorted = sorted(list(jaccard_index.values()), reverse=True)
-    return commodities_sorted[:n], scores_sorted[:n]
+    """Return the n best keys of a {key: score} dictionary and their scores, best first. Ties keep dictionary order."""
+    top = TopK(n)
+    for key, score in jaccard_index.items():
+        top.push(key, score)
+    best = top.results()
+    return [key for key, _, _ in best], [score for _, score, _ in best]
@@ -0,0 +1,315 @@
+import unittest
+import random
+import string
+
+import matcher
+
+def random_word_set(vocabulary, max_words=5):
+    return set(random.sample(vocabulary, random.randint(1, max_words)))
+
+def random_candidates(n, vocabulary):
+    return {"".join(random.choices(string.ascii_lowercase, k=10)): {"Preprocessed": random_word_set(vocabulary)} for _ in range(n)}
+
+def scan_most_matching_words(words_to_match, sentences_preprocessed, number_of_results, words_to_exclude):
+    """Reference implementation, scoring every candidate."""
+    words_to_match = words_to_match - words_to_exclude
+    jaccard_index = {}
+    for match_candidate in sentences_preprocessed:
+        preprocessed_candidate = sentences_preprocessed[match_candidate]["Preprocessed"]
+        intersection = len(preprocessed_candidate.intersection(words_to_match))
+        jaccard_index[match_candidate] = intersection / (len(preprocessed_candidate) + len(words_to_match) - intersection)
+    matches_sorted = sorted(jaccard_index, key=lambda match: -jaccard_index[match])[:number_of_results]
+    return matches_sorted, [jaccard_index[match] for match in matches_sorted]
+
+class JaccardIndexTestCase(unittest.TestCase):
+    """Tests for JaccardIndex and most_matching_words."""
+
+    def setUp(self):
+        self.vocabulary = ["".join(random.choices(string.ascii_lowercase, k=4)) for _ in range(60)]
+
+    def test_same_results_as_scanning_every_candidate(self):
+        """Index results and scores should equal the exhaustive scan, ties included."""
+        for _ in range(20):
+            candidates = random_candidates(random.randint(1, 200), self.vocabulary)
+            index = matcher.JaccardIndex(candidates)
+            for _ in range(20):
+                query = random_word_set(self.vocabulary)
+                exclude = random_word_set(self.vocabulary, 2) if random.random() < 0.3 else set()
+                n = random.randint(1, 15)
+                expected = scan_most_matching_words(query, candidates, n, exclude)
+                self.assertEqual(index.most_matching_words(query, n, exclude), expected)
+                self.assertEqual(matcher.most_matching_words(query, candidates, n, exclude), expected)
+
+    def test_same_results_with_encoded_candidates(self):
+        """Candidates stored as word id tuples should match exactly like sets of words."""
+        candidates = random_candidates(200, self.vocabulary)
+        vocabulary = matcher.Vocabulary()
+        encoded = {candidate: {"Preprocessed": vocabulary.encode(data["Preprocessed"])} for candidate, data in candidates.items()}
+        for _ in range(50):
+            query = random_word_set(self.vocabulary) | {"unknown"}
+            expected = scan_most_matching_words(query, candidates, 10, set())
+            self.assertEqual(matcher.most_matching_words(query, encoded, 10, set(), vocabulary=vocabulary), expected)
+
+    def test_batch_same_results_as_single_queries(self):
+        """Batch matching should return exactly what matching each query separately returns."""
+        candidates = random_candidates(300, self.vocabulary)
+        candidates["empty"] = {"Preprocessed": set()}
+        index = matcher.JaccardIndex(candidates)
+        queries = [random_word_set(self.vocabulary) for _ in range(100)] + [set(), {"unknown"}]
+        exclude = random_word_set(self.vocabulary, 2)
+        expected = [index.most_matching_words(query, 10, exclude) for query in queries]
+        self.assertEqual(index.most_matching_words_batch(queries, 10, exclude, block_size=7), expected)
+        self.assertEqual(matcher.most_matching_words_batch(queries, candidates, 10, exclude), expected)
+
+    def test_min_score_same_as_filtering_exhaustive_results(self):
+        """With min_score, results should be exactly the exhaustive results scoring at least min_score."""
+        for _ in range(10):
+            candidates = random_candidates(300, self.vocabulary)
+            index = matcher.JaccardIndex(candidates)
+            for _ in range(30):
+                query = random_word_set(self.vocabulary, 8) | ({"unknown"} if random.random() < 0.2 else set())
+                min_score = random.choice([0.1, 0.2, 1/3, 0.4, 0.5, 0.6, 2/3, 0.75, 1.0])
+                matches, scores = scan_most_matching_words(query, candidates, 10, set())
+                expected = ([match for match, score in zip(matches, scores) if score >= min_score], [score for score in scores if score >= min_score])
+                self.assertEqual(index.most_matching_words(query, 10, min_score=min_score), expected)
+                self.assertEqual(matcher.most_matching_words(query, candidates, 10, set(), min_score=min_score), expected)
+
+    def test_duplicate_word_sets_same_as_scanning(self):
+        """Candidates sharing a word set should be scored once but all returned like in the exhaustive scan."""
+        word_sets = [random_word_set(self.vocabulary[:10], 3) for _ in range(20)]
+        candidates = {str(i): {"Preprocessed": set(random.choice(word_sets))} for i in range(300)}
+        index = matcher.JaccardIndex(candidates)
+        self.assertLessEqual(len(index.sizes), 20)
+        queries = [random_word_set(self.vocabulary[:12], 4) for _ in range(50)]
+        for n in [1, 5, 40]:
+            expected = [scan_most_matching_words(query, candidates, n, set()) for query in queries]
+            self.assertEqual([index.most_matching_words(query, n) for query in queries], expected)
+            self.assertEqual(index.most_matching_words_batch(queries, n), expected)
+            for query, (matches, scores) in zip(queries, expected):
+                kept = [(match, score) for match, score in zip(matches, scores) if score >= 0.5]
+                self.assertEqual(index.most_matching_words(query, n, min_score=0.5), ([match for match, _ in kept], [score for _, score in kept]))
+
+    def test_unrelated_candidates_score_zero(self):
+        """Candidates without shared words should fill the results with 0.0 in dictionary order."""
+        candidates = {"a b": {"Preprocessed": {"a", "b"}}, "c": {"Preprocessed": {"c"}}, "d": {"Preprocessed": {"d"}}}
+        matches, scores = matcher.most_matching_words({"d"}, candidates, 3, set())
+        self.assertEqual(matches, ["d", "a b", "c"])
+        self.assertEqual(scores, [1.0, 0.0, 0.0])
+
+    def test_does_not_modify_query(self):
+        """Excluded words should not be removed from the caller's set."""
+        query = {"a", "b"}
+        matcher.most_matching_words(query, {"a": {"Preprocessed": {"a"}}}, 1, {"b"})
+        self.assertEqual(query, {"a", "b"})
+
+class MultiJaccardIndexTestCase(unittest.TestCase):
+    """Tests for MultiJaccardIndex."""
+
+    def test_same_results_as_an_index_per_group(self):
+        """Each group's results should equal those of a JaccardIndex built from the group alone."""
+        vocabulary = ["".join(random.choices(string.ascii_lowercase, k=4)) for _ in range(40)]
+        shared = random_candidates(50, vocabulary)
+        groups = {}
+        for group in ["a", "b", "c", "d"]:
+            groups[group] = random_candidates(random.randint(1, 150), vocabulary)
+            groups[group].update(random.sample(list(shared.items()), 20))
+        groups["empty word set"] = {"nothing": {"Preprocessed": set()}}
+        index = matcher.MultiJaccardIndex(groups)
+        queries = [random_word_set(vocabulary) for _ in range(60)] + [set(), {"unknown"}]
+        exclude = random_word_set(vocabulary, 2)
+        for n in [1, 10, 200]:
+            expected = [{} for _ in queries]
+            for group, candidates in groups.items():
+                for query_results, result in zip(expected, matcher.JaccardIndex(candidates).most_matching_words_batch(queries, n, exclude)):
+                    query_results[group] = result
+            self.assertEqual(index.most_matching_words_batch(queries, n, exclude, block_size=7), expected)
+        self.assertEqual(list(index.most_matching_words(queries[0], 5)), list(groups))
+
+    def test_query_groups_only_intersect_their_groups(self):
+        """Queries should only be intersected with the word sets of their groups, and get the same results for them."""
+        vocabulary = ["".join(random.choices(string.ascii_lowercase, k=4)) for _ in range(40)]
+        groups = {group: random_candidates(random.randint(1, 80), vocabulary) for group in ["a", "b", "c", "d"]}
+        index = matcher.MultiJaccardIndex(groups)
+        queries = [random_word_set(vocabulary) for _ in range(60)]
+        query_groups = [[random.random() < 0.4 for _ in groups] for _ in queries]
+        full = index.most_matching_words_batch(queries, 10)
+        expected = [{group: result for number, (group, result) in enumerate(query_results.items()) if wanted[number]} for query_results, wanted in zip(full, query_groups)]
+        self.assertEqual(index.most_matching_words_batch(queries, 10, block_size=7, query_groups=query_groups), expected)
+        intersections, _ = index.intersections(queries, query_groups=query_groups)
+        for query, wanted in enumerate(query_groups):
+            assert set(intersections[query].indices) <= set(index.members(wanted))
+
+class MinHashLSHIndexTestCase(unittest.TestCase):
+    """Tests for MinHashLSHIndex."""
+
+    def setUp(self):
+        self.vocabulary = ["".join(random.choices(string.ascii_lowercase, k=4)) for _ in range(500)]
+        self.candidates = random_candidates(500, self.vocabulary)
+        self.index = matcher.MinHashLSHIndex(self.candidates)
+
+    def test_finds_identical_descriptions(self):
+        """A query identical to a candidate always shares every bucket with it."""
+        for candidate, data in list(self.candidates.items())[:50]:
+            matches, scores = self.index.most_matching_words(data["Preprocessed"], 1)
+            self.assertEqual(scores, [1.0])
+            self.assertEqual(self.candidates[matches[0]]["Preprocessed"], data["Preprocessed"])
+
+    def test_scores_are_exact(self):
+        """Every match found in a shared bucket should have its exact Jaccard score, and results should be sorted."""
+        for _ in range(50):
+            query = random_word_set(self.vocabulary)
+            matches, scores = self.index.most_matching_words(query, 10)
+            self.assertEqual(len(matches), 10)
+            self.assertEqual(scores, sorted(scores, reverse=True))
+            for match, score in zip(matches, scores):
+                if score == 0:
+                    # Filler, not found in any shared bucket
+                    continue
+                expected = scan_most_matching_words(query, {match: self.candidates[match]}, 1, set())[1][0]
+                self.assertEqual(score, expected)
+
+class AbbreviationsTestCase(unittest.TestCase):
+    """Tests for Abbreviations and abbreviation expansion in preprocess."""
+
+    def setUp(self):
+        self.abbrevs = [{"Abbreviation": "SS", "Expanded": "Stainless Steel"}, {"Abbreviation": "SS PIPE", "Expanded": "Stainless Pipe"}, {"Abbreviation": "W/", "Expanded": "With"}, {"Abbreviation": "W/O", "Expanded": "Without"}]
+
+    def test_expands_whole_words_only(self):
+        """Abbreviations inside longer words should not be expanded."""
+        self.assertEqual(matcher.preprocess("BRASS SS NUT", self.abbrevs), {"brass", "stainless", "steel", "nut"})
+        self.assertEqual(matcher.preprocess("BOLTSS W/O", self.abbrevs), {"boltss", "without"})
+
+    def test_abbreviations_ending_in_punctuation_expand_before_words(self):
+        """Abbreviations not ending in a word character should expand when a word follows directly, like with str.replace."""
+        self.assertEqual(matcher.preprocess("PIPE W/HANDLE", self.abbrevs), matcher.preprocess("PIPE WITHHANDLE"))
+        self.assertEqual(matcher.preprocess("AW/ CAP", self.abbrevs), {"aw/", "cap"})
+
+    def test_longest_abbreviation_wins(self):
+        """When abbreviations overlap, the longest one should be expanded."""
+        self.assertEqual(matcher.preprocess("SS PIPE W/ CAP", self.abbrevs), {"stainless", "pipe", "with", "cap"})
+
+    def test_expansions_are_not_expanded_again(self):
+        """Every abbreviation should be expanded in a single pass."""
+        abbrevs = [{"Abbreviation": "A", "Expanded": "B"}, {"Abbreviation": "B", "Expanded": "C"}]
+        self.assertEqual(matcher.preprocess("a b", abbrevs), {"b", "c"})
+
+    def test_compiled_table_is_reused(self):
+        """Compiling the same table twice should return the same compiled instance."""
+        compiled = matcher.compile_abbrevs(self.abbrevs)
+        self.assertIs(matcher.compile_abbrevs(self.abbrevs), compiled)
+        self.assertIs(matcher.compile_abbrevs(compiled), compiled)
+
+class CacheTestCase(unittest.TestCase):
+    """Tests for LRUCache and the tokenization caches."""
+
+    def test_evicts_least_recently_used(self):
+        """A full cache should evict the entry that was used least recently."""
+        cache = matcher.LRUCache(maxsize=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.stats(), {"Hits": 2, "Misses": 1, "Size": 2, "Max Size": 2})
+
+    def test_resize_evicts_least_recently_used(self):
+        """Shrinking a cache should keep the entries used most recently."""
+        cache = matcher.LRUCache(maxsize=3)
+        for key, value in [("a", 1), ("b", 2), ("c", 3)]:
+            cache.put(key, value)
+        cache.get("a")
+        cache.resize(2)
+        self.assertEqual(list(cache.entries), ["c", "a"])
+        cache.put("d", 4)
+        self.assertEqual(list(cache.entries), ["a", "d"])
+
+    def test_cache_is_keyed_by_abbreviation_table(self):
+        """Changing the abbreviation table should not return results cached for another table."""
+        self.assertEqual(matcher.preprocess("ss nut", [{"Abbreviation": "ss", "Expanded": "stainless"}]), {"stainless", "nut"})
+        self.assertEqual(matcher.preprocess("ss nut", [{"Abbreviation": "ss", "Expanded": "steel"}]), {"steel", "nut"})
+
+    def test_repeated_strings_hit_the_cache(self):
+        """Preprocessing the same string again should be a cache hit."""
+        hits = matcher.TOKENIZATION_CACHE.hits
+        first = matcher.to_base_word_set("Cutting Washers", [])
+        self.assertIs(matcher.to_base_word_set("Cutting Washers", []), first)
+        self.assertEqual(first, {"cutt", "wash"})
+        self.assertEqual(matcher.TOKENIZATION_CACHE.hits, hits + 1)
+
+def sort_and_dedupe(pushes, k):
+    """Reference for TopK: stable sort everything, keep the first of each key, union the rows of all."""
+    ranked = sorted(pushes, key=lambda push: -push[1])
+    keys = []
+    best = {}
+    for key, score, rows in ranked:
+        if key not in best:
+            keys.append(key)
+            best[key] = (score, set(rows))
+        else:
+            best[key][1].update(rows)
+    return [(key, best[key][0], best[key][1]) for key in keys[:k]]
+
+class TopKTestCase(unittest.TestCase):
+    """Tests for TopK."""
+
+    def random_pushes(self, n):
+        keys = [random.choice(string.ascii_lowercase) for _ in range(n)]
+        return [(key, random.choice([0.0, 0.25, 0.5, 0.75, 1.0]), {random.randint(0, 100)}) for key in keys]
+
+    def test_same_as_sorting_everything(self):
+        """Kept keys, scores, order and unioned rows should equal sorting and deduplicating everything."""
+        for _ in range(200):
+            pushes = self.random_pushes(random.randint(0, 60))
+            k = random.randint(0, 12)
+            top = matcher.TopK(k)
+            for push in pushes:
+                top.push(*push)
+            self.assertEqual(top.results(), sort_and_dedupe(pushes, k))
+            self.assertLessEqual(len(top), k)
+
+    def test_merge(self):
+        """Merging two accumulators should equal pushing everything into one."""
+        for _ in range(200):
+            first = self.random_pushes(random.randint(0, 30))
+            second = self.random_pushes(random.randint(0, 30))
+            k = random.randint(1, 12)
+            top1 = matcher.TopK(k)
+            top2 = matcher.TopK(k)
+            for push in first:
+                top1.push(*push)
+            for push in second:
+                top2.push(*push)
+            top1.merge(top2)
+            # Only what top2 kept is ranked again, so compare against its kept entries
+            expected = sort_and_dedupe(first + [(key, score, rows) for key, score, rows in top2.results()], k)
+            self.assertEqual([(key, score) for key, score, _ in top1.results()], [(key, score) for key, score, _ in expected])
+
+    def test_does_not_modify_pushed_rows(self):
+        """Unioning rows should create new sets rather than modify the ones pushed."""
+        rows = {"1"}
+        top = matcher.TopK(1)
+        top.push("a", 0.5, rows)
+        top.push("a", 0.7, {"2"})
+        self.assertEqual(rows, {"1"})
+        self.assertEqual(top.results(), [("a", 0.7, {"1", "2"})])
+
+class VocabularyTestCase(unittest.TestCase):
+    """Tests for Vocabulary."""
+
+    def test_encode_is_sorted_and_stable(self):
+        """The same words should always encode to the same sorted tuple of ids."""
+        vocabulary = matcher.Vocabulary()
+        first = vocabulary.encode({"bolt", "hex", "m10"})
+        self.assertEqual(first, tuple(sorted(first)))
+        self.assertEqual(vocabulary.encode(["m10", "bolt", "hex"]), first)
+        self.assertEqual(len(vocabulary), 3)
+
+    def test_encoded_tuples_pass_through(self):
+        """Encoding an already encoded tuple should not change it."""
+        vocabulary = matcher.Vocabulary()
+        encoded = vocabulary.encode({"nut", "washer"})
+        self.assertIs(vocabulary.encode(encoded), encoded)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,16 +1,26 @@
 """Match each row to other rows with similar descriptions."""
 
 import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
 import time
-import copy
-#import concurrent.futures
+import uuid
+import random
+import concurrent.futures
+import multiprocessing
 
+import numpy
 import pandas
+from scipy import sparse
 
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+from collections.abc import Mapping
 
 import file_utils
-from matcher import preprocess, most_matching_words
+from matcher import preprocess, compile_abbrevs, cache_stats, most_matching_words_batch, JaccardIndex, MultiJaccardIndex, MinHashLSHIndex, TopK, group_patterns, Vocabulary, LRUCache, TOKENIZATION_CACHE
 
 OUTPUT_FIELDNAMES = ["Site", "Match Site", "Stock & Site", "Description", "Old Row", "Match Description", "Match Stock & Site", "Match Score", "Match Number", "Matching Row Count"]
 
@@ -18,109 +28,824 @@ INPUT_FIELDNAMES = ["Site", "Stock Code", "Stock & Site", "Stock Description"]
 
 ALL_FIELDNAMES = list(set(INPUT_FIELDNAMES) | set(OUTPUT_FIELDNAMES))
 
-def generate_item_ids_to_rows(rows):
-    """Take a list of rows and return a dictionary mapping each site to a list of rows for that site.
+DELTA_CHANGES = ["added", "changed", "removed"]
+
+RECORD_FIELDNAMES = ["Stock & Site", "Site", "Description", "Match Site", "Old Row"]
+RECORD_MATCH_FIELDNAMES = ["Match Number", "Match Description", "Match Score", "Matching Row Count"]
+
+# Rough sizes in bytes of an output row and of a tokenization cache entry, see memory_budget
+OUTPUT_ROW_SIZE = 2000
+TOKENIZATION_ENTRY_SIZE = 1000
+# Rough bytes taken by scoring each intersection of a query with an indexed token set, see block_size_for_memory
+INTERSECTION_SIZE = 300
+
+class Match(namedtuple("Match", ["description", "score", "rows"])):
+    """A matching description with its score and a frozenset of the "Stock & Site" values of its rows.
+
+    The matches of an item against a site are a tuple of Match records, best first. Being immutable,
+    they are shared between items and runs instead of copied.
+    """
+    __slots__ = ()
+
+# Indexes shared with forked worker processes, so that they are not pickled for every task. See score_blocks.
+_SHARED_INDEXES = None
+
+# (run key, shared indexes) of the last distributed run an rq worker process scored blocks of. See score_queued_block.
+_QUEUED_RUN = None
+
+# Seconds the rows of a distributed run are kept in Redis after the coordinator last checked its tasks
+QUEUED_RUN_TTL = 600
+
+def generate_old_rows_index(rows):
+    """Take a list of output rows and index them by item and match site.
 
     Arguments:
-    rows -- list of dictionaries representing rows
+    rows -- list of dictionaries representing rows with matches
 
     Returns:
-    A dictionary mapping item ids ("Stock & Site") to lists of rows
+    A dictionary mapping item ids ("Stock & Site") to dictionaries mapping match sites to lists of rows sorted by "Match Number"
     """
-    item_ids_to_rows = {}
+    old_rows_index = {}
     for row in rows:
-        item_id = row["Stock & Site"]
-        if item_id not in item_ids_to_rows:
-            item_ids_to_rows[item_id] = []
-        item_ids_to_rows[item_id].append(row)
-    return item_ids_to_rows
+        old_rows_index.setdefault(row["Stock & Site"], {}).setdefault(row["Match Site"], []).append(row)
+    for site_to_rows in old_rows_index.values():
+        for site, site_rows in site_to_rows.items():
+            site_to_rows[site] = sorted(site_rows, key=lambda r: int(r["Match Number"]))
+    return old_rows_index
 
-def preprocess_all(site_rows, abbrevs=[]):
+def preprocess_all(site_rows, abbrevs=[], vocabulary=None):
     """Take a list of rows and return a dictionary mapping sites to properly preprocessed dictionaries. (See return format below.)
 
     Arguments:
     site_rows -- A list of dictionaries representing rows
-    abbrevs -- a list of dictionaries with keys "Abbreviation" and "Expanded"
+    abbrevs -- a list of dictionaries with keys "Abbreviation" and "Expanded", or a matcher.Abbreviations
+    vocabulary -- If given, store "Preprocessed" as a tuple of word ids encoded with this matcher.Vocabulary rather than a set of words
 
     Returns:
-    A dictionary of the form {"site": {"Stock Description": {"Preprocessed": ..., "Stock Code": ..., "Stock & Site": {...}}, ...}, ...}
+    A dictionary of the form {"site": {"Stock Description": {"Preprocessed": ..., "Stock Code": ..., "Stock & Site": frozenset({...})}, ...}, ...}
+    The descriptions of each site are sorted, so tied matches are ordered by description whatever the order of the rows.
     """
     site_to_descs = {}
     site = None
-    site_rows_sorted = sorted(site_rows, key=lambda row: row["Site"])
+    site_rows_sorted = sorted(site_rows, key=lambda row: (row["Site"], row["Description"].strip()))
     for row in site_rows_sorted:
         if row["Site"] != site:
             site = row["Site"]
             desc_to_preprocessed = {}
         desc = row["Description"].strip()
         if desc not in desc_to_preprocessed:
-            relevant_data = {"Preprocessed": preprocess(desc, abbrevs), "Stock & Site": {row["Stock & Site"]}}
+            preprocessed = preprocess(desc, abbrevs)
+            if vocabulary is not None:
+                preprocessed = vocabulary.encode(preprocessed)
+            relevant_data = {"Preprocessed": preprocessed, "Stock & Site": {row["Stock & Site"]}}
             desc_to_preprocessed[desc] = relevant_data
         else:
             desc_to_preprocessed[desc]["Stock & Site"].add(row["Stock & Site"])
         site_to_descs[site] = desc_to_preprocessed
+    for desc_to_preprocessed in site_to_descs.values():
+        for relevant_data in desc_to_preprocessed.values():
+            relevant_data["Stock & Site"] = frozenset(relevant_data["Stock & Site"])
     return site_to_descs
 
-def generate_jobs(site_rows, site_to_descs_preprocessed, abbrevs=[]):
+def site_index(descs_preprocessed, vocabulary=None, lsh=None):
+    """Build the index used to match descriptions against one site.
+
+    Arguments:
+    descs_preprocessed -- A dictionary of the format {"Stock Description": {"Preprocessed": ..., "Stock & Site": {...}}, ...}
+    vocabulary -- The matcher.Vocabulary used by preprocess_all, if any
+    lsh -- A (bands, rows per band) tuple to use approximate MinHash LSH matching, or None for exact matching
+
+    Returns:
+    A matcher.JaccardIndex or matcher.MinHashLSHIndex
+    """
+    if lsh:
+        bands, rows_per_band = lsh
+        return MinHashLSHIndex(descs_preprocessed, vocabulary, bands=bands, rows_per_band=rows_per_band)
+    return JaccardIndex(descs_preprocessed, vocabulary)
+
+def canonical_token_sets(site_rows, abbrevs=[]):
+    """Map every row, across all sites, to the id of its preprocessed description.
+
+    Descriptions that only differ in case, punctuation, spacing, word order or abbreviations
+    preprocess to the same token set and share an id, so they only need to be matched once.
+
+    Arguments:
+    site_rows -- a list of dictionaries representing rows
+    abbrevs -- a list of dictionaries with keys "Abbreviation" and "Expanded", or a matcher.Abbreviations
+
+    Returns:
+    A tuple (row_set_ids, token_sets) where row_set_ids[i] is the position of site_rows[i]'s token set in token_sets
+    """
+    set_ids = {}
+    row_set_ids = []
+    for row in site_rows:
+        preprocessed = preprocess(row["Description"].strip(), abbrevs)
+        if preprocessed not in set_ids:
+            set_ids[preprocessed] = len(set_ids)
+        row_set_ids.append(set_ids[preprocessed])
+    return row_set_ids, list(set_ids.keys())
+
+def compression_ratio(site_rows, abbrevs=[]):
+    """Return the amount of rows per unique token set, see canonical_token_sets."""
+    row_set_ids, token_sets = canonical_token_sets(site_rows, abbrevs)
+    if not token_sets:
+        return 1.0
+    return len(row_set_ids) / len(token_sets)
+
+def site_affinities(site_to_descs_preprocessed):
+    """Measure how related sites are by the overlap of their vocabularies.
+
+    Arguments:
+    site_to_descs_preprocessed -- A dictionary like preprocess_all returns
+
+    Returns:
+    A {"site": {"other site": affinity, ...}, ...} dictionary, the affinity being the Jaccard index of the sets of words used by the two sites
+    """
+    site_words = {site: set().union(*(data["Preprocessed"] for data in descs.values())) for site, descs in site_to_descs_preprocessed.items()}
+    affinities = {site: {} for site in site_words}
+    sites = list(site_words)
+    for number, site in enumerate(sites):
+        for other in sites[number+1:]:
+            union = len(site_words[site] | site_words[other])
+            affinity = len(site_words[site] & site_words[other]) / union if union else 0.0
+            affinities[site][other] = affinity
+            affinities[other][site] = affinity
+    return affinities
+
+def related_sites(site_to_descs_preprocessed, top_sites=0, min_affinity=0.0, keep_unrelated=False):
+    """Pick the sites to match the rows of each site against, see site_affinities.
+
+    Arguments:
+    site_to_descs_preprocessed -- A dictionary like preprocess_all returns
+    top_sites (int) -- Match each site only against this many of the sites with the highest affinity to it. 0 keeps all of them.
+    min_affinity (float) -- Match each site only against sites with at least this affinity to it
+    keep_unrelated (bool) -- Whether to also match against sites sharing no words with the site, when the other limits allow
+
+    Returns:
+    A {"site": {"related site", ...}, ...} dictionary. A site is never related to itself.
+    """
+    related = {}
+    for site, affinities in site_affinities(site_to_descs_preprocessed).items():
+        # Ties are broken by site name, so that the same sites are picked on every run
+        others = [other for other in sorted(affinities, key=lambda other: (-affinities[other], other))
+                  if affinities[other] >= min_affinity and (keep_unrelated or affinities[other] > 0)]
+        if top_sites:
+            others = others[:top_sites]
+        related[site] = set(others)
+    return related
+
+def related_groups(site_rows, row_set_ids, set_count, group_names, related):
+    """Return the groups each token set needs to be matched against, for the rows having it.
+
+    Arguments:
+    site_rows -- a list of dictionaries representing rows
+    row_set_ids -- The token set id of each row, see canonical_token_sets
+    set_count (int) -- Amount of token sets
+    group_names -- The sites of the matcher.MultiJaccardIndex to match against, in order
+    related -- A dictionary like related_sites returns
+
+    Returns:
+    A boolean numpy array of token sets x groups, for the query_groups argument of matcher.MultiJaccardIndex
+    """
+    group_numbers = {group: number for number, group in enumerate(group_names)}
+    site_groups = {site: [group_numbers[other] for other in others if other in group_numbers] for site, others in related.items()}
+    mask = numpy.zeros((set_count, len(group_names)), dtype=bool)
+    for set_id, site in {(set_id, row["Site"]) for row, set_id in zip(site_rows, row_set_ids) if set_id < set_count}:
+        mask[set_id, site_groups[site]] = True
+    return mask
+
+class DescriptionMatchCache:
+    """Persistent SQLite store of the top 10 matches of preprocessed descriptions against sites.
+
+    Entries are keyed by the site, the preprocessed description matched against it, the abbreviation
+    table and the amount of matches, and remember the version of the site they were matched against.
+    A version is the site's set of descriptions, stored once. When descriptions have only been added
+    to a site since, an entry is brought up to date by matching against the added descriptions alone.
+    Entries are matched again in full when descriptions were removed. "Stock & Site" sets are not
+    stored, they are looked up from the current rows.
+    """
+
+    # Bump when preprocessing or matching changes in a way that changes the results
+    VERSION = 3
+    TABLES = ("description_match_cache", "site_versions", "site_matches")
+    # The only table of version 1, which had no version marker
+    VERSION_1_SCHEMA = "CREATE TABLE matches (key TEXT PRIMARY KEY, result TEXT NOT NULL)"
+
+    def __init__(self, filename):
+        """Arguments:
+        filename (string) -- The SQLite database file, created if it does not exist
+
+        Raises ValueError if the file is not a match cache, such as the JSON match data of older versions
+        or an unrelated SQLite database. Caches of other versions are emptied.
+        """
+        self.connection = sqlite3.connect(file_utils.add_path(filename))
+        try:
+            schemas = dict(self.connection.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table'").fetchall())
+        except sqlite3.DatabaseError:
+            self.connection.close()
+            raise ValueError(filename + " is not a match cache database. Match data of older versions was JSON, remove the file or give another one.")
+        if schemas and "description_match_cache" not in schemas and schemas != {"matches": self.VERSION_1_SCHEMA}:
+            self.connection.close()
+            raise ValueError(filename + " is an SQLite database, but not a match cache. Give a new file or an existing match cache.")
+        with self.connection:
+            if "description_match_cache" in schemas:
+                if self.connection.execute("SELECT version FROM description_match_cache").fetchone() != (self.VERSION,):
+                    for table in self.TABLES:
+                        self.connection.execute("DROP TABLE IF EXISTS " + table)
+                    schemas = {}
+            elif schemas:
+                # Version 1 had no marker, only its own matches table
+                self.connection.execute("DROP TABLE matches")
+                schemas = {}
+            if not schemas:
+                self.connection.execute("CREATE TABLE description_match_cache (version INTEGER NOT NULL)")
+                self.connection.execute("INSERT INTO description_match_cache (version) VALUES (?)", (self.VERSION,))
+                self.connection.execute("CREATE TABLE site_versions (version TEXT PRIMARY KEY, descriptions TEXT NOT NULL)")
+                self.connection.execute("CREATE TABLE site_matches (key TEXT PRIMARY KEY, version TEXT NOT NULL, result TEXT NOT NULL)")
+        self.hits = 0
+        self.updates = 0
+        self.misses = 0
+
+    def close(self):
+        with self.connection:
+            self.connection.execute("DELETE FROM site_versions WHERE version NOT IN (SELECT version FROM site_matches)")
+        self.connection.close()
+
+    def site_version(self, site, descs_preprocessed, abbrevs):
+        """Return a hash identifying a site with the given descriptions, in any order, preprocessed with abbrevs."""
+        content = [self.VERSION, site, compile_abbrevs(abbrevs).version, sorted(descs_preprocessed)]
+        return hashlib.sha1(json.dumps(content).encode("utf-8")).hexdigest()
+
+    def key(self, site, descriptions, token_set, abbrevs, number_of_results):
+        """Return the key of the matches of a token set against some descriptions of a site.
+
+        descriptions (string) names which descriptions of the site are matched against, like
+        "All" or "New", so that matches against each are kept apart.
+        """
+        content = [self.VERSION, site, descriptions, sorted(token_set), compile_abbrevs(abbrevs).version, number_of_results]
+        return hashlib.sha1(json.dumps(content).encode("utf-8")).hexdigest()
+
+    def get_site_versions(self, versions):
+        """Return a {version: list of descriptions} dictionary of the site versions found in the cache."""
+        return {version: json.loads(descriptions) for version, descriptions in self._select("site_versions", "version", "descriptions", versions)}
+
+    def put_site_versions(self, items):
+        """Store (version, list of descriptions) tuples, see site_version."""
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO site_versions (version, descriptions) VALUES (?, ?)", ((version, json.dumps(sorted(descriptions))) for version, descriptions in items))
+
+    def get_many(self, keys):
+        """Return a {key: (version, (matches, scores))} dictionary of the keys found in the cache."""
+        found = {}
+        for key, version, result in self._select("site_matches", "key", "version, result", keys):
+            matches, scores = json.loads(result)
+            found[key] = (version, (matches, scores))
+        return found
+
+    def put_many(self, items):
+        """Store (key, version, (matches, scores)) tuples."""
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO site_matches (key, version, result) VALUES (?, ?, ?)", ((key, version, json.dumps(result)) for key, version, result in items))
+
+    def _select(self, table, key_column, columns, keys):
+        keys = list(keys)
+        # Stay under SQLite's limit on the amount of query parameters
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start+500]
+            query = "SELECT " + key_column + ", " + columns + " FROM " + table + " WHERE " + key_column + " IN (" + ",".join("?" * len(chunk)) + ")"
+            yield from self.connection.execute(query, chunk)
+
+    def stats(self):
+        return {"Hits": self.hits, "Updates": self.updates, "Misses": self.misses}
+
+def added_descriptions(old_descriptions, descs_preprocessed):
+    """Return the descriptions of descs_preprocessed missing from old_descriptions, or None if any of old_descriptions was removed."""
+    old = set(old_descriptions)
+    if not old.issubset(descs_preprocessed):
+        return None
+    return {description: data for description, data in descs_preprocessed.items() if description not in old}
+
+def merge_top_matches(results, number_of_results):
+    """Merge (matches, scores) tuples of disjoint descriptions of a site into its best number_of_results.
+
+    Tied scores are ordered by description, like when matching against all of them at once, see preprocess_all.
+    """
+    merged = sorted((entry for matches, scores in results for entry in zip(matches, scores)), key=lambda entry: (-entry[1], entry[0]))
+    merged = merged[:number_of_results]
+    return [match for match, _ in merged], [score for _, score in merged]
+
+def cached_most_matching_words(cache, queries, site_to_descs_preprocessed, index, shared_index, abbrevs=[], block_size=1000, query_groups=None, descriptions="All"):
+    """Return the top 10 matches of each query against each site, matching only what is not found in the cache.
+
+    Each query and site is looked up separately. Entries of sites that only gained descriptions since
+    are updated by matching against the added descriptions, and the rest are matched in full.
+
+    Arguments:
+    cache -- A DescriptionMatchCache
+    queries -- A list of token sets
+    site_to_descs_preprocessed -- The descriptions to match against, like preprocess_all returns
+    index -- A matcher.MultiJaccardIndex of site_to_descs_preprocessed sharing shared_index
+    shared_index -- A matcher.JaccardIndex with every query token set and description
+    abbrevs -- a list of dictionaries with keys "Abbreviation" and "Expanded", or a matcher.Abbreviations
+    query_groups -- If given, a boolean numpy array of queries x sites to only match each query against some sites, see related_groups
+    descriptions (string) -- Which descriptions of the sites site_to_descs_preprocessed has, see DescriptionMatchCache.key
+
+    Returns:
+    A list with a {"site": (matches, scores)} dictionary for each query
+    """
+    abbrevs = compile_abbrevs(abbrevs)
+    sites = list(site_to_descs_preprocessed)
+    versions = [cache.site_version(site, descs, abbrevs) for site, descs in site_to_descs_preprocessed.items()]
+    cache.put_site_versions(zip(versions, site_to_descs_preprocessed.values()))
+    if query_groups is None:
+        query_groups = numpy.ones((len(queries), len(sites)), dtype=bool)
+    keys = {(position, number): cache.key(sites[number], descriptions, queries[position], abbrevs, 10) for position, number in numpy.argwhere(query_groups).tolist()}
+    found = cache.get_many(keys.values())
+    old_versions = cache.get_site_versions({found[key][0] for key in keys.values() if key in found} - set(versions))
+    # The descriptions added to a site since an older version of it, for each (site number, version) pair
+    added = {}
+    results = [{} for _ in queries]
+    missing = numpy.zeros((len(queries), len(sites)), dtype=bool)
+    outdated = {}
+    for (position, number), key in keys.items():
+        version, result = found.get(key, (None, None))
+        if version == versions[number]:
+            results[position][sites[number]] = result
+            continue
+        if version in old_versions and (number, version) not in added:
+            added[(number, version)] = added_descriptions(old_versions[version], site_to_descs_preprocessed[sites[number]])
+        if added.get((number, version)):
+            outdated[(position, number)] = (version, result)
+        else:
+            missing[position, number] = True
+    cache.hits += len(keys) - len(outdated) - int(missing.sum())
+    cache.updates += len(outdated)
+    cache.misses += int(missing.sum())
+    # Outdated entries are only matched against the descriptions added since, in an index of their own
+    added_groups = [group for group, descs in added.items() if descs]
+    added_index = MultiJaccardIndex({group: added[group] for group in added_groups}, index=shared_index)
+    stale = numpy.zeros((len(queries), len(added_groups)), dtype=bool)
+    group_numbers = {group: number for number, group in enumerate(added_groups)}
+    for (position, number), (version, _) in outdated.items():
+        stale[position, group_numbers[(number, version)]] = True
+    site_numbers = {site: number for number, site in enumerate(sites)}
+    todo = numpy.flatnonzero(missing.any(axis=1) | stale.any(axis=1))
+    for start, end in split_blocks(len(todo), block_size):
+        block = todo[start:end]
+        # Only the word sets of the sites each query is matched against are intersected
+        patterns, parts = group_patterns(numpy.hstack([missing[block], stale[block]]))
+        candidates = [numpy.union1d(index.members(pattern[:len(sites)]), added_index.members(pattern[len(sites):])) for pattern in patterns]
+        intersections, query_sizes = shared_index.intersections([queries[position] for position in block], frozenset(), parts, candidates)
+        new_items = []
+        for position, query_results in zip(block.tolist(), index.most_matching_words_from_intersections(intersections, query_sizes, 10, missing[block])):
+            results[position].update(query_results)
+            new_items.extend((keys[(position, site_numbers[site])], versions[site_numbers[site]], result) for site, result in query_results.items())
+        for position, query_results in zip(block.tolist(), added_index.most_matching_words_from_intersections(intersections, query_sizes, 10, stale[block])):
+            for (number, version), added_result in query_results.items():
+                site = sites[number]
+                results[position][site] = merge_top_matches([outdated[(position, number)][1], added_result], 10)
+                new_items.append((keys[(position, number)], versions[number], results[position][site]))
+        cache.put_many(new_items)
+    # Keep the sites in the order of the index, like when matching without a cache
+    return [{site: query_results[site] for site in sites if site in query_results} for query_results in results]
+
+def generate_jobs(site_rows, site_to_descs_preprocessed, abbrevs=[], vocabulary=None, lsh=None, related=None, spill=None, all_site_to_descs_preprocessed=None, block_size=10000):
     """Take rows and preprocessed descriptions and return top 10 matches and Jaccard scores for each stock_id and site in a dictionary.
 
     Arguments:
     site_rows -- a list of dictionaries representing rows
     site_to_descs_preprocessed -- A dictionary of the format {"site": {"Stock Description": {"Preprocessed": ..., "Stock Code": ..., "Stock & Site": {...}}, ...}, ...}
-    abbrevs -- a list of dictionaries with keys "Abbreviation" and "Expanded"
+    abbrevs -- a list of dictionaries with keys "Abbreviation" and "Expanded", or a matcher.Abbreviations
+    vocabulary -- The matcher.Vocabulary used by preprocess_all, if any
+    lsh -- A (bands, rows per band) tuple to use approximate MinHash LSH matching, or None for exact matching
+    related -- A dictionary like related_sites returns to only match rows against the sites related to theirs, or None for all sites
+    spill -- A SpilledDescMatches to add the matches to block by block instead of returning them, so that
+             only the results of one block of token sets are held in memory at a time
+    all_site_to_descs_preprocessed -- The descriptions to look the rows of matches up from when spilling, see jobs_to_desc_matches
+    block_size (int) -- Amount of token sets in a block when spilling
+
+    Returns:
+    A dictionary of the form {"stock_id": {"site": ([descending list of top 10 matches], [descending list of top 10 scores]), ...}, ...},
+    or an empty dictionary when spilling
+    """
+    row_set_ids, token_sets = canonical_token_sets(site_rows, abbrevs)
+    query_groups = None
+    if related is not None:
+        query_groups = related_groups(site_rows, row_set_ids, len(token_sets), list(site_to_descs_preprocessed), related)
+    indexes = None
+    if not lsh:
+        # Match every unique token set against all sites in one pass over a shared index
+        multi_index = MultiJaccardIndex(site_to_descs_preprocessed, vocabulary)
+    if spill is None:
+        blocks = [(0, len(token_sets))]
+    else:
+        blocks = split_blocks(len(token_sets), block_size)
+        rows_by_set = sorted_by_set_id(site_rows, row_set_ids)
+        if lsh:
+            # Every block is matched against every site, so the LSH indexes are only built once
+            indexes = [site_index(descs, vocabulary, lsh) for descs in site_to_descs_preprocessed.values()]
+    for start, end in blocks:
+        block_groups = None if query_groups is None else query_groups[start:end]
+        if lsh:
+            results = [{} for _ in range(start, end)]
+            for number, (site, descs) in enumerate(site_to_descs_preprocessed.items()):
+                index = site_index(descs, vocabulary, lsh) if indexes is None else indexes[number]
+                positions = range(end - start) if block_groups is None else numpy.flatnonzero(block_groups[:, number])
+                site_results = most_matching_words_batch([token_sets[start + position] for position in positions], index, 10, words_to_exclude=set())
+                for position, result in zip(positions, site_results):
+                    results[position][site] = result
+        else:
+            results = multi_index.most_matching_words_batch(token_sets[start:end], 10, query_groups=block_groups)
+        if spill is None:
+            return jobs_from_results(site_rows, row_set_ids, results, related)
+        spill_results(spill, rows_by_set, range(start, end), results, all_site_to_descs_preprocessed, related)
+    return {}
+
+def score_block(start, end, shared_indexes=None):
+    """Match new token sets start to end against the shared indexes.
+
+    Arguments:
+    start, end (int) -- The block of new token sets to match
+    shared_indexes -- A (shared_index, new_index, token_sets, old_queries, new_query_groups, old_index, old_query_groups) tuple,
+                      see both_ways_indexes. Defaults to the ones set up by score_blocks.
+
+    Returns:
+    A tuple with the results for the new token sets, and their intersection sizes with the old query token sets.
+    With query groups, intersections with old query token sets are only known where the old query is matched against a site having the new one.
+    """
+    if shared_indexes is None:
+        shared_indexes = _SHARED_INDEXES
+    shared_index, new_index, token_sets, old_queries, new_query_groups, old_index, old_query_groups = shared_indexes
+    if new_query_groups is None:
+        intersections, query_sizes = shared_index.intersections(token_sets[start:end])
+        return new_index.most_matching_words_from_intersections(intersections, query_sizes, 10), intersections[:, old_queries]
+    block_groups = new_query_groups[start:end]
+    # Only the word sets of the related sites, and the old queries matched against the sites having the new token set, are intersected.
+    # New token sets are the first ones of the shared index.
+    patterns, parts = group_patterns(numpy.hstack([block_groups, old_index.word_set_groups(numpy.arange(start, end))]))
+    group_count = len(new_index.groups)
+    old_positions = numpy.asarray(old_queries, dtype=numpy.int64)
+    candidates = [numpy.union1d(new_index.members(pattern[:group_count]), old_positions[old_query_groups[:, pattern[group_count:]].any(axis=1)])
+                  for pattern in patterns]
+    intersections, query_sizes = shared_index.intersections(token_sets[start:end], frozenset(), parts, candidates)
+    return new_index.most_matching_words_from_intersections(intersections, query_sizes, 10, block_groups), intersections[:, old_queries]
+
+def score_blocks(shared_indexes, new_count, block_size, processes=1):
+    """Run score_block for every block of new token sets, yielding the results in order.
+
+    With more than one process, the blocks are spread over forked worker processes which inherit
+    the indexes instead of receiving them with each task. The blocks are collected in order,
+    so the results are the same as when running in a single process. Only a few blocks per
+    process are scored ahead of the one being yielded, so that unread results do not pile up.
+
+    Arguments:
+    shared_indexes -- A (shared_index, new_index, token_sets, old_queries, new_query_groups, old_index, old_query_groups) tuple, see both_ways_indexes
+    new_count (int) -- Amount of new token sets
+    block_size (int) -- Amount of new token sets in a block
+    processes (int) -- Amount of worker processes. Forking is needed for more than one.
+
+    Yields:
+    The score_block result of each block
+    """
+    global _SHARED_INDEXES
+    blocks = split_blocks(new_count, block_size)
+    _SHARED_INDEXES = shared_indexes
+    try:
+        if processes > 1 and len(blocks) > 1 and "fork" in multiprocessing.get_all_start_methods():
+            with concurrent.futures.ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("fork")) as executor:
+                futures = []
+                for start, end in blocks:
+                    futures.append(executor.submit(score_block, start, end))
+                    if len(futures) > 2 * processes:
+                        yield futures.pop(0).result()
+                for future in futures:
+                    yield future.result()
+        else:
+            for start, end in blocks:
+                yield score_block(start, end)
+    finally:
+        _SHARED_INDEXES = None
+
+def split_blocks(count, block_size):
+    """Return (start, end) tuples splitting range(count) into blocks of block_size."""
+    return [(start, min(start + block_size, count)) for start in range(0, count, block_size)]
+
+def block_size_for_memory(shared_index, queries, max_memory, sample_size=100):
+    """Return how many queries to score at a time to take about max_memory bytes, estimated from the intersections of a sample of them.
+
+    Arguments:
+    shared_index -- The matcher.JaccardIndex the queries are intersected with
+    queries -- A list of token sets
+    max_memory (int) -- Bytes of memory scoring a block may take
+    sample_size (int) -- Amount of evenly spaced queries to intersect
+
+    Returns:
+    The amount of queries in a block, at least 1
+    """
+    if not queries:
+        return 1
+    sample = queries[::max(len(queries) // sample_size, 1)]
+    intersections, _ = shared_index.intersections(sample)
+    query_memory = max(intersections.nnz / len(sample), 1) * INTERSECTION_SIZE
+    return max(int(max_memory // query_memory), 1)
+
+def score_queued_block(run_key, start, end):
+    """rq task scoring one block of new token sets of a distributed run, see score_blocks_on_queue.
+
+    The rows of the run are read from Redis and the indexes are built from them. A forking rq
+    Worker runs every task in a new work horse process, so this happens for every task, and only
+    workers running tasks in their own process (like SimpleWorker) reuse the indexes for the next
+    blocks of the same run.
+    """
+    global _QUEUED_RUN
+    if _QUEUED_RUN is None or _QUEUED_RUN[0] != run_key:
+        from rq import get_current_job
+        run = get_current_job().connection.get(run_key)
+        if run is None:
+            raise RuntimeError("The rows of " + run_key + " are gone, the run has ended")
+        run = json.loads(run)
+        abbrevs = compile_abbrevs(run["Abbreviations"])
+        vocabulary = Vocabulary()
+        site_to_descs_preprocessed, _, all_site_to_descs_preprocessed = preprocess_new_and_old(run["Rows"], run["Old Rows"], abbrevs, vocabulary)
+        related = None if run["Related Sites"] is None else {site: set(others) for site, others in run["Related Sites"].items()}
+        indexes = both_ways_indexes(run["Rows"], run["Old Rows"], site_to_descs_preprocessed, all_site_to_descs_preprocessed, abbrevs, vocabulary, related)
+        _QUEUED_RUN = (run_key, indexes["Shared Indexes"])
+    return score_block(start, end, _QUEUED_RUN[1])
+
+def queue_block_size(queue, new_count, block_size):
+    """Return how many new token sets to score in a task on queue.
+
+    Every task builds the indexes of the whole run, so the new token sets are split evenly between
+    the workers listening on the queue instead of into many small tasks.
+
+    Arguments:
+    queue -- An rq Queue
+    new_count (int) -- Amount of new token sets
+    block_size (int) -- Least amount of new token sets in a task
+
+    Returns:
+    The amount of new token sets in a task, at least 1
+    """
+    from rq import Worker
+    workers = max(Worker.count(queue=queue), 1)
+    return max(block_size, -(-new_count // workers), 1)
+
+def score_blocks_on_queue(queue, site_rows, old_site_rows, abbrevs, new_count, block_size, poll_interval=1.0, job_timeout=3600, related=None):
+    """Distributed version of score_blocks, scoring the blocks as tasks on an rq queue.
+
+    The rows are stored in Redis once for the whole run and tasks only carry the block bounds,
+    but every task rebuilds the indexes from the rows, see score_queued_block. The rows are kept
+    for as long as the tasks are checked on, however long they wait in the queue, and deleted when
+    the run ends. The block results are collected in order, so the results are the same as when
+    scoring everything locally.
+
+    Arguments:
+    queue -- An rq Queue served by workers that can import this module
+    site_rows, old_site_rows, abbrevs, related -- As given to generate_jobs_both_ways
+    new_count (int) -- Amount of new token sets
+    block_size (int) -- Amount of new token sets in a task, see queue_block_size
+    poll_interval (float) -- Seconds to wait between checking the tasks
+    job_timeout (int) -- Seconds a task may take
+
+    Returns:
+    A list with the score_block result of each block
+    """
+    abbrevs = compile_abbrevs(abbrevs)
+    fields = ["Site", "Stock & Site", "Description"]
+    run = {"Abbreviations": [{"Abbreviation": abbreviation, "Expanded": expanded} for abbreviation, expanded in abbrevs.expansions.items()],
+           "Rows": [{field: row[field] for field in fields} for row in site_rows],
+           "Old Rows": [{field: row[field] for field in fields} for row in old_site_rows],
+           "Related Sites": None if related is None else {site: sorted(others) for site, others in related.items()}}
+    run_key = "row_to_row:" + uuid.uuid4().hex
+    queue.connection.set(run_key, json.dumps(run), ex=QUEUED_RUN_TTL)
+    try:
+        jobs = [queue.enqueue(score_queued_block, run_key, start, end, job_timeout=job_timeout) for start, end in split_blocks(new_count, block_size)]
+        while True:
+            # Only expires if this process stops checking on the tasks without deleting the rows
+            queue.connection.expire(run_key, QUEUED_RUN_TTL)
+            statuses = [job.get_status() for job in jobs]
+            if any(status in ("failed", "stopped", "canceled") for status in statuses):
+                raise RuntimeError("Distributed row to row matching failed: " + str([job.id for job, status in zip(jobs, statuses) if status in ("failed", "stopped", "canceled")]))
+            if all(status == "finished" for status in statuses):
+                # Older rq versions only have job.result
+                return [job.return_value() if hasattr(job, "return_value") else job.result for job in jobs]
+            time.sleep(poll_interval)
+    finally:
+        queue.connection.delete(run_key)
+
+def both_ways_indexes(site_rows, old_site_rows, site_to_descs_preprocessed, all_site_to_descs_preprocessed, abbrevs=[], vocabulary=None, related=None):
+    """Build the indexes used by generate_jobs_both_ways.
 
     Returns:
-    A dictionary of the form {"stock_id": {"site": ([descending list of top 10 matches], [descending list of top 10 scores]), ...}, ...}
+    A dictionary with keys "New Set Ids" and "Old Set Ids" (see canonical_token_sets), "New Count" (amount of new token sets),
+    "Shared Indexes" (a (shared_index, new_index, token_sets, old_queries, new_query_groups, old_index, old_query_groups) tuple
+    for score_block), "Old Index" and "Old Query Groups". The query groups are None unless related is given, see related_groups.
+    """
+    row_set_ids, token_sets = canonical_token_sets(site_rows + old_site_rows, abbrevs)
+    new_set_ids = row_set_ids[:len(site_rows)]
+    old_set_ids = row_set_ids[len(site_rows):]
+    # New rows come first, so their token sets are the first ones
+    new_count = max(new_set_ids) + 1 if new_set_ids else 0
+    old_queries = sorted(set(old_set_ids))
+    shared_index = JaccardIndex({set_id: {"Preprocessed": token_set} for set_id, token_set in enumerate(token_sets)}, vocabulary)
+    new_index = MultiJaccardIndex(all_site_to_descs_preprocessed, vocabulary, index=shared_index)
+    old_index = MultiJaccardIndex(site_to_descs_preprocessed, vocabulary, index=shared_index)
+    new_query_groups = None
+    old_query_groups = None
+    if related is not None:
+        new_query_groups = related_groups(site_rows, new_set_ids, new_count, new_index.group_names, related)
+        old_query_groups = related_groups(old_site_rows, old_set_ids, len(token_sets), old_index.group_names, related)[old_queries]
+    return {"New Set Ids": new_set_ids, "Old Set Ids": old_set_ids, "New Count": new_count, "Shared Indexes": (shared_index, new_index, token_sets, old_queries, new_query_groups, old_index, old_query_groups),
+            "Old Index": old_index, "Old Query Groups": old_query_groups}
+
+def generate_jobs_both_ways(site_rows, old_site_rows, site_to_descs_preprocessed, all_site_to_descs_preprocessed, abbrevs=[], vocabulary=None, block_size=1000, processes=1, queue=None, cache=None, related=None, spill=None):
+    """Match new rows against all descriptions and old rows against new descriptions.
+
+    The Jaccard index is symmetric, so every pair of a new and an old token set is only scored
+    once, when matching the new rows, and the old rows get their scores from the transpose.
+
+    Arguments:
+    site_rows -- a list of dictionaries representing new rows
+    old_site_rows -- a list of dictionaries representing rows from previous output
+    site_to_descs_preprocessed -- The preprocess_all output for site_rows
+    all_site_to_descs_preprocessed -- The preprocess_all outputs for site_rows and old_site_rows, combined for each site
+    abbrevs -- a list of dictionaries with keys "Abbreviation" and "Expanded", or a matcher.Abbreviations
+    vocabulary -- The matcher.Vocabulary used by preprocess_all, if any
+    block_size (int) -- Amount of new token sets to score at a time. On a queue, the least amount, see queue_block_size.
+    processes (int) -- Amount of worker processes to score the blocks with
+    queue -- An rq Queue to score the blocks on instead, see score_blocks_on_queue
+    cache -- A DescriptionMatchCache to read known matches from and store new ones to. Both directions are then
+             matched separately for the token sets missing from the cache, in this process.
+    related -- A dictionary like related_sites returns to only match rows against the sites related to theirs, or None for all sites
+    spill -- A SpilledDescMatches to add the matches to block by block instead of returning them, see generate_jobs.
+             The blocks are then also made small enough to score within its memory budget.
+
+    Returns:
+    A tuple (new_jobs, old_jobs) of dictionaries like the ones generate_jobs returns, empty when spilling
+    """
+    indexes = both_ways_indexes(site_rows, old_site_rows, site_to_descs_preprocessed, all_site_to_descs_preprocessed, abbrevs, vocabulary, related)
+    new_set_ids, old_set_ids, new_count = indexes["New Set Ids"], indexes["Old Set Ids"], indexes["New Count"]
+    shared_index, new_index, token_sets, old_queries, new_query_groups, _, old_query_groups = indexes["Shared Indexes"]
+    if queue is not None and cache is None:
+        block_size = queue_block_size(queue, new_count, block_size)
+    if spill is not None:
+        block_size = min(block_size, block_size_for_memory(shared_index, token_sets[:new_count], spill.max_memory))
+        new_rows_by_set = sorted_by_set_id(site_rows, new_set_ids)
+        old_rows_by_set = sorted_by_set_id(old_site_rows, old_set_ids)
+    if cache is not None:
+        new_results = cached_most_matching_words(cache, token_sets[:new_count], all_site_to_descs_preprocessed, new_index, shared_index, abbrevs, block_size, new_query_groups)
+        # The old index only has the word sets of new descriptions, so intersections with old ones are ignored
+        old_results = cached_most_matching_words(cache, [token_sets[set_id] for set_id in old_queries], site_to_descs_preprocessed, indexes["Old Index"], shared_index, abbrevs, block_size, old_query_groups, "New")
+        if spill is None:
+            return jobs_from_results(site_rows, new_set_ids, new_results, related), jobs_from_results(old_site_rows, old_set_ids, dict(zip(old_queries, old_results)), related)
+        for start, end in split_blocks(new_count, block_size):
+            spill_results(spill, new_rows_by_set, range(start, end), new_results[start:end], all_site_to_descs_preprocessed, related)
+        for start, end in split_blocks(len(old_queries), block_size):
+            spill_results(spill, old_rows_by_set, old_queries[start:end], old_results[start:end], all_site_to_descs_preprocessed, related)
+        return {}, {}
+    if queue is not None:
+        blocks = score_blocks_on_queue(queue, site_rows, old_site_rows, abbrevs, new_count, block_size, related=related)
+    else:
+        blocks = score_blocks(indexes["Shared Indexes"], new_count, block_size, processes)
+    new_results = []
+    old_blocks = []
+    for (start, end), (block_results, old_block) in zip(split_blocks(new_count, block_size), blocks):
+        if spill is None:
+            new_results.extend(block_results)
+        else:
+            spill_results(spill, new_rows_by_set, range(start, end), block_results, all_site_to_descs_preprocessed, related)
+        old_blocks.append(old_block)
+    if old_blocks:
+        old_intersections = sparse.vstack(old_blocks).T.tocsr()
+    else:
+        old_intersections = sparse.csr_matrix((len(old_queries), 0), dtype=numpy.int32)
+    # Columns are the new token sets, which are the first ones of the shared index
+    old_intersections = sparse.csr_matrix((old_intersections.data, old_intersections.indices, old_intersections.indptr), shape=(len(old_queries), len(token_sets)))
+    old_query_sizes = [len(token_sets[set_id]) for set_id in old_queries]
+    if spill is None:
+        old_results = indexes["Old Index"].most_matching_words_from_intersections(old_intersections, old_query_sizes, 10, old_query_groups)
+        old_results = dict(zip(old_queries, old_results))
+        return jobs_from_results(site_rows, new_set_ids, new_results, related), jobs_from_results(old_site_rows, old_set_ids, old_results, related)
+    for start, end in split_blocks(len(old_queries), block_size):
+        block_groups = None if old_query_groups is None else old_query_groups[start:end]
+        block_results = indexes["Old Index"].most_matching_words_from_intersections(old_intersections[start:end], old_query_sizes[start:end], 10, block_groups)
+        spill_results(spill, old_rows_by_set, old_queries[start:end], block_results, all_site_to_descs_preprocessed, related)
+    return {}, {}
+
+def jobs_from_results(site_rows, row_set_ids, results, related=None):
+    """Fan the results of token sets out to the rows, in the format generate_jobs returns.
+
+    The results are only read from here on, so rows with the same token set share them. A token set
+    shared by rows of different sites may have results for sites related to either, so with related
+    given, each row only gets the sites related to its own.
     """
     jobs = {}
-    result_cache = {}
-    for row in site_rows:
-        row_jobs = {}
-        desc = row["Description"]
-        desc = desc.strip()
-        preprocessed = frozenset(preprocess(desc, abbrevs))
-        if preprocessed not in result_cache:
-                result_cache[preprocessed] = {}
-        for site in site_to_descs_preprocessed:
-            if site in result_cache[preprocessed]:
-                row_jobs[site] = copy.deepcopy(result_cache[preprocessed][site])
-            else:
-                row_jobs[site] = most_matching_words(preprocessed, site_to_descs_preprocessed[site], 10, words_to_exclude=set())
-                result_cache[preprocessed][site] = copy.deepcopy(row_jobs[site])
-        jobs[row["Stock & Site"]] = row_jobs
+    filtered = {}
+    for row, set_id in zip(site_rows, row_set_ids):
+        if related is None:
+            jobs[row["Stock & Site"]] = results[set_id]
+            continue
+        key = (set_id, row["Site"])
+        if key not in filtered:
+            filtered[key] = {site: result for site, result in results[set_id].items() if site in related[row["Site"]]}
+        jobs[row["Stock & Site"]] = filtered[key]
     return jobs
 
-def match_by_description(site_rows, old_site_rows):
+def sorted_by_set_id(site_rows, row_set_ids):
+    """Sort rows by token set id, so that spill_results can find the rows of a block of token sets.
+
+    Only the last row of each item is kept, as its results are the ones jobs_from_results keeps.
+
+    Returns:
+    A tuple with a list of rows and a numpy array of their token set ids, sorted by token set id
+    """
+    last_positions = {row["Stock & Site"]: position for position, row in enumerate(site_rows)}
+    positions = sorted(last_positions.values(), key=lambda position: row_set_ids[position])
+    return [site_rows[position] for position in positions], numpy.array([row_set_ids[position] for position in positions], dtype=numpy.int64)
+
+def spill_results(spill, rows_by_set, set_ids, results, all_site_to_descs_preprocessed, related=None):
+    """Fan the results of some token sets out to their rows like jobs_from_results, and add them to a SpilledDescMatches.
+
+    Arguments:
+    spill -- A SpilledDescMatches
+    rows_by_set -- Rows and their token set ids, see sorted_by_set_id
+    set_ids -- Increasing token set ids, with every token set of the rows between the first and the last one
+    results -- The results of the token sets in set_ids, in the same order
+    all_site_to_descs_preprocessed -- The descriptions to look the rows of matches up from, see jobs_to_desc_matches
+    related -- A dictionary like related_sites returns, or None
+    """
+    if len(set_ids) == 0:
+        return
+    rows, row_set_ids = rows_by_set
+    low, high = numpy.searchsorted(row_set_ids, [set_ids[0], set_ids[-1] + 1])
+    jobs = jobs_from_results(rows[low:high], row_set_ids[low:high].tolist(), dict(zip(set_ids, results)), related)
+    spill.add_jobs(jobs, all_site_to_descs_preprocessed)
+
+def preprocess_new_and_old(site_rows, old_site_rows, abbrevs=[], vocabulary=None):
+    """Run preprocess_all for new and old rows, and combine the two for each site with old descriptions taking precedence.
+
+    Returns:
+    A tuple with the preprocess_all outputs for site_rows, old_site_rows and both combined
+    """
+    site_to_descs_preprocessed = preprocess_all(site_rows, abbrevs=abbrevs, vocabulary=vocabulary)
+    old_site_to_descs_preprocessed = preprocess_all(old_site_rows, abbrevs=abbrevs, vocabulary=vocabulary)
+    all_site_to_descs_preprocessed = {}
+    for site in (set(site_to_descs_preprocessed.keys()) | set(old_site_to_descs_preprocessed.keys())):
+        combined = {**site_to_descs_preprocessed.get(site, {}), **old_site_to_descs_preprocessed.get(site, {})}
+        # Sorted like preprocess_all
+        all_site_to_descs_preprocessed[site] = dict(sorted(combined.items(), key=lambda item: item[0]))
+    return site_to_descs_preprocessed, old_site_to_descs_preprocessed, all_site_to_descs_preprocessed
+
+def match_by_description(site_rows, old_site_rows, lsh=None, processes=1, queue=None, cache=None, site_pruning=None, spill=None):
     """Given a list of site_rows, process them into a dictionary of the form
-    {"item_id1": {"site1": {"Matches": [...], "Scores": [...], "Stock & Site": [...]}, ...}, ...}.
+    {"item_id1": {"site1": (Match(...), ...), ...}, ...}.
 
     Arguments:
     site_rows -- a list of dictionaries representing rows
     old_site_rows -- a list of dictionaries representing rows from previous output
+    lsh -- A (bands, rows per band) tuple to use approximate MinHash LSH matching, or None for exact matching
+    processes (int) -- Amount of processes to use for exact matching
+    queue -- An rq Queue to distribute exact matching over its workers instead, see score_blocks_on_queue
+    cache -- A DescriptionMatchCache to reuse exact matches of earlier runs from
+    site_pruning -- A (top sites, minimum affinity) tuple to only match the rows of each site against the sites
+                    related to it, see related_sites, or None to match them against all other sites
+    spill -- A SpilledDescMatches to add the matches to as they are found instead of keeping them all in memory
 
     Returns:
-    A dict of dicts of dicts mapping item_ids to sites to matches.
+    A dict of dicts of dicts mapping item_ids to sites to matches, or spill with the matches added to it.
     """
-    abbrevs = file_utils.read_csv("desc_abbrevs.csv")
-    site_to_descs_preprocessed = preprocess_all(site_rows, abbrevs=abbrevs)
-    old_site_to_descs_preprocessed = preprocess_all(old_site_rows, abbrevs=abbrevs)
-    all_site_to_descs_preprocessed = {}
-    for site in (set(site_to_descs_preprocessed.keys()) | set(old_site_to_descs_preprocessed.keys())):
-        all_site_to_descs_preprocessed[site] = {}
-        if site in site_to_descs_preprocessed:
-            all_site_to_descs_preprocessed[site].update(site_to_descs_preprocessed[site])
-        if site in old_site_to_descs_preprocessed:
-            all_site_to_descs_preprocessed[site].update(old_site_to_descs_preprocessed[site])
-    desc_matches = {}
-    jobs_new_to_new = generate_jobs(site_rows, site_to_descs_preprocessed, abbrevs=abbrevs)
-    jobs_new_to_old = generate_jobs(site_rows, old_site_to_descs_preprocessed, abbrevs=abbrevs)
-    jobs_old_to_new = generate_jobs(old_site_rows, site_to_descs_preprocessed, abbrevs=abbrevs)
-    nn_desc_matches = jobs_to_desc_matches(jobs_new_to_new, all_site_to_descs_preprocessed)
-    no_desc_matches = jobs_to_desc_matches(jobs_new_to_old, all_site_to_descs_preprocessed)
-    on_desc_matches = jobs_to_desc_matches(jobs_old_to_new, all_site_to_descs_preprocessed)
-    desc_matches = combine_desc_matches(nn_desc_matches, no_desc_matches, 10)
-    desc_matches = combine_desc_matches(desc_matches, on_desc_matches, 10)
-    return desc_matches
+    abbrevs = compile_abbrevs(file_utils.read_csv("desc_abbrevs.csv"))
+    vocabulary = Vocabulary()
+    print("Token set compression ratio: " + str(round(compression_ratio(site_rows + old_site_rows, abbrevs), 2)))
+    site_to_descs_preprocessed, old_site_to_descs_preprocessed, all_site_to_descs_preprocessed = preprocess_new_and_old(site_rows, old_site_rows, abbrevs, vocabulary)
+    related = None
+    if site_pruning:
+        related = related_sites(all_site_to_descs_preprocessed, *site_pruning)
+        site_count = len(all_site_to_descs_preprocessed)
+        print("Matching " + str(sum(len(others) for others in related.values())) + " of " + str(site_count * (site_count - 1)) + " site pairs")
+    if lsh and spill is not None:
+        # Each direction is added separately, and they are combined when read
+        for rows, descs in [(site_rows, site_to_descs_preprocessed), (site_rows, old_site_to_descs_preprocessed), (old_site_rows, site_to_descs_preprocessed)]:
+            generate_jobs(rows, descs, abbrevs=abbrevs, vocabulary=vocabulary, lsh=lsh, related=related, spill=spill, all_site_to_descs_preprocessed=all_site_to_descs_preprocessed)
+        return spill.finish()
+    if lsh:
+        # LSH indexes are built for each site and direction separately
+        jobs_new_to_new = generate_jobs(site_rows, site_to_descs_preprocessed, abbrevs=abbrevs, vocabulary=vocabulary, lsh=lsh, related=related)
+        jobs_new_to_old = generate_jobs(site_rows, old_site_to_descs_preprocessed, abbrevs=abbrevs, vocabulary=vocabulary, lsh=lsh, related=related)
+        jobs_old_to_new = generate_jobs(old_site_rows, site_to_descs_preprocessed, abbrevs=abbrevs, vocabulary=vocabulary, lsh=lsh, related=related)
+        nn_desc_matches = jobs_to_desc_matches(jobs_new_to_new, all_site_to_descs_preprocessed)
+        no_desc_matches = jobs_to_desc_matches(jobs_new_to_old, all_site_to_descs_preprocessed)
+        on_desc_matches = jobs_to_desc_matches(jobs_old_to_new, all_site_to_descs_preprocessed)
+        desc_matches = combine_desc_matches(nn_desc_matches, no_desc_matches, 10)
+        return combine_desc_matches(desc_matches, on_desc_matches, 10)
+    # Matching new rows against new and old descriptions of a site at once gives the same top 10 as combining both
+    new_jobs, old_jobs = generate_jobs_both_ways(site_rows, old_site_rows, site_to_descs_preprocessed, all_site_to_descs_preprocessed, abbrevs=abbrevs, vocabulary=vocabulary, processes=processes, queue=queue, cache=cache, related=related, spill=spill)
+    if spill is not None:
+        return spill.finish()
+    new_desc_matches = jobs_to_desc_matches(new_jobs, all_site_to_descs_preprocessed)
+    old_desc_matches = jobs_to_desc_matches(old_jobs, all_site_to_descs_preprocessed)
+    # Only items found in both new and old rows need combining
+    return combine_desc_matches(new_desc_matches, old_desc_matches, 10)
 
 def jobs_to_desc_matches(jobs, all_site_to_descs_preprocessed):
     """Convert jobs to the matches format required by top_n_matches, mapping item_ids to sites to matches.
@@ -130,23 +855,25 @@ def jobs_to_desc_matches(jobs, all_site_to_descs_preprocessed):
     all_site_to_descs_preprocessed -- A dictionary of the format {"site": {"Stock Description": {"Preprocessed": ..., "Stock Code": ..., "Stock & Site": {...}}, ...}, ...}
 
     Returns:
-    A dict of dicts of dicts mapping item_ids to sites to matches.
+    A dict of dicts mapping item_ids to sites to tuples of Match records.
     """
     desc_matches = {}
+    # Items with the same tokens share their jobs, so they share the converted matches too.
+    # The jobs are kept alongside so that their ids are not reused while converting.
+    converted = {}
     for item_id, item_jobs in jobs.items():
+        item_matches = desc_matches.setdefault(str(item_id), {})
         for site, job in item_jobs.items():
-            results, scores = job
-            #results, scores = job.result()
-            if str(item_id) not in desc_matches:
-                desc_matches[str(item_id)] = {}
-            desc_matches[str(item_id)][site] = {"Matches": results, "Scores": scores, "Stock & Site": []}
-            for result in results:
-                stock_and_site = all_site_to_descs_preprocessed[site][result]["Stock & Site"]
-                desc_matches[str(item_id)][site]["Stock & Site"].append(stock_and_site)
+            key = (site, id(job))
+            if key not in converted:
+                results, scores = job
+                site_descs = all_site_to_descs_preprocessed[site]
+                converted[key] = (job, tuple(Match(result, score, site_descs[result]["Stock & Site"]) for result, score in zip(results, scores)))
+            item_matches[site] = converted[key][1]
     return desc_matches
 
 def combine_desc_matches(matches1, matches2, n):
-    """Combine description matches. Input and output is like {"item_id1": {"site1": {"Matches": [...], "Scores": [...], "Stock & Site": [...]}, ...}, ...}
+    """Combine description matches. Input and output is like {"item_id1": {"site1": (Match(...), ...), ...}, ...}
 
     Arguments:
     matches1, matches2 -- Lists of dictionaries mapping item_ids ("Stock & Site" fields) to sites to matches.
@@ -186,95 +913,156 @@ def top_n_matches(m1, m2, n):
     """Return the best n matches in m1 and m2.
 
     Arguments:
-    m1, m2 -- Dictionaries with keys "Matches", "Scores" and "Stock & Site" mapped to lists of equal length
+    m1, m2 -- Sequences of Match records
     n (integer) -- The amount of matches to return
 
     Returns:
-    A dictionary with keys "Matches", "Scores" and "Stock & Site" mapped to lists, combining m1 and m2 while removing duplicates. The lists are sorted and of length n.
+    A tuple of at most n Match records, best first, combining m1 and m2 while removing duplicates. The rows of duplicates are combined.
     """
-    all_matches = list(zip(m1["Matches"], m1["Scores"], m1["Stock & Site"])) + list(zip(m2["Matches"], m2["Scores"], m2["Stock & Site"]))
-    all_matches = sorted(all_matches, key = lambda match: float(match[1]), reverse = True)
-    #all_matches = list(OrderedDict.fromkeys(all_matches)) #Remove duplicates
-    descs = []
-    no_duplicate_matches = []
-    for match in all_matches:
-        if not match[0] in descs:
-            descs.append(match[0])
-            no_duplicate_matches.append(match)
-        else:
-            #Update our list of rows this description matches to
-            match_index = descs.index(match[0])
-            rows = no_duplicate_matches[match_index][2]
-            prev_match = no_duplicate_matches[match_index]
-            rows = rows.union(match[2])
-            new_match = (prev_match[0], prev_match[1], rows)
-            no_duplicate_matches[match_index] = new_match
-    result_matches = {"Matches": [], "Scores": [], "Stock & Site": []}
-    for match in no_duplicate_matches[:n]:
-        result_matches["Matches"].append(match[0])
-        result_matches["Scores"].append(match[1])
-        result_matches["Stock & Site"].append(match[2])
-    return result_matches
+    top = TopK(n)
+    for matches in (m1, m2):
+        for match in matches:
+            top.push(match.description, match.score, match.rows)
+    return tuple(Match(description, score, rows) for description, score, rows in top.results())
+
+class SpilledDescMatches(Mapping):
+    """Matches of items against sites, like match_by_description returns, spilled to a temporary SQLite file.
+
+    Matches are buffered in memory up to a budget and then written to the file. The same item and site
+    may be added more than once, e.g. once for each direction of matching, and the matches are then
+    combined when read, in the order they were added, like combine_desc_matches would combine them.
+    Call finish once everything is added, and close to delete the file.
+    """
+
+    # Rough size in bytes of a buffered list of matches besides its json text
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, max_memory, n=10):
+        """Arguments:
+        max_memory (int) -- Bytes of matches to buffer before writing them to the file
+        n (int) -- The amount of matches to keep when combining the matches of an item and site
+        """
+        self.max_memory = max_memory
+        self.n = n
+        self.directory = tempfile.TemporaryDirectory()
+        self.connection = sqlite3.connect(os.path.join(self.directory.name, "matches.sqlite"))
+        self.connection.execute("CREATE TABLE matches (item_id TEXT NOT NULL, site TEXT NOT NULL, matches TEXT NOT NULL)")
+        self.buffer = []
+        self.buffer_size = 0
+        self.writes = 0
+        # match_sites reads each item once for every site it has matches in
+        self.read_cache = LRUCache(maxsize=64)
+
+    def close(self):
+        self.connection.close()
+        self.directory.cleanup()
+
+    def add_jobs(self, jobs, all_site_to_descs_preprocessed):
+        """Add jobs like generate_jobs returns, see jobs_to_desc_matches."""
+        for item_id, item_matches in jobs_to_desc_matches(jobs, all_site_to_descs_preprocessed).items():
+            for site, matches in item_matches.items():
+                text = json.dumps([[match.description, match.score, sorted(match.rows)] for match in matches])
+                self.buffer.append((item_id, site, text))
+                self.buffer_size += len(text) + self.ENTRY_OVERHEAD
+        if self.buffer_size > self.max_memory:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered matches to the file."""
+        if self.buffer:
+            with self.connection:
+                self.connection.executemany("INSERT INTO matches (item_id, site, matches) VALUES (?, ?, ?)", self.buffer)
+            self.writes += 1
+        self.buffer = []
+        self.buffer_size = 0
+
+    def finish(self):
+        """Write the rest of the matches and index them for reading. Returns self."""
+        self.flush()
+        with self.connection:
+            self.connection.execute("CREATE INDEX IF NOT EXISTS matches_item_id ON matches (item_id)")
+        return self
+
+    def stats(self):
+        return {"Writes": self.writes, "Lists Of Matches": self.connection.execute("SELECT COUNT(*) FROM matches").fetchone()[0]}
+
+    def __getitem__(self, item_id):
+        item_matches = self.read_cache.get(item_id)
+        if item_matches is None:
+            item_matches = {}
+            for site, text in self.connection.execute("SELECT site, matches FROM matches WHERE item_id = ? ORDER BY rowid", (item_id,)):
+                matches = tuple(Match(description, score, frozenset(rows)) for description, score, rows in json.loads(text))
+                item_matches[site] = top_n_matches(item_matches[site], matches, self.n) if site in item_matches else matches
+            if not item_matches:
+                raise KeyError(item_id)
+            self.read_cache.put(item_id, item_matches)
+        return item_matches
+
+    def __iter__(self):
+        return (item_id for item_id, in self.connection.execute("SELECT DISTINCT item_id FROM matches"))
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(DISTINCT item_id) FROM matches").fetchone()[0]
 
 def rows_to_matches(rows):
     """Convert rows to matches format required by top_n_matches.
 
     Arguments:
-    rows -- list of dictionaries representing rows
+    rows -- list of dictionaries representing rows, sorted by "Match Number" like in generate_old_rows_index
 
     Returns:
-    Matches as a dictionary of the form {"Matches": [...], "Scores": [...], "Stock & Site": []}
+    A tuple of Match records
     """
-    matches = {"Matches": [], "Scores": [], "Stock & Site": []}
-    # Rows need to be sorted correctly for ["Stock & Site"][-1] to target the right match
-    rows = sorted(rows, key = lambda r: r["Match Number"])
+    # Position of each description in the lists below
+    positions = {}
+    descriptions = []
+    scores = []
+    match_rows = []
     for row in rows:
-        if not row["Match Description"] in matches["Matches"]:
-            matches["Scores"].append(float(row["Match Score"]))
-            matches["Matches"].append(row["Match Description"])
-            matches["Stock & Site"].append(set())
-        # else it should be the case that matches["Matches"][-1] == row["Match Description"] because of sorting
-        matches["Stock & Site"][-1].add(row["Match Stock & Site"])
-    return matches
+        position = positions.get(row["Match Description"])
+        if position is None:
+            position = positions[row["Match Description"]] = len(descriptions)
+            scores.append(float(row["Match Score"]))
+            descriptions.append(row["Match Description"])
+            match_rows.append(set())
+        match_rows[position].add(row["Match Stock & Site"])
+    return tuple(Match(description, score, frozenset(stock_and_sites)) for description, score, stock_and_sites in zip(descriptions, scores, match_rows))
 
-def find_rows_with_id_and_match_site(old_item_ids_to_rows, item_id, match_site):
-    """Given a dictionary mapping ids to lists of rows, find all rows with the given id and Match Site and return them in a list.
+def find_rows_with_id_and_match_site(old_rows_index, item_id, match_site):
+    """Find all rows with the given id and Match Site in an index of old rows.
 
     Arguments:
-    old_item_ids_to_rows -- a dictionary mapping ids to lists of row dictionaries. The rows should have a "Match Site" field.
-    item_id -- id to look for. Must be a key of old_item_ids_to_rows.
+    old_rows_index -- a dictionary mapping ids to match sites to lists of row dictionaries, like from generate_old_rows_index
+    item_id -- id to look for.
     match_site -- value of Match Site field to look for.
 
     Returns:
-    A list of row dictionaries with the desired id (normally "Stock & Site") and Match Site.
+    A list of row dictionaries with the desired id (normally "Stock & Site") and Match Site, sorted by "Match Number".
     """
-    results = []
-    if item_id in old_item_ids_to_rows:
-        for row in old_item_ids_to_rows[item_id]:
-            if row["Match Site"] == match_site:
-                results.append(row)
-    return results
+    return old_rows_index.get(item_id, {}).get(match_site, [])
 
-def match_sites(site_rows, old_rows=[], old_item_ids_to_rows={}, desc_matches={}, exclude_unchanged=True, top_n=10):
-    """Match rows to rows.
+def match_sites(site_rows, old_rows=[], old_rows_index={}, desc_matches={}, exclude_unchanged=True, top_n=10, lsh=None, processes=1, queue=None, site_pruning=None):
+    """Match rows to rows, yielding the rows with matches one at a time.
 
     Arguments:
     site_rows -- A list of rows represented by dictionaries
     old_rows -- A list of rows represented by dictionaries
-    old_item_ids_to_rows -- A dictionary mapping item ids ("Stock & Site") to rows
-    desc_matches -- A dict of dicts of dicts mapping item_ids to sites to matches.
+    old_rows_index -- A dictionary mapping item ids ("Stock & Site") to match sites to rows, see generate_old_rows_index
+    desc_matches -- A dict of dicts mapping item_ids to sites to tuples of Match records, or a SpilledDescMatches.
     exclude_unchanged (bool) -- If true, do not return rows which have not changed relative to old_site_rows
     top_n (int) -- Maximum amount of matches to return for each item
+    lsh -- A (bands, rows per band) tuple to use approximate MinHash LSH matching, or None for exact matching
+    processes (int) -- Amount of processes to use for matching descriptions
+    queue -- An rq Queue to distribute matching descriptions over its workers instead
+    site_pruning -- A (top sites, minimum affinity) tuple to only match each site against the sites related to it, see related_sites
 
-    Returns:
-    A list of dictionaries representing rows with matches.
+    Yields:
+    Dictionaries representing rows with matches.
     """
     rows = site_rows + old_rows
     if not desc_matches:
-        desc_matches = match_by_description(site_rows, old_rows)
-    final_rows = []
+        desc_matches = match_by_description(site_rows, old_rows, lsh=lsh, processes=processes, queue=queue, site_pruning=site_pruning)
     for row in rows:
-        row = copy.deepcopy(row)
         item_id = str(row["Stock & Site"])
         all_sites = set()
         if item_id in desc_matches:
@@ -282,7 +1070,7 @@ def match_sites(site_rows, old_rows=[], old_item_ids_to_rows={}, desc_matches={}
         for site in all_sites:
             if site == row["Site"]:
                 continue
-            old_rows = find_rows_with_id_and_match_site(old_item_ids_to_rows, item_id, site)
+            old_rows = find_rows_with_id_and_match_site(old_rows_index, item_id, site)
             old_matches = rows_to_matches(old_rows)
 
             row_base = {"Stock & Site": item_id, "Site": row["Site"], "Description": row["Description"], "Match Site": site}
@@ -293,82 +1081,411 @@ def match_sites(site_rows, old_rows=[], old_item_ids_to_rows={}, desc_matches={}
                     # Results unchanged for this site, skip to next one
                     continue
                 row_base["Old Row"] = "Unchanged"
-            else:
+            elif old_matches:
                 matches = top_n_matches(matches, old_matches, top_n)
                 for old_row in old_rows:
-                    old_row["Old Row"] = "Yes"
-                    final_rows.append(old_row)
+                    yield {**old_row, "Old Row": "Yes"}
                 row_base["Old Row"] = "No"
-            for i, (match, score, desc_match_rows) in enumerate(zip(matches["Matches"], matches["Scores"], matches["Stock & Site"])):
-                for match_row in desc_match_rows:
-                    new_row = {**row_base, "Match Description": match, "Match Stock & Site": match_row, "Match Score": str(score), "Match Number": str(i), "Matching Row Count": str(len(desc_match_rows))}
-                    #Prevent duplicate rows. TODO: Figure out how this happens.
-                    #if not new_row in final_rows:
-                    final_rows.append(new_row)
+            else:
+                # Matches from match_by_description are already best first without duplicates
+                matches = matches[:top_n]
+                row_base["Old Row"] = "No"
+            yield from matches_to_rows(row_base, matches)
+
+def matches_to_rows(row_base, matches):
+    """Return a row for every row of every match, with the fields of row_base.
+
+    Arguments:
+    row_base -- A dictionary with the fields shared by all rows, such as "Stock & Site" and "Match Site"
+    matches -- A sequence of Match records
 
+    Returns:
+    A list of dictionaries representing rows with matches.
+    """
+    rows = []
+    for i, (match, score, desc_match_rows) in enumerate(matches):
+        for match_row in desc_match_rows:
+            new_row = {**row_base, "Match Description": match, "Match Stock & Site": match_row, "Match Score": str(score), "Match Number": str(i), "Matching Row Count": str(len(desc_match_rows))}
+            #Prevent duplicate rows. TODO: Figure out how this happens.
+            #if not new_row in final_rows:
+            rows.append(new_row)
+    return rows
+
+def apply_delta(old_output_rows, delta_rows, top_n=5):
+    """Update previous output with added, changed and removed rows, recomputing only the affected lists of matches.
+
+    The list of matches of an item against a site is recomputed from an index of the current rows if the item
+    was added or changed, if one of its match descriptions lost a row, or if the site got new descriptions
+    and the list has room for more matches, already has one of them, or has a worse match than one of them.
+    Every other list is kept as it is.
+
+    Arguments:
+    old_output_rows -- A list of dictionaries representing rows of previous output, with the keys in OUTPUT_FIELDNAMES
+    delta_rows -- A list of dictionaries with the keys in INPUT_FIELDNAMES and "Change", one of DELTA_CHANGES
+    top_n (int) -- Maximum amount of matches in recomputed lists
+
+    Returns:
+    A list of dictionaries representing rows with matches for the items remaining after the changes.
+    """
+    abbrevs = compile_abbrevs(file_utils.read_csv("desc_abbrevs.csv"))
+    items = OrderedDict()
+    lists = OrderedDict()
+    for row in old_output_rows:
+        if row["Stock & Site"] not in items:
+            items[row["Stock & Site"]] = {"Site": row["Site"], "Stock & Site": row["Stock & Site"], "Description": row["Description"]}
+        lists.setdefault((row["Stock & Site"], row["Match Site"]), []).append(row)
+    for row in old_output_rows:
+        if row["Match Stock & Site"] not in items:
+            items[row["Match Stock & Site"]] = {"Site": row["Match Site"], "Stock & Site": row["Match Stock & Site"], "Description": row["Match Description"]}
+    # Descriptions that lost a row, and items to match again
+    gone = set()
+    changed = set()
+    for row in delta_rows:
+        change = row["Change"].strip().lower()
+        if change not in DELTA_CHANGES:
+            raise ValueError("Unknown change " + repr(row["Change"]) + " for " + row["Stock & Site"] + ", expected one of " + str(DELTA_CHANGES))
+        item_id = row["Stock & Site"]
+        if item_id in items:
+            old_item = items.pop(item_id)
+            gone.add((old_item["Site"], old_item["Description"]))
+        changed.discard(item_id)
+        if change != "removed":
+            items[item_id] = {"Site": row["Site"], "Stock & Site": item_id, "Description": row["Stock Description"].strip()}
+            changed.add(item_id)
+    site_to_descs_preprocessed = preprocess_all(list(items.values()), abbrevs=abbrevs)
+    added = {}
+    for item_id in changed:
+        site = items[item_id]["Site"]
+        added.setdefault(site, {})[items[item_id]["Description"]] = site_to_descs_preprocessed[site][items[item_id]["Description"]]
+    # Best score of every kept item against the descriptions added to each site
+    kept = [item_id for item_id in items if item_id not in changed]
+    kept_set_ids, kept_token_sets = canonical_token_sets([items[item_id] for item_id in kept], abbrevs)
+    best_added = MultiJaccardIndex(added).most_matching_words_batch(kept_token_sets, 1) if added else []
+    recompute = [(item_id, site) for item_id in items if item_id in changed for site in site_to_descs_preprocessed if site != items[item_id]["Site"]]
+    kept_lists = {}
+    for item_id, set_id in zip(kept, kept_set_ids):
+        for site in site_to_descs_preprocessed:
+            if site == items[item_id]["Site"]:
+                continue
+            rows = lists.get((item_id, site), [])
+            match_descs = {row["Match Description"] for row in rows}
+            affected = any((site, desc) in gone for desc in match_descs)
+            if site in added and not affected:
+                worst = min(float(row["Match Score"]) for row in rows) if rows else 0.0
+                _, best_scores = best_added[set_id][site]
+                affected = len(match_descs) < top_n or best_scores[0] > worst or not match_descs.isdisjoint(added[site])
+            if affected:
+                recompute.append((item_id, site))
+            else:
+                kept_lists[(item_id, site)] = rows
+    # Refill the affected lists from an index of every current description
+    recompute_ids = list(OrderedDict.fromkeys(item_id for item_id, _ in recompute))
+    set_ids, token_sets = canonical_token_sets([items[item_id] for item_id in recompute_ids], abbrevs)
+    results = MultiJaccardIndex(site_to_descs_preprocessed).most_matching_words_batch(token_sets, top_n)
+    item_results = {item_id: results[set_id] for item_id, set_id in zip(recompute_ids, set_ids)}
+    new_lists = {}
+    for item_id, site in recompute:
+        item = items[item_id]
+        results, scores = item_results[item_id][site]
+        matches = [Match(result, score, site_to_descs_preprocessed[site][result]["Stock & Site"]) for result, score in zip(results, scores)]
+        row_base = {"Stock & Site": item_id, "Site": item["Site"], "Description": item["Description"], "Match Site": site, "Old Row": "No"}
+        new_lists[(item_id, site)] = matches_to_rows(row_base, matches)
+    print("Delta: recomputed " + str(len(new_lists)) + " and kept " + str(len(kept_lists)) + " lists of matches")
+    final_rows = []
+    for item_id in items:
+        for site in site_to_descs_preprocessed:
+            key = (item_id, site)
+            final_rows.extend(kept_lists.get(key, new_lists.get(key, [])))
     return final_rows
 
-def match_sites_dataframe(dataframe, matches_json="", top_n=5):
+def match_sites_dataframe(dataframe, match_cache="", top_n=5, lsh=None, processes=1, queue=None, site_pruning=None, max_memory=None):
     '''
     Generates a dataframe of matched sites.
-    matches_json is an optional parameter for saving and loading slow to generate
+    match_cache is an optional parameter for saving and loading slow to generate
     description based matches.
     INPUTS:
      - dataframe
-     - matches_json -- A string representing the filename of a json file containing old matches to speed up processing
+     - match_cache -- A string representing the filename of a DescriptionMatchCache database to speed up processing
      - top_n (int) -- Maximum amount of matches to return for each item
+     - lsh -- A (bands, rows per band) tuple to use approximate MinHash LSH matching, or None for exact matching
+     - processes (int) -- Amount of processes to use for matching descriptions
+     - queue -- An rq Queue to distribute matching descriptions over its workers instead
+     - site_pruning -- A (top sites, minimum affinity) tuple to only match each site against the sites related to it, see related_sites
+     - max_memory (int) -- Bytes of description matches to hold in memory before spilling them to disk, see SpilledDescMatches. Default is no limit.
     OUTPUTS:
      - matches_df
     '''
+    matches_rows = match_sites_rows(dataframe, match_cache=match_cache, top_n=top_n, lsh=lsh, processes=processes, queue=queue, site_pruning=site_pruning, max_memory=max_memory)
+    return pandas.DataFrame(list(matches_rows), columns=OUTPUT_FIELDNAMES)
+
+def normalized_columns(dataframe):
+    """Normalize an input dataframe column by column into strings without extra whitespace.
+
+    Missing values become empty strings, and fields in ALL_FIELDNAMES missing from the dataframe
+    are filled with "-1" to mark they weren't originally there. Other columns are left out.
 
-    #Missing values should be represented by empty strings
-    dataframe = dataframe.fillna(value="")
+    Arguments:
+    dataframe -- A pandas DataFrame of input rows, old output rows or both
 
-    #Ensure we have the correct columns
-    dataframe = pandas.DataFrame(dataframe.to_dict("records"), columns=ALL_FIELDNAMES)
+    Returns:
+    A dictionary mapping the fields in ALL_FIELDNAMES to pandas Series of strings
+    """
+    columns = {}
+    for field in ALL_FIELDNAMES:
+        if field in dataframe.columns:
+            columns[field] = dataframe[field].fillna(value="").astype(str).str.strip()
+        else:
+            columns[field] = pandas.Series("-1", index=dataframe.index, dtype=object)
+    return columns
 
-    #Fill any columns we just added with "-1" to mark it wasn't originally there
-    dataframe = dataframe.fillna(value="-1")
+def columns_to_rows(columns, fieldnames, mask):
+    """Build row dictionaries with the given fields for the rows selected by a boolean mask.
 
-    #Make sure everything in that dataframe is a string
-    dataframe = dataframe.applymap(lambda x: str(x))
+    Arguments:
+    columns -- A dictionary mapping fields to pandas Series, like from normalized_columns
+    fieldnames -- The fields to include in the rows
+    mask -- A boolean pandas Series selecting the rows
 
-    #Remove extra whitespace
-    dataframe = dataframe.applymap(lambda x: x.strip() if type(x)==str else x)
+    Returns:
+    A list of dictionaries representing rows
+    """
+    values = [columns[field][mask].tolist() for field in fieldnames]
+    return [dict(zip(fieldnames, row_values)) for row_values in zip(*values)]
 
-    if "Match Site" in dataframe.columns:
-        ndf = dataframe[dataframe["Match Site"] == "-1"]
-        if ndf.empty:
-            #No new rows.
-            return pandas.DataFrame()
-        odf = dataframe[dataframe["Match Site"] != "-1"]
-        if odf.empty:
-            old_rows = []
-        else:
-            old_rows = odf.to_dict("records")
-        new_rows = ndf.to_dict("records")
-    else:
-        new_rows = dataframe.to_dict("records")
-        old_rows = []
-    # Add a 'Description' field to new_rows
-    site_rows = [{**row, "Description": row["Stock Description"]} for row in new_rows]
+def match_sites_rows(dataframe, match_cache="", top_n=5, lsh=None, processes=1, queue=None, site_pruning=None, max_memory=None):
+    '''
+    Generates rows of matched sites one at a time, so that they can be written out
+    without keeping all of them in memory. Takes the same arguments as match_sites_dataframe.
+    OUTPUTS:
+     - Dictionaries with the keys in OUTPUT_FIELDNAMES
+    '''
+
+    columns = normalized_columns(dataframe)
+    is_new = columns["Match Site"] == "-1"
+    if not is_new.any():
+        #No new rows.
+        return
+    # Only the fields match_sites reads, and the Description field it expects for new rows
+    site_rows = [{**row, "Description": row["Stock Description"]} for row in columns_to_rows(columns, ["Site", "Stock & Site", "Stock Description"], is_new)]
+    old_rows = columns_to_rows(columns, OUTPUT_FIELDNAMES, ~is_new)
     old_site_rows = remove_duplicate_rows(old_rows)
-    old_item_ids_to_rows = generate_item_ids_to_rows(old_rows)
+    old_rows_index = generate_old_rows_index(old_rows)
 
-    # Generate desc_matches based on matches_json
-    desc_matches = {}
-    if matches_json:
-        if file_utils.file_exists(matches_json):
-            desc_matches = file_utils.read_json(matches_json)
-        else:
-            desc_matches = match_by_description(site_rows, old_site_rows)
-            file_utils.save_json(matches_json, desc_matches)
+    spill = SpilledDescMatches(max_memory) if max_memory else None
+    try:
+        # Generate desc_matches reusing the matches in match_cache
+        desc_matches = {}
+        if match_cache:
+            cache = DescriptionMatchCache(match_cache)
+            try:
+                desc_matches = match_by_description(site_rows, old_site_rows, lsh=lsh, processes=processes, queue=queue, cache=cache, site_pruning=site_pruning, spill=spill)
+                print("Match cache stats: " + str(cache.stats()))
+            finally:
+                cache.close()
+        elif spill is not None:
+            desc_matches = match_by_description(site_rows, old_site_rows, lsh=lsh, processes=processes, queue=queue, site_pruning=site_pruning, spill=spill)
+        if spill is not None:
+            print("Spilled match stats: " + str(spill.stats()))
+
+        for row in match_sites(site_rows, old_site_rows, old_rows_index, desc_matches, top_n=top_n, lsh=lsh, processes=processes, queue=queue, site_pruning=site_pruning):
+            yield {field: row.get(field, "") for field in OUTPUT_FIELDNAMES}
+    finally:
+        if spill is not None:
+            spill.close()
+
+def rows_to_records(rows):
+    """Group consecutive output rows of the same item, match site and "Old Row" into records, one per list of matches.
 
-    matches_rows = match_sites(site_rows, old_site_rows, old_item_ids_to_rows, desc_matches, top_n=top_n)
-    matches_df = pandas.DataFrame(matches_rows, columns=OUTPUT_FIELDNAMES)
-    matches_df = matches_df.fillna(value="")
-    matches_df = matches_df[OUTPUT_FIELDNAMES]
-    return matches_df
+    Consecutive rows of the same match are stored as a single match with a list of the matching rows,
+    so records repeat neither the fields of the item nor those of the match.
+
+    Arguments:
+    rows -- An iterable of dictionaries with the keys in OUTPUT_FIELDNAMES, grouped like from match_sites_rows
+
+    Yields:
+    Dictionaries with the keys in RECORD_FIELDNAMES and "Matches", a list with a list of the values of
+    RECORD_MATCH_FIELDNAMES followed by the list of matching rows ("Match Stock & Site") for each match
+    """
+    record = None
+    for row in rows:
+        if record is None or any(record[field] != row[field] for field in RECORD_FIELDNAMES):
+            if record is not None:
+                yield record
+            record = {**{field: row[field] for field in RECORD_FIELDNAMES}, "Matches": []}
+        matches = record["Matches"]
+        match = [row[field] for field in RECORD_MATCH_FIELDNAMES]
+        if not matches or matches[-1][:-1] != match:
+            matches.append(match + [[]])
+        matches[-1][-1].append(row["Match Stock & Site"])
+    if record is not None:
+        yield record
+
+def records_to_rows(records):
+    """Expand records from rows_to_records back into output rows.
+
+    Arguments:
+    records -- An iterable of dictionaries like from rows_to_records
+
+    Yields:
+    Dictionaries with the keys in OUTPUT_FIELDNAMES
+    """
+    for record in records:
+        for match in record["Matches"]:
+            for match_row in match[-1]:
+                row = {**{field: record[field] for field in RECORD_FIELDNAMES}, **dict(zip(RECORD_MATCH_FIELDNAMES, match)), "Match Stock & Site": match_row}
+                yield {field: row[field] for field in OUTPUT_FIELDNAMES}
+
+def is_jsonl_output(filename):
+    """Return True if filename is output saved as json lines records, False if it is a csv file."""
+    with open(file_utils.add_path(filename), encoding="utf-8-sig") as f:
+        return f.read(1) == "{"
+
+def read_output(filename):
+    """Read output rows from a csv or json lines output file.
+
+    Arguments:
+    filename (string) -- Filename of output saved by save_output in either format
+
+    Returns:
+    A list of dictionaries with the keys in OUTPUT_FIELDNAMES
+    """
+    if is_jsonl_output(filename):
+        return list(records_to_rows(file_utils.read_jsonl(filename)))
+    return file_utils.read_csv(filename)
+
+def save_output(filename, rows, output_format="csv", chunk_size=100000):
+    """Save output rows sorted by "Stock & Site", without holding all of them in memory.
+
+    Arguments:
+    filename (string) -- Filename to save to
+    rows -- An iterable of dictionaries with the keys in OUTPUT_FIELDNAMES
+    output_format (string) -- "csv" for a row per matching row, sorted by output_row_key,
+    or "jsonl" for a record per list of matches, see rows_to_records, sorted by "Stock & Site", "Match Site" and match_list_key
+    chunk_size (int) -- Maximum amount of rows to sort in memory at a time, see file_utils.external_sort
+
+    Returns:
+    The amount of rows or records saved
+    """
+    if output_format == "jsonl":
+        # Rows of the same list of matches may be spread out, e.g. when read from a csv file
+        rows = file_utils.external_sort(rows, key=lambda row: (row["Stock & Site"], row["Match Site"]) + match_list_key(row), chunk_size=chunk_size)
+        return file_utils.save_jsonl(filename, rows_to_records(rows))
+    return file_utils.save_sorted_csv(filename, rows, key=output_row_key, fieldnames=OUTPUT_FIELDNAMES, chunk_size=chunk_size)
+
+def output_row_key(row):
+    """Sort key of output rows in csv files, "Stock & Site", "Match Stock & Site" and then match_list_key."""
+    return (row["Stock & Site"], row["Match Stock & Site"]) + match_list_key(row)
+
+def match_list_key(row):
+    """Sort key of the lists of matches of an item and match site.
+
+    Old rows kept as they were come first, like from match_sites. An item whose description was
+    edited has lists for both descriptions, which are kept apart so that their rows do not interleave.
+    The key covers every field telling rows apart, so sorting gives the same order whatever the input order.
+    """
+    return (row["Old Row"] != "Yes", row["Old Row"], row["Description"], int(row["Match Number"]))
+
+def memory_budget(max_memory):
+    """Split a memory budget between the parts of a row to row run that can be bounded.
+
+    Half of it is for matching descriptions, both for scoring them and for buffering the matches,
+    see SpilledDescMatches, a quarter for sorting the output and a quarter for the tokenization cache.
+    The rows and indexes themselves are not counted, so the process takes more memory than this.
+
+    Arguments:
+    max_memory (int) -- The budget in bytes
+
+    Returns:
+    A dictionary with keys "Matches" (bytes), "Sort Chunk" (amount of output rows, for save_output)
+    and "Tokenization Cache" (amount of entries, for matcher.TOKENIZATION_CACHE)
+    """
+    return {"Matches": max_memory // 2,
+            "Sort Chunk": max(max_memory // 4 // OUTPUT_ROW_SIZE, 1000),
+            "Tokenization Cache": max(max_memory // 4 // TOKENIZATION_ENTRY_SIZE, 1000)}
+
+def input_dataframe(sites_rows, old_rows):
+    """Combine input rows and old output rows into a dataframe for match_sites_rows.
+
+    Fields only one of them has are filled with "-1" in the other, which marks input rows
+    as new as they have no "Match Site".
+
+    Arguments:
+    sites_rows -- A list of dictionaries with the keys in INPUT_FIELDNAMES
+    old_rows -- A list of dictionaries with the keys in OUTPUT_FIELDNAMES, or an empty list
+
+    Returns:
+    A pandas DataFrame
+    """
+    ndf = pandas.DataFrame(sites_rows)
+    odf = pandas.DataFrame(old_rows)
+    all_columns = ndf.columns.union(odf.columns)
+    ndf = ndf.reindex(columns = all_columns, fill_value="-1")
+    odf = odf.reindex(columns = all_columns, fill_value="-1")
+    return pandas.concat([ndf, odf]).reset_index(drop=True)
+
+def match_sites_to_redis(sites_rows, old_rows, pages_key, top_n=5, page_size=1000, site_pruning=None, ttl=86400):
+    """rq task matching uploaded rows and saving the output rows to Redis in pages, see the /row_to_row endpoint of flask_api.
+
+    The output is sorted like in csv output files and saved as a Redis list with a json list of rows
+    for each page, so that a page can be served without loading the rest of the output.
+
+    Arguments:
+    sites_rows -- A list of dictionaries with the keys in INPUT_FIELDNAMES
+    old_rows -- A list of dictionaries with the keys in OUTPUT_FIELDNAMES from earlier output, or an empty list
+    pages_key (string) -- The Redis key to save the pages to, replacing any earlier pages
+    top_n (int) -- Maximum amount of matches to return for each item
+    page_size (int) -- Amount of rows in a page
+    site_pruning -- A (top sites, minimum affinity) tuple to only match each site against the sites related to it, see related_sites
+    ttl (int) -- Seconds to keep the pages for
+
+    Returns:
+    A dictionary with keys "Rows" and "Pages"
+    """
+    from rq import get_current_job
+    connection = get_current_job().connection
+    matches_rows = match_sites_rows(input_dataframe(sites_rows, old_rows), top_n=top_n, site_pruning=site_pruning)
+    connection.delete(pages_key)
+    count = 0
+    page = []
+    for row in file_utils.external_sort(matches_rows, key=output_row_key):
+        page.append(row)
+        count += 1
+        if len(page) == page_size:
+            connection.rpush(pages_key, json.dumps(page))
+            page = []
+    if page:
+        connection.rpush(pages_key, json.dumps(page))
+    connection.expire(pages_key, ttl)
+    return {"Rows": count, "Pages": connection.llen(pages_key)}
+
+def lsh_recall(site_rows, lsh, sample_size=100, seed=0):
+    """Measure how much of the exact matching the approximate LSH mode finds, on a random sample of rows.
+
+    Arguments:
+    site_rows -- a list of dictionaries representing rows
+    lsh -- A (bands, rows per band) tuple
+    sample_size (int) -- Amount of rows to match both ways
+    seed (int) -- Seed for picking the sample
+
+    Returns:
+    The fraction of the exact top 10 matches with a non-zero score that the LSH mode also returned.
+    """
+    abbrevs = compile_abbrevs(file_utils.read_csv("desc_abbrevs.csv"))
+    vocabulary = Vocabulary()
+    site_to_descs_preprocessed = preprocess_all(site_rows, abbrevs=abbrevs, vocabulary=vocabulary)
+    sample = random.Random(seed).sample(site_rows, min(sample_size, len(site_rows)))
+    exact_jobs = generate_jobs(sample, site_to_descs_preprocessed, abbrevs=abbrevs, vocabulary=vocabulary)
+    lsh_jobs = generate_jobs(sample, site_to_descs_preprocessed, abbrevs=abbrevs, vocabulary=vocabulary, lsh=lsh)
+    found = 0
+    total = 0
+    for item_id, item_jobs in exact_jobs.items():
+        for site, (results, scores) in item_jobs.items():
+            expected = {result for result, score in zip(results, scores) if score > 0}
+            found += len(expected.intersection(lsh_jobs[item_id][site][0]))
+            total += len(expected)
+    if total == 0:
+        return 1.0
+    return found / total
 
 def remove_duplicate_rows(rows):
     """Remove rows with duplicate "Stock & Site"
@@ -379,13 +1496,12 @@ def remove_duplicate_rows(rows):
     Returns:
     A list of rows with duplicate 'Stock & Site' rows removed
     """
-    item_ids = []
+    item_ids = set()
     new_rows = []
     for row in rows:
-        row = copy.deepcopy(row)
         item_id = row["Stock & Site"]
         if item_id not in item_ids:
-            item_ids.append(item_id)
+            item_ids.add(item_id)
             new_rows.append(row)
     return new_rows
 
@@ -393,42 +1509,85 @@ if __name__=="__main__":
     parser = argparse.ArgumentParser(description="Script to match similar rows in data from different sites.")
     parser.add_argument("filename", help="Filename of the csv file to process.")
     parser.add_argument("-o", "--output", help="Save output to file with the given filename. If argument is not present, the output is instead printed to console in an abbreviated form. If output file already exists, the new results are combined to the already existing ones.")
-    parser.add_argument("-d", "--match_data", help="Filename of json with old matches. If file already exists, read it. If file does not exist, create one based on the results of this run. Generating the description matches in match_data is by far the slowest part, so it is recommended to save it when expecting re-use.")
+    parser.add_argument("-d", "--match_data", help="Filename of an SQLite database caching description matches between runs, created if it does not exist. Matches against a site are only brought up to date with the descriptions added to it since, and matched again in full when descriptions were removed from it. Generating the description matches is by far the slowest part, so it is recommended to use it when expecting re-use. Not used with LSH matching.")
     parser.add_argument("-m", "--matches", help="Maximum amount of matches to return for each row. Default value is 5.", type=int, default=5)
+    parser.add_argument("-j", "--jobs", help="Amount of processes to match descriptions with. The output is the same for any amount. Default value is 1.", type=int, default=1)
+    parser.add_argument("-q", "--queue", help="Distribute matching over the rq workers serving this queue, using the Redis at REDISTOGO_URL. Start workers with run_worker.py.", choices=["high", "default", "low"])
+    parser.add_argument("-f", "--format", help="Format of the output file. csv has a row for every matching row, jsonl has a record for the matches of every item and site. Existing output is read in either format. Default is csv.", choices=["csv", "jsonl"], default="csv")
+    parser.add_argument("--convert", help="Convert filename, an output file in either format, to the format given with --format and save it to the output file.", action="store_true")
+    parser.add_argument("--delta", help="Treat filename as a delta file with a Change column of added, changed or removed, and apply it to the existing output file, recomputing only the affected matches.", action="store_true")
+    parser.add_argument("--related_sites", help="Only match each site against this many of the sites sharing the most vocabulary with it. Sites sharing no words with it are left out whenever --related_sites or --min_affinity is given. Default value is 0, matching against all sites.", type=int, default=0)
+    parser.add_argument("--min_affinity", help="Only match each site against sites whose vocabulary overlaps with its own by at least this much, measured as the Jaccard index of the sets of words of the two sites. Default value is 0.", type=float, default=0.0)
+    parser.add_argument("--max_memory", help="Memory budget in megabytes for the matches, output sorting and caches. Matches beyond it are spilled to a temporary file and combined at the end, so that large inputs can be matched on small machines. The input rows are not counted. Default is no limit.", type=int, default=0)
+    parser.add_argument("--lsh_bands", help="Use approximate MinHash LSH matching with this many bands. Much faster on large inputs, but some matches may be missed. Default is exact matching.", type=int, default=0)
+    parser.add_argument("--lsh_rows", help="Amount of hashes per LSH band. Higher values only match more similar descriptions. Default value is 2.", type=int, default=2)
+    parser.add_argument("--lsh_sample", help="Amount of rows to sample when measuring the recall of LSH matching against exact matching. Default value is 100, 0 skips the measurement.", type=int, default=100)
 
     args = parser.parse_args()
 
     sites_rows = file_utils.read_csv(args.filename)
     output_file = args.output
-    matches_json = args.match_data
-    if not matches_json:
-        matches_json = ""
+    match_cache = args.match_data
+    if not match_cache:
+        match_cache = ""
+    else:
+        try:
+            DescriptionMatchCache(match_cache).close()
+        except ValueError as e:
+            parser.error(str(e))
     top_n = args.matches
+    lsh = (args.lsh_bands, args.lsh_rows) if args.lsh_bands else None
+    site_pruning = (args.related_sites, args.min_affinity) if args.related_sites or args.min_affinity else None
+    max_memory = None
+    chunk_size = 100000
+    if args.max_memory:
+        budget = memory_budget(args.max_memory * 2**20)
+        max_memory = budget["Matches"]
+        chunk_size = budget["Sort Chunk"]
+        TOKENIZATION_CACHE.resize(min(TOKENIZATION_CACHE.maxsize, budget["Tokenization Cache"]))
+    queue = None
+    if args.queue:
+        import os
+        import urllib.parse as urlparse
+        from redis import Redis
+        from rq import Queue
+        urlparse.uses_netloc.append('redis')
+        url = urlparse.urlparse(os.getenv('REDISTOGO_URL'))
+        queue = Queue(args.queue, connection=Redis(host=url.hostname, port=url.port, db=0, password=url.password))
 
     stime = time.time()
 
-    if file_utils.file_exists(output_file):
-        old_rows = file_utils.read_csv(output_file)
+    if args.convert:
+        if not output_file:
+            parser.error("--convert needs an output file to save to")
+        save_output(output_file, read_output(args.filename), args.format, chunk_size)
+    elif args.delta:
+        if not file_utils.file_exists(output_file):
+            parser.error("--delta needs an existing output file to apply the changes to")
+        result_rows = apply_delta(read_output(output_file), sites_rows, top_n=top_n)
+        save_output(output_file, result_rows, args.format, chunk_size)
     else:
-        old_rows = []
+        if lsh and args.lsh_sample:
+            recall_rows = [{**row, "Description": row["Stock Description"]} for row in sites_rows]
+            print("LSH recall on " + str(min(args.lsh_sample, len(recall_rows))) + " sampled rows: " + str(lsh_recall(recall_rows, lsh, args.lsh_sample)))
 
-    ndf = pandas.DataFrame(sites_rows)
-    odf = pandas.DataFrame(old_rows)
-    all_columns = ndf.columns.union(odf.columns)
-    ndf = ndf.reindex(columns = all_columns, fill_value="-1")
-    odf = odf.reindex(columns = all_columns, fill_value="-1")
-    df = pandas.concat([ndf, odf]).reset_index(drop=True)
+        if file_utils.file_exists(output_file):
+            old_rows = read_output(output_file)
+        else:
+            old_rows = []
 
-    if output_file:
-        matches_df = match_sites_dataframe(df, matches_json=matches_json, top_n=top_n)
-        matches_df = matches_df.sort_values(by=["Stock & Site", "Match Stock & Site"])
-        result_rows = matches_df.to_dict("records")
-        file_utils.save_csv(output_file, result_rows, fieldnames=OUTPUT_FIELDNAMES)
-    else:
-        matches_df = match_sites_dataframe(df, top_n=top_n)
-    with pandas.option_context('display.max_rows', None, 'display.max_columns', None):  # more options can be specified also
-        print(matches_df.head(n=10))
+        df = input_dataframe(sites_rows, old_rows)
+
+        if output_file:
+            matches_rows = match_sites_rows(df, match_cache=match_cache, top_n=top_n, lsh=lsh, processes=args.jobs, queue=queue, site_pruning=site_pruning, max_memory=max_memory)
+            count = save_output(output_file, matches_rows, args.format, chunk_size)
+            print("Saved " + str(count) + " rows to " + output_file)
+        else:
+            matches_df = match_sites_dataframe(df, top_n=top_n, lsh=lsh, processes=args.jobs, queue=queue, site_pruning=site_pruning, max_memory=max_memory)
+            with pandas.option_context('display.max_rows', None, 'display.max_columns', None):  # more options can be specified also
+                print(matches_df.head(n=10))
 
     etime = time.time()
     ttime = etime-stime
+    print("Cache stats: " + str(cache_stats()))
     print('Time = ', ttime, 's')
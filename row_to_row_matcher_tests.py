@@ -1,7 +1,8 @@
 import unittest
 import random
 import string
-import copy
+import os
+import tempfile
 import pandas
 
 import row_to_row_matcher
@@ -423,55 +424,34 @@ class TopNMatchesUnitTest(unittest.TestCase):
         return matches
 
     def random_matches(self, n):
-        matches = {"Matches": [], "Scores": [], "Stock & Site": []}
-        for _ in range(n):
-            match = self.random_match()
-            matches["Matches"].append(match[0])
-            matches["Scores"].append(match[1])
-            matches["Stock & Site"].append(match[2])
-        return matches
+        return tuple(self.random_match() for _ in range(n))
 
     def random_match(self):
-        return ("".join(random.choices(string.ascii_lowercase, k=10)), random.uniform(0,1), {"".join(random.choices(string.ascii_lowercase, k=10)) for _ in range(random.randint(1,3))})
+        return row_to_row_matcher.Match("".join(random.choices(string.ascii_lowercase, k=10)), random.uniform(0,1), frozenset("".join(random.choices(string.ascii_lowercase, k=10)) for _ in range(random.randint(1,3))))
 
     def duplicate_match(self, matches):
-        matches = copy.deepcopy(matches)
-        i = random.randint(0, len(matches["Matches"])-1)
-        matches["Matches"].append(matches["Matches"][i])
-        matches["Scores"].append(matches["Scores"][i])
-        matches["Stock & Site"].append(matches["Stock & Site"][i])
-        return matches
+        i = random.randint(0, len(matches)-1)
+        return matches + (matches[i],)
 
     def duplicate_match_diff_stock_n_site(self, matches):
-        matches = copy.deepcopy(matches)
         matches = self.duplicate_match(matches)
-        for _ in range(random.randint(1,3)):
-            matches["Stock & Site"][-1].add("".join(random.choices(string.ascii_lowercase, k=10)))
-        return matches
+        extra_rows = {"".join(random.choices(string.ascii_lowercase, k=10)) for _ in range(random.randint(1,3))}
+        return matches[:-1] + (matches[-1]._replace(rows=matches[-1].rows | extra_rows),)
 
     def copy_match_m1_to_m2(self, m1, m2):
-        m2 = copy.deepcopy(m2)
-        m2["Matches"].append(m1["Matches"][0])
-        m2["Scores"].append(m1["Scores"][0])
-        m2["Stock & Site"].append(m1["Stock & Site"][0])
-        return m2
+        return m2 + (m1[0],)
 
     def assert_is_n_matches(self, matches, n):
-        self.assertEqual(len(matches["Matches"]), n)
-        self.assertEqual(len(matches["Scores"]), n)
-        self.assertEqual(len(matches["Stock & Site"]), n)
+        self.assertEqual(len(matches), n)
 
     def assert_each_match_has_at_least_one_stock_n_site(self, matches):
-        for rows in matches["Stock & Site"]:
-            self.assertTrue(len(rows) >= 1)
+        for match in matches:
+            self.assertTrue(len(match.rows) >= 1)
 
     def assert_has_no_duplicate_matches(self, matches):
-        match_tuples = []
-        for i in range(len(matches["Matches"])):
-            match_tuples.append((matches["Matches"][i], matches["Scores"][i], matches["Stock & Site"][i]))
         i = 0
-        for match in match_tuples:
-            for match2 in match_tuples:
+        for match in matches:
+            for match2 in matches:
                 if match == match2:
                     i += 1
             self.assertEqual(i, 1)
@@ -489,10 +469,10 @@ class TopNMatchesUnitTest(unittest.TestCase):
         for (m1, m2) in matches:
             n = random.randint(1, 40)
             matches = row_to_row_matcher.top_n_matches(m1, m2, n)
-            if n < len(m1["Matches"]) + len(m2["Matches"]):
+            if n < len(m1) + len(m2):
                 self.assert_is_n_matches(matches, n)
             else:
-                self.assert_is_n_matches(matches, len(m1["Matches"]) + len(m2["Matches"]))
+                self.assert_is_n_matches(matches, len(m1) + len(m2))
 
     def test_top_n_matches_returns_no_duplicate_matches(self):
         #Duplicates caused by same match appearing twice in same set of matches
@@ -519,6 +499,27 @@ class TopNMatchesUnitTest(unittest.TestCase):
             matches = row_to_row_matcher.top_n_matches(m1, m2, n)
             self.assert_has_no_duplicate_matches(matches)
 
+class OldRowsIndexTestCase(unittest.TestCase):
+    """Tests for generate_old_rows_index and rows_to_matches."""
+
+    def row(self, item_id, match_site, number, description, match_row):
+        return {"Stock & Site": item_id, "Match Site": match_site, "Match Number": str(number), "Match Description": description, "Match Score": "0.5", "Match Stock & Site": match_row}
+
+    def test_rows_indexed_by_item_and_match_site_in_match_number_order(self):
+        rows = [self.row("1", "A", n, "d" + str(n), "r" + str(n)) for n in (10, 2, 0)] + [self.row("1", "B", 0, "d", "r"), self.row("2", "A", 0, "d", "r")]
+        index = row_to_row_matcher.generate_old_rows_index(rows)
+        assert [row["Match Number"] for row in row_to_row_matcher.find_rows_with_id_and_match_site(index, "1", "A")] == ["0", "2", "10"]
+        assert len(row_to_row_matcher.find_rows_with_id_and_match_site(index, "1", "B")) == 1
+        assert row_to_row_matcher.find_rows_with_id_and_match_site(index, "2", "B") == []
+        assert row_to_row_matcher.find_rows_with_id_and_match_site(index, "3", "A") == []
+
+    def test_rows_of_a_repeated_match_go_to_that_match(self):
+        """Old output can have two lists for an item and site, so a description can come back after other ones."""
+        rows = [self.row("1", "A", 0, "bolt", "r1"), self.row("1", "A", 0, "nut", "r2"), self.row("1", "A", 1, "nut", "r3"), self.row("1", "A", 1, "bolt", "r4")]
+        index = row_to_row_matcher.generate_old_rows_index(rows)
+        matches = row_to_row_matcher.rows_to_matches(row_to_row_matcher.find_rows_with_id_and_match_site(index, "1", "A"))
+        assert matches == (row_to_row_matcher.Match("bolt", 0.5, frozenset({"r1", "r4"})), row_to_row_matcher.Match("nut", 0.5, frozenset({"r2", "r3"})))
+
 class MatchSitesTestCase(unittest.TestCase):
     """Tests for match_sites."""
 
@@ -529,59 +530,67 @@ class MatchSitesTestCase(unittest.TestCase):
 
     def test_returns_empty_list_if_empty(self):
         """If input list is empty, return an empty list."""
-        assert match_sites([]) == []
+        assert list(match_sites([])) == []
 
     def test_every_input_row_has_at_least_one_match(self):
         """All input rows should have at least one match in the output."""
-        assert len(match_sites(self.rows)) >= 2
+        assert len(list(match_sites(self.rows))) >= 2
         new_rows = self.rows+[{"Site": "3", "Stock & Site": "3", "Stock Code": "C", "Description": "Else"}]
-        assert len(match_sites(new_rows)) >= 3
+        assert len(list(match_sites(new_rows))) >= 3
 
     def test_all_matches_should_contain_keys(self):
         """All output matches should contain the keys 'Match Site', 'Old Row', 'Match Description', 'Match Stock & Site', 'Match Score', 'Match Number' and 'Matching Row Count'"""
         required_keys = ["Match Site", "Old Row", "Match Description", "Match Stock & Site", "Match Score", "Match Number", "Matching Row Count"]
         rows = [{"Site": "1", "Stock & Site": "1", "Stock Code": "A", "Description": "Thing"}, {"Site": "2", "Stock & Site": "1", "Stock Code": "A", "Description": "Thing"}, {"Site": "3", "Stock & Site": "1", "Stock Code": "A", "Description": "Thing"}]
-        output = match_sites(rows)
+        output = list(match_sites(rows))
         for match in output:
             assert all([key in match for key in required_keys])
 
     def test_identical_rows_should_match_perfectly(self):
         """Identical rows should match each other with a match score of 1.0."""
         rows = [{"Site": "1","Stock & Site": "1", "Stock Code": "A", "Description": "Thing"}, {"Site": "2","Stock & Site": "1", "Stock Code": "A", "Description": "Thing"}]
-        output = match_sites(rows)
+        output = list(match_sites(rows))
         expected_output = [{'Stock & Site': '1', 'Site': '1', 'Description': 'Thing', 'Match Site': '2', 'Old Row': 'No', 'Match Description': 'Thing', 'Match Stock & Site': '1', 'Match Score': '1.0', 'Match Number': '0', 'Matching Row Count': '1'}, {'Stock & Site': '1', 'Site': '2', 'Description': 'Thing', 'Match Site': '1', 'Old Row': 'No', 'Match Description': 'Thing', 'Match Stock & Site': '1', 'Match Score': '1.0', 'Match Number': '0', 'Matching Row Count': '1'}]
         for row in expected_output:
             assert row in output
 
+    def test_identical_rows_should_match_perfectly_with_lsh(self):
+        """Approximate LSH matching should always find identical rows."""
+        rows = [{"Site": "1","Stock & Site": "1", "Stock Code": "A", "Description": "Thing"}, {"Site": "2","Stock & Site": "1", "Stock Code": "A", "Description": "Thing"}]
+        output = list(match_sites(rows, lsh=(32, 2)))
+        assert len(output) == 2
+        for row in output:
+            assert row["Match Score"] == "1.0"
+
     def test_bad_match_should_score_zero(self):
         """If row has no valid matches, best match score should be 0.0."""
-        output = match_sites(self.rows)
+        output = list(match_sites(self.rows))
         for row in output:
             assert row["Match Score"] == "0.0"
 
-    # NOTE: matches_json functionality testing is currently left unimplemented. To facilitate testing, the functionality should be rewritten so that file reads and writes are done outside of match_sites
+    # NOTE: match_cache is tested through match_by_description in MatchByDescriptionTestCase, as match_sites_dataframe reads and writes the file itself
 
     def test_does_not_return_old_rows_if_exclude_unchanged_true(self):
         """If exclude_unchanged == True, and all rows are old, return an empty list."""
         # Note that currently if only some matches are old, exclude_unchanged is ignored for that site, all old matches are kept and marked "Old Row": "Yes" rather than "Unchanged"
-        output = match_sites(self.rows)
-        old_item_ids_to_rows = {output[0]["Stock & Site"]: [output[0]], output[1]["Stock & Site"]: [output[1]]}
-        assert match_sites(self.rows, old_item_ids_to_rows=old_item_ids_to_rows, exclude_unchanged=True) == []
+        output = list(match_sites(self.rows))
+        old_rows_index = row_to_row_matcher.generate_old_rows_index(output[:2])
+        assert list(match_sites(self.rows, old_rows_index=old_rows_index, exclude_unchanged=True)) == []
 
     def test_rows_marked_unchanged_if_exclude_unchanged_false(self):
         """If exclude_unchanged == False, and all rows are old, return them with "Old Row": "Unchanged"."""
-        output = match_sites(self.rows)
-        old_item_ids_to_rows = {output[0]["Stock & Site"]: [output[0]], output[1]["Stock & Site"]: [output[1]]}
-        new_output = match_sites(self.rows, old_item_ids_to_rows=old_item_ids_to_rows, exclude_unchanged=False)
+        output = list(match_sites(self.rows))
+        old_rows_index = row_to_row_matcher.generate_old_rows_index(output[:2])
+        new_output = list(match_sites(self.rows, old_rows_index=old_rows_index, exclude_unchanged=False))
         for row in new_output:
             assert  row["Old Row"] == "Unchanged"
 
     def test_if_some_old_and_some_new_old_row_should_be_yes_or_no(self):
         """If some rows are old and some new, and exclude_unchanged == True, all rows should have "Old Row": "Yes" or "No" but not "Unchanged"."""
-        output = match_sites(self.rows)
-        old_item_ids_to_rows = {output[0]["Stock & Site"]: [output[0]], output[1]["Stock & Site"]: [output[1]]}
+        output = list(match_sites(self.rows))
+        old_rows_index = row_to_row_matcher.generate_old_rows_index(output[:2])
         new_rows = self.rows+[{"Site": "2", "Stock & Site": "3", "Stock Code": "C", "Description": "Else"}]
-        new_output = match_sites(new_rows, old_rows=output, old_item_ids_to_rows=old_item_ids_to_rows)
+        new_output = list(match_sites(new_rows, old_rows=output, old_rows_index=old_rows_index))
         assert any([row["Old Row"] == "Yes" for row in new_output])
         assert any([row["Old Row"] == "No" for row in new_output])
         for row in new_output:
@@ -590,6 +599,441 @@ class MatchSitesTestCase(unittest.TestCase):
     # UNTESTED: if some rows are old and some new, all old rows are preserved. Note that as far as I can tell sometimes old rows might appear twice, once with "Old Row": "Yes" as a preserved row,
     # and once with "Old Row": "No" as a "new" match (this happens if no better match was found.)
 
+class MatchByDescriptionTestCase(unittest.TestCase):
+    """Tests for match_by_description."""
+
+    def random_rows(self, n, words, sites):
+        rows = []
+        for i in range(n):
+            description = " ".join(random.sample(words, random.randint(1, 4)))
+            site = random.choice(sites)
+            rows.append({"Site": site, "Stock & Site": str(random.randint(0, 2*n)) + " " + site, "Description": random.choice([description, description.upper() + ","])})
+        return rows
+
+    def test_same_as_matching_each_direction_separately(self):
+        """Scoring each pair of new and old descriptions once should give the same matches as matching new to new, new to old and old to new separately."""
+        words = ["bolt", "nut", "hex", "washer", "m10", "m12", "steel", "brass", "seal", "ring"]
+        for _ in range(5):
+            site_rows = self.random_rows(60, words, ["A", "B", "C"])
+            old_site_rows = self.random_rows(80, words, ["B", "C", "D"])
+            abbrevs = row_to_row_matcher.compile_abbrevs(row_to_row_matcher.file_utils.read_csv("desc_abbrevs.csv"))
+            new_descs, _, all_descs = row_to_row_matcher.preprocess_new_and_old(site_rows, old_site_rows, abbrevs)
+            # Tied matches are ordered by description, so new rows are matched against all descriptions at once
+            passes = [(site_rows, all_descs), (old_site_rows, new_descs)]
+            expected = {}
+            for rows, descs in passes:
+                jobs = row_to_row_matcher.generate_jobs(rows, descs, abbrevs)
+                expected = row_to_row_matcher.combine_desc_matches(expected, row_to_row_matcher.jobs_to_desc_matches(jobs, all_descs), 10)
+            assert row_to_row_matcher.match_by_description(site_rows, old_site_rows) == expected
+
+    def test_same_results_with_worker_processes(self):
+        """Scoring blocks in worker processes should give exactly the serial results."""
+        words = ["bolt", "nut", "hex", "washer", "m10", "m12", "steel", "brass", "seal", "ring"]
+        site_rows = self.random_rows(100, words, ["A", "B", "C"])
+        old_site_rows = self.random_rows(100, words, ["B", "C", "D"])
+        new_descs, _, all_descs = row_to_row_matcher.preprocess_new_and_old(site_rows, old_site_rows)
+        serial = row_to_row_matcher.generate_jobs_both_ways(site_rows, old_site_rows, new_descs, all_descs, block_size=7)
+        assert row_to_row_matcher.generate_jobs_both_ways(site_rows, old_site_rows, new_descs, all_descs, block_size=7, processes=3) == serial
+
+    def test_same_results_on_rq_queue(self):
+        """Scoring blocks as rq tasks should give exactly the local results."""
+        try:
+            import fakeredis
+            from rq import Queue
+        except ImportError:
+            self.skipTest("rq and fakeredis are needed to run rq tasks locally")
+        words = ["bolt", "nut", "hex", "washer", "m10", "m12", "steel", "brass", "seal", "ring"]
+        site_rows = self.random_rows(100, words, ["A", "B", "C"])
+        old_site_rows = self.random_rows(100, words, ["B", "C", "D"])
+        new_descs, _, all_descs = row_to_row_matcher.preprocess_new_and_old(site_rows, old_site_rows)
+        local = row_to_row_matcher.generate_jobs_both_ways(site_rows, old_site_rows, new_descs, all_descs, block_size=7)
+        queue = Queue(is_async=False, connection=fakeredis.FakeRedis())
+        assert row_to_row_matcher.generate_jobs_both_ways(site_rows, old_site_rows, new_descs, all_descs, block_size=7, queue=queue) == local
+        assert queue.connection.keys("row_to_row:*") == []
+
+    def test_queue_blocks_split_between_workers(self):
+        """Every queued task builds the indexes, so there should be one block per worker listening on the queue."""
+        try:
+            import fakeredis
+            from rq import Queue, Worker
+        except ImportError:
+            self.skipTest("rq and fakeredis are needed to run rq tasks locally")
+        queue = Queue(is_async=False, connection=fakeredis.FakeRedis())
+        assert row_to_row_matcher.queue_block_size(queue, 20, 1) == 20
+        for _ in range(3):
+            Worker([queue], connection=queue.connection).register_birth()
+        assert row_to_row_matcher.queue_block_size(queue, 20, 1) == 7
+        assert row_to_row_matcher.queue_block_size(queue, 20, 10) == 10
+        assert row_to_row_matcher.queue_block_size(queue, 0, 0) == 1
+        words = ["bolt", "nut", "hex", "washer", "m10", "m12", "steel", "brass", "seal", "ring"]
+        site_rows = self.random_rows(100, words, ["A", "B", "C"])
+        old_site_rows = self.random_rows(100, words, ["B", "C", "D"])
+        new_descs, _, all_descs = row_to_row_matcher.preprocess_new_and_old(site_rows, old_site_rows)
+        local = row_to_row_matcher.generate_jobs_both_ways(site_rows, old_site_rows, new_descs, all_descs)
+        assert row_to_row_matcher.generate_jobs_both_ways(site_rows, old_site_rows, new_descs, all_descs, block_size=1, queue=queue) == local
+
+    def test_queued_run_outlives_its_ttl_while_checked(self):
+        """Tasks waiting in the queue longer than the TTL of the run should still find its rows, and the rows should be deleted after the run."""
+        try:
+            import fakeredis
+            from rq import Queue, SimpleWorker
+        except ImportError:
+            self.skipTest("rq and fakeredis are needed to run rq tasks locally")
+        import threading
+        import time
+        words = ["bolt", "nut", "hex", "washer", "m10", "m12", "steel", "brass", "seal", "ring"]
+        site_rows = self.random_rows(50, words, ["A", "B", "C"])
+        old_site_rows = self.random_rows(50, words, ["B", "C", "D"])
+        new_descs, _, all_descs = row_to_row_matcher.preprocess_new_and_old(site_rows, old_site_rows)
+        local = row_to_row_matcher.generate_jobs_both_ways(site_rows, old_site_rows, new_descs, all_descs)
+        queue = Queue(connection=fakeredis.FakeRedis())
+        results = []
+        ttl = row_to_row_matcher.QUEUED_RUN_TTL
+        # Checked every second, so the rows outlive the wait only by being refreshed
+        row_to_row_matcher.QUEUED_RUN_TTL = 2
+        try:
+            coordinator = threading.Thread(target=lambda: results.append(row_to_row_matcher.generate_jobs_both_ways(site_rows, old_site_rows, new_descs, all_descs, queue=queue)))
+            coordinator.start()
+            time.sleep(4)
+            SimpleWorker([queue], connection=queue.connection).work(burst=True)
+            coordinator.join()
+        finally:
+            row_to_row_matcher.QUEUED_RUN_TTL = ttl
+        assert results == [local]
+        assert queue.connection.keys("row_to_row:*") == []
+
+    def test_same_results_with_cache(self):
+        """Matches read from the cache should be the same as computed ones, and only new descriptions and changed sites should be matched again."""
+        words = ["bolt", "nut", "hex", "washer", "m10", "m12", "steel", "brass", "seal", "ring"]
+        site_rows = self.random_rows(60, words, ["A", "B", "C"])
+        old_site_rows = self.random_rows(60, words, ["B", "C", "D"])
+        cache = row_to_row_matcher.DescriptionMatchCache(":memory:")
+        expected = row_to_row_matcher.match_by_description(site_rows, old_site_rows)
+        assert row_to_row_matcher.match_by_description(site_rows, old_site_rows, cache=cache) == expected
+        misses = cache.misses
+        assert row_to_row_matcher.match_by_description(site_rows, old_site_rows, cache=cache) == expected
+        assert cache.misses == misses
+        more_rows = site_rows + [{"Site": "A", "Stock & Site": "new A", "Description": "hex nut m12 seal ring"}]
+        assert row_to_row_matcher.match_by_description(more_rows, old_site_rows, cache=cache) == row_to_row_matcher.match_by_description(more_rows, old_site_rows)
+        assert cache.misses > misses
+        cache.close()
+
+    def test_cache_updated_for_added_descriptions(self):
+        """Adding descriptions to a site should only match its entries against the added ones, and removing some should match them again in full."""
+        words = ["bolt", "nut", "hex", "washer", "m10", "m12", "steel", "brass", "seal", "ring"]
+        site_rows = self.random_rows(60, words, ["A", "B", "C"])
+        old_site_rows = self.random_rows(60, words, ["B", "C", "D"])
+        cache = row_to_row_matcher.DescriptionMatchCache(":memory:")
+        row_to_row_matcher.match_by_description(site_rows, old_site_rows, cache=cache)
+        stats = cache.stats()
+        # The order of the rows does not matter
+        assert row_to_row_matcher.match_by_description(site_rows[::-1], old_site_rows[::-1], cache=cache) == row_to_row_matcher.match_by_description(site_rows[::-1], old_site_rows[::-1])
+        assert (cache.stats()["Updates"], cache.stats()["Misses"]) == (stats["Updates"], stats["Misses"])
+        stats = cache.stats()
+        more_old_rows = [{"Site": "B", "Stock & Site": "new B", "Description": "ring seal nut washer bolt"}] + old_site_rows[::-1]
+        assert row_to_row_matcher.match_by_description(site_rows, more_old_rows, cache=cache) == row_to_row_matcher.match_by_description(site_rows, more_old_rows)
+        assert cache.stats()["Updates"] > stats["Updates"]
+        assert cache.stats()["Hits"] > stats["Hits"]
+        # At most the token set of the added row is matched in full, against the sites of new rows
+        assert cache.stats()["Misses"] - stats["Misses"] <= 3
+        stats = cache.stats()
+        removed = next(row["Description"] for row in old_site_rows if row["Site"] == "D")
+        fewer_old_rows = [row for row in old_site_rows if row["Site"] != "D" or row["Description"] != removed]
+        assert row_to_row_matcher.match_by_description(site_rows, fewer_old_rows, cache=cache) == row_to_row_matcher.match_by_description(site_rows, fewer_old_rows)
+        assert cache.stats()["Misses"] > stats["Misses"]
+        cache.close()
+
+    def test_cache_file_checks(self):
+        """Only match caches should be opened, and only caches of older versions emptied."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            json_file = os.path.join(tmpdir, "match_data.json")
+            with open(json_file, "w") as f:
+                f.write('{"A": {}}')
+            with self.assertRaises(ValueError):
+                row_to_row_matcher.DescriptionMatchCache(json_file)
+            other_file = os.path.join(tmpdir, "other.db")
+            connection = row_to_row_matcher.sqlite3.connect(other_file)
+            connection.execute("CREATE TABLE matches (id INTEGER)")
+            connection.commit()
+            connection.close()
+            with self.assertRaises(ValueError):
+                row_to_row_matcher.DescriptionMatchCache(other_file)
+            connection = row_to_row_matcher.sqlite3.connect(other_file)
+            assert connection.execute("SELECT name FROM sqlite_master").fetchall() == [("matches",)]
+            connection.close()
+            old_file = os.path.join(tmpdir, "old.db")
+            connection = row_to_row_matcher.sqlite3.connect(old_file)
+            connection.execute(row_to_row_matcher.DescriptionMatchCache.VERSION_1_SCHEMA)
+            connection.commit()
+            connection.close()
+            cache = row_to_row_matcher.DescriptionMatchCache(old_file)
+            cache.put_many([("key", "version", (["a"], [1.0]))])
+            cache.close()
+            cache = row_to_row_matcher.DescriptionMatchCache(old_file)
+            assert cache.get_many(["key"]) == {"key": ("version", (["a"], [1.0]))}
+            cache.close()
+
+class SpilledDescMatchesTestCase(unittest.TestCase):
+    """Tests for spilling description matches to disk with SpilledDescMatches."""
+
+    words = ["bolt", "nut", "hex", "washer", "m10", "m12", "steel", "brass", "seal", "ring"]
+
+    def random_rows(self, n, sites):
+        rows = []
+        for i in range(n):
+            site = random.choice(sites)
+            rows.append({"Site": site, "Stock & Site": str(random.randint(0, 2*n)) + " " + site, "Description": " ".join(random.sample(self.words, random.randint(1, 4)))})
+        return rows
+
+    def sorted_rows(self, rows):
+        # Match sites of an item come in set order, which may differ between runs
+        return sorted(rows, key=lambda row: [row[field] for field in row_to_row_matcher.OUTPUT_FIELDNAMES])
+
+    def read_all(self, spill):
+        return {item_id: spill[item_id] for item_id in spill}
+
+    def test_same_matches_as_in_memory(self):
+        """Matches spilled to disk and combined when read should be the same as the ones kept in memory."""
+        site_rows = self.random_rows(80, ["A", "B", "C"])
+        old_site_rows = self.random_rows(80, ["B", "C", "D"])
+        for lsh in (None, (16, 2)):
+            for site_pruning in (None, (2, 0.0)):
+                expected = row_to_row_matcher.match_by_description(site_rows, old_site_rows, lsh=lsh, site_pruning=site_pruning)
+                spill = row_to_row_matcher.SpilledDescMatches(max_memory=2000)
+                assert row_to_row_matcher.match_by_description(site_rows, old_site_rows, lsh=lsh, site_pruning=site_pruning, spill=spill) is spill
+                assert spill.stats()["Writes"] > 1
+                assert self.read_all(spill) == expected
+                spill.close()
+        cache = row_to_row_matcher.DescriptionMatchCache(":memory:")
+        spill = row_to_row_matcher.SpilledDescMatches(max_memory=2000)
+        expected = row_to_row_matcher.match_by_description(site_rows, old_site_rows)
+        assert self.read_all(row_to_row_matcher.match_by_description(site_rows, old_site_rows, cache=cache, spill=spill)) == expected
+        spill.close()
+        cache.close()
+
+    def test_same_matches_in_blocks(self):
+        """Spilling the results of each block of token sets should give the same matches as converting all of them at once."""
+        site_rows = self.random_rows(100, ["A", "B", "C"])
+        old_site_rows = self.random_rows(100, ["B", "C", "D"])
+        new_descs, _, all_descs = row_to_row_matcher.preprocess_new_and_old(site_rows, old_site_rows)
+        new_jobs, old_jobs = row_to_row_matcher.generate_jobs_both_ways(site_rows, old_site_rows, new_descs, all_descs, block_size=7)
+        expected = row_to_row_matcher.combine_desc_matches(row_to_row_matcher.jobs_to_desc_matches(new_jobs, all_descs), row_to_row_matcher.jobs_to_desc_matches(old_jobs, all_descs), 10)
+        for processes in (1, 3):
+            spill = row_to_row_matcher.SpilledDescMatches(max_memory=10**6)
+            assert row_to_row_matcher.generate_jobs_both_ways(site_rows, old_site_rows, new_descs, all_descs, block_size=7, processes=processes, spill=spill) == ({}, {})
+            assert self.read_all(spill.finish()) == expected
+            spill.close()
+        expected = row_to_row_matcher.jobs_to_desc_matches(row_to_row_matcher.generate_jobs(site_rows, new_descs, lsh=(16, 2)), all_descs)
+        spill = row_to_row_matcher.SpilledDescMatches(max_memory=10**6)
+        row_to_row_matcher.generate_jobs(site_rows, new_descs, lsh=(16, 2), spill=spill, all_site_to_descs_preprocessed=all_descs, block_size=7)
+        assert self.read_all(spill.finish()) == expected
+        spill.close()
+
+    def test_same_output_rows(self):
+        """Output rows should not depend on the memory budget, for new rows and for new rows combined with old output."""
+        rows = [{"Site": row["Site"], "Stock & Site": row["Stock & Site"], "Stock Description": row["Description"]} for row in self.random_rows(60, ["A", "B", "C"])]
+        df = pandas.DataFrame(rows[:40])
+        output = list(row_to_row_matcher.match_sites_rows(df))
+        assert self.sorted_rows(row_to_row_matcher.match_sites_rows(df, max_memory=2000)) == self.sorted_rows(output)
+        # Fields missing from either part are filled with "-1" like in the command line script
+        new_df, old_df = pandas.DataFrame(rows[40:]), pandas.DataFrame(output)
+        columns = new_df.columns.union(old_df.columns)
+        df = pandas.concat([new_df.reindex(columns=columns, fill_value="-1"), old_df.reindex(columns=columns, fill_value="-1")]).reset_index(drop=True)
+        output = list(row_to_row_matcher.match_sites_rows(df))
+        assert any(row["Old Row"] == "Yes" for row in output)
+        assert self.sorted_rows(row_to_row_matcher.match_sites_rows(df, max_memory=2000)) == self.sorted_rows(output)
+
+class NormalizedColumnsTestCase(unittest.TestCase):
+    """Tests for normalized_columns and columns_to_rows."""
+
+    def test_same_as_normalizing_each_value(self):
+        """Values should become stripped strings, missing values empty strings and missing columns "-1"."""
+        df = pandas.DataFrame({"Site": [" A ", None, 3], "Stock & Site": [1.5, float("nan"), "x "], "Extra": [1, 2, 3]})
+        columns = row_to_row_matcher.normalized_columns(df)
+        assert set(columns) == set(row_to_row_matcher.ALL_FIELDNAMES)
+        rows = row_to_row_matcher.columns_to_rows(columns, ["Site", "Stock & Site", "Match Site"], pandas.Series([True, True, True]))
+        assert rows == [{"Site": "A", "Stock & Site": "1.5", "Match Site": "-1"},
+                        {"Site": "", "Stock & Site": "", "Match Site": "-1"},
+                        {"Site": "3", "Stock & Site": "x", "Match Site": "-1"}]
+        assert row_to_row_matcher.columns_to_rows(columns, ["Site"], pandas.Series([False, True, False])) == [{"Site": ""}]
+
+class ApplyDeltaTestCase(unittest.TestCase):
+    """Tests for apply_delta."""
+
+    def score_lists(self, output_rows):
+        lists = {}
+        for row in output_rows:
+            lists.setdefault((row["Stock & Site"], row["Match Site"]), {})[row["Match Description"]] = float(row["Match Score"])
+        return {key: sorted(matches.values(), reverse=True) for key, matches in lists.items()}
+
+    def test_same_scores_as_matching_from_scratch(self):
+        """Every list of matches should score the same as when matching the changed rows from scratch, and removed rows should not appear."""
+        words = ["bolt", "nut", "hex", "washer", "m10", "m12", "steel", "brass", "seal", "ring"]
+        for _ in range(5):
+            rows = []
+            for i in range(80):
+                site = random.choice(["A", "B", "C"])
+                rows.append({"Site": site, "Stock & Site": str(i) + " " + site, "Description": " ".join(random.sample(words, random.randint(1, 4)))})
+            old_output = list(row_to_row_matcher.match_sites(rows, top_n=5))
+            delta = []
+            new_rows = []
+            for row in rows:
+                change = random.choice(["removed", "changed", None, None, None, None, None, None])
+                if change == "changed":
+                    row = {**row, "Description": " ".join(random.sample(words, random.randint(1, 4)))}
+                if change:
+                    delta.append({"Site": row["Site"], "Stock & Site": row["Stock & Site"], "Stock Description": row["Description"], "Change": change})
+                if change != "removed":
+                    new_rows.append(row)
+            for i in range(10):
+                site = random.choice(["A", "B", "C", "D"])
+                row = {"Site": site, "Stock & Site": "new " + str(i) + " " + site, "Description": " ".join(random.sample(words, random.randint(1, 4)))}
+                delta.append({"Site": site, "Stock & Site": row["Stock & Site"], "Stock Description": row["Description"], "Change": "Added"})
+                new_rows.append(row)
+            output = row_to_row_matcher.apply_delta(old_output, delta, top_n=5)
+            assert self.score_lists(output) == self.score_lists(list(row_to_row_matcher.match_sites(new_rows, top_n=5)))
+            removed = {row["Stock & Site"] for row in delta if row["Change"] == "removed"}
+            assert not any(row["Stock & Site"] in removed or row["Match Stock & Site"] in removed for row in output)
+
+class JsonlOutputTestCase(unittest.TestCase):
+    """Tests for the json lines output format."""
+
+    def rows(self):
+        rows = []
+        for i in range(30):
+            site = random.choice(["A", "B", "C"])
+            rows.append({"Site": site, "Stock & Site": str(i) + " " + site, "Description": random.choice(["bolt", "hex bolt", "nut", "hex nut m10", "washer"])})
+        return [{field: row[field] for field in row_to_row_matcher.OUTPUT_FIELDNAMES} for row in match_sites(rows, top_n=3)]
+
+    def test_records_convert_back_to_same_rows(self):
+        rows = self.rows()
+        records = list(row_to_row_matcher.rows_to_records(rows))
+        assert len(records) < len(rows)
+        assert list(row_to_row_matcher.records_to_rows(records)) == rows
+
+    def test_read_output_reads_both_formats(self):
+        """Saving as csv or jsonl and reading back should give the same rows."""
+        rows = self.rows()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            csv_filename = os.path.join(tmpdir, "output.csv")
+            jsonl_filename = os.path.join(tmpdir, "output.jsonl")
+            row_to_row_matcher.save_output(csv_filename, rows, "csv")
+            row_to_row_matcher.save_output(jsonl_filename, rows, "jsonl")
+            key = lambda row: (row["Stock & Site"], row["Match Stock & Site"])
+            assert sorted(row_to_row_matcher.read_output(jsonl_filename), key=key) == row_to_row_matcher.read_output(csv_filename) == sorted(rows, key=key)
+
+    def test_edited_descriptions_round_trip(self):
+        """Lists of matches of an edited item should stay whole records, and csv to jsonl to csv should give the same file."""
+        rows = []
+        for old_row, description in [("Yes", "bolt"), ("Yes", "hex bolt"), ("No", "hex bolt m10")]:
+            for number, match in enumerate(["1 B", "2 B", "3 B"]):
+                rows.append({"Site": "A", "Match Site": "B", "Stock & Site": "1 A", "Description": description, "Old Row": old_row, "Match Description": "bolt " + match,
+                             "Match Stock & Site": match, "Match Score": "0.5", "Match Number": str(number), "Matching Row Count": "1"})
+        # Old rows of both descriptions interleave by match number, like from generate_old_rows_index
+        rows = sorted(rows[:6], key=lambda row: row["Match Number"]) + rows[6:]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            csv_filename = os.path.join(tmpdir, "output.csv")
+            jsonl_filename = os.path.join(tmpdir, "output.jsonl")
+            back_filename = os.path.join(tmpdir, "back.csv")
+            row_to_row_matcher.save_output(csv_filename, rows, "csv")
+            assert row_to_row_matcher.save_output(jsonl_filename, row_to_row_matcher.read_output(csv_filename), "jsonl") == 3
+            row_to_row_matcher.save_output(back_filename, row_to_row_matcher.read_output(jsonl_filename), "csv")
+            with open(csv_filename) as csv_file, open(back_filename) as back_file:
+                assert csv_file.read() == back_file.read()
+
+class SitePruningTestCase(unittest.TestCase):
+    """Tests for matching sites only against related sites."""
+
+    def rows(self, n, sites):
+        words = {"A": ["bolt", "nut", "hex", "m10"], "B": ["bolt", "nut", "washer", "m12"], "C": ["seal", "ring", "oil"], "D": ["seal", "ring", "filter", "nut"]}
+        rows = []
+        for i in range(n):
+            site = random.choice(sites)
+            rows.append({"Site": site, "Stock & Site": str(random.randint(0, 2*n)) + " " + site, "Description": " ".join(random.sample(words[site], random.randint(1, 3)))})
+        return rows
+
+    def test_related_sites(self):
+        descs = row_to_row_matcher.preprocess_all(self.rows(100, ["A", "B", "C", "D"]))
+        related = row_to_row_matcher.related_sites(descs, top_sites=1)
+        assert related["A"] == {"B"} and related["C"] == {"D"}
+        assert all(site not in row_to_row_matcher.related_sites(descs)[site] for site in descs)
+        assert row_to_row_matcher.related_sites(descs, min_affinity=1.0) == {site: set() for site in descs}
+
+    def test_related_sites_ties_and_unrelated_sites(self):
+        """Ties should be broken by site name, and sites sharing no words should only be related when asked for."""
+        rows = [{"Site": site, "Stock & Site": "1 " + site, "Description": description} for site, description in
+                [("Z", "bolt nut"), ("Y", "bolt washer"), ("X", "bolt seal"), ("W", "pump")]]
+        descs = row_to_row_matcher.preprocess_all(rows)
+        related = row_to_row_matcher.related_sites(descs, top_sites=1)
+        assert related["Z"] == {"X"} and related["W"] == set()
+        assert row_to_row_matcher.related_sites(descs)["Z"] == {"X", "Y"}
+        assert row_to_row_matcher.related_sites(descs, keep_unrelated=True)["Z"] == {"X", "Y", "W"}
+
+    def test_same_matches_for_related_sites(self):
+        """Pruned matching should give the same matches as matching against all sites, only for the related sites."""
+        site_rows = self.rows(80, ["A", "B", "C", "D"])
+        old_site_rows = self.rows(80, ["A", "B", "C", "D"])
+        abbrevs = row_to_row_matcher.compile_abbrevs(row_to_row_matcher.file_utils.read_csv("desc_abbrevs.csv"))
+        _, _, all_descs = row_to_row_matcher.preprocess_new_and_old(site_rows, old_site_rows, abbrevs)
+        related = row_to_row_matcher.related_sites(all_descs, top_sites=2)
+        item_sites = {row["Stock & Site"]: row["Site"] for row in site_rows + old_site_rows}
+        for lsh in ((16, 2), None):
+            full = row_to_row_matcher.match_by_description(site_rows, old_site_rows, lsh=lsh)
+            expected = {item_id: {site: matches for site, matches in site_matches.items() if site in related[item_sites[item_id]]} for item_id, site_matches in full.items()}
+            assert row_to_row_matcher.match_by_description(site_rows, old_site_rows, lsh=lsh, site_pruning=(2, 0.0)) == expected
+        cache = row_to_row_matcher.DescriptionMatchCache(":memory:")
+        for _ in range(2):
+            # Exact matches, as left by the last loop
+            assert row_to_row_matcher.match_by_description(site_rows, old_site_rows, cache=cache, site_pruning=(2, 0.0)) == expected
+        cache.close()
+        new_descs, _, all_descs = row_to_row_matcher.preprocess_new_and_old(site_rows, old_site_rows, abbrevs)
+        serial = row_to_row_matcher.generate_jobs_both_ways(site_rows, old_site_rows, new_descs, all_descs, abbrevs, block_size=7, related=related)
+        assert row_to_row_matcher.generate_jobs_both_ways(site_rows, old_site_rows, new_descs, all_descs, abbrevs, block_size=7, processes=3, related=related) == serial
+        try:
+            import fakeredis
+            from rq import Queue
+        except ImportError:
+            return
+        queue = Queue(is_async=False, connection=fakeredis.FakeRedis())
+        assert row_to_row_matcher.generate_jobs_both_ways(site_rows, old_site_rows, new_descs, all_descs, abbrevs, block_size=7, queue=queue, related=related) == serial
+
+class MatchSitesToRedisTestCase(unittest.TestCase):
+    """Tests for match_sites_to_redis."""
+
+    def test_pages_have_sorted_output(self):
+        """The pages should have the rows match_sites_rows outputs, sorted like csv output, and replace earlier pages."""
+        try:
+            import fakeredis
+            from rq import Queue
+        except ImportError:
+            self.skipTest("rq and fakeredis are needed to run rq tasks locally")
+        words = ["bolt", "nut", "hex", "washer", "m10", "m12", "steel", "brass", "seal", "ring"]
+        rows = []
+        for i in range(40):
+            site = random.choice(["A", "B", "C"])
+            rows.append({"Site": site, "Stock Code": str(i), "Stock & Site": str(i) + " " + site, "Stock Description": " ".join(random.sample(words, random.randint(1, 4)))})
+        queue = Queue(is_async=False, connection=fakeredis.FakeRedis())
+        for old_rows in ([], list(row_to_row_matcher.match_sites_rows(row_to_row_matcher.input_dataframe(rows[20:], [])))):
+            expected = sorted(row_to_row_matcher.match_sites_rows(row_to_row_matcher.input_dataframe(rows[:20], old_rows)), key=row_to_row_matcher.output_row_key)
+            job = queue.enqueue(row_to_row_matcher.match_sites_to_redis, rows[:20], old_rows, "pages", page_size=7)
+            assert job.result == {"Rows": len(expected), "Pages": (len(expected) + 6) // 7}
+            pages = [row_to_row_matcher.json.loads(page) for page in queue.connection.lrange("pages", 0, -1)]
+            assert all(len(page) == 7 for page in pages[:-1])
+            assert [row for page in pages for row in page] == expected
+
+class CanonicalTokenSetsTestCase(unittest.TestCase):
+    """Tests for canonical_token_sets."""
+
+    def test_rows_with_same_tokens_share_an_id_across_sites(self):
+        """Descriptions differing only in case, punctuation and word order should get the same id, whatever their site."""
+        rows = [{"Site": "1", "Stock & Site": "1", "Description": "Bolt, hex"},
+                {"Site": "2", "Stock & Site": "2", "Description": " HEX BOLT"},
+                {"Site": "2", "Stock & Site": "3", "Description": "Nut"}]
+        row_set_ids, token_sets = row_to_row_matcher.canonical_token_sets(rows)
+        assert row_set_ids == [0, 0, 1]
+        assert len(token_sets) == 2
+        assert row_to_row_matcher.compression_ratio(rows) == 1.5
+
 if __name__ == "__main__":
     unittest.main()
     #import file_utils